@@ -1,8 +1,14 @@
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPBearer
-from jose import jwt
+from jose import jwk, jwt
+from jose.exceptions import JOSEError
+from collections import OrderedDict
+import hashlib
 import requests
 import os
+import threading
+import time
+from logs import get_logger
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -17,29 +23,143 @@ IS_CI = os.getenv("GITHUB_ACTIONS") == "true" or os.getenv("CI") == "true"
 
 bearer_scheme = HTTPBearer()
 
+log = get_logger("auth")
+
+# AUTH0_JWKS_URL permite apuntar a un servidor local (benchmarks)
+JWKS_URL = os.getenv("AUTH0_JWKS_URL", f"https://{AUTH0_DOMAIN}/.well-known/jwks.json")
+JWKS_TIMEOUT = float(os.getenv("JWKS_TIMEOUT_SECONDS", "5"))
+# Cada cuánto se refrescan las llaves en segundo plano
+JWKS_REFRESH_INTERVAL = float(os.getenv("JWKS_REFRESH_SECONDS", "3600"))
+# Tiempo mínimo entre refrescos pedidos por un kid desconocido
+JWKS_MIN_REFRESH_INTERVAL = float(os.getenv("JWKS_MIN_REFRESH_SECONDS", "30"))
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "4096"))
+
+
 def get_jwk():
     """Get JWKS from Auth0 - skip in CI environment"""
     if IS_CI:
-        print("[AUTH] Running in CI environment, skipping Auth0 JWKS fetch")
+        log.info("Running in CI environment, skipping Auth0 JWKS fetch")
         return {"keys": []}
     
     if not AUTH0_DOMAIN:
-        print("[AUTH] No Auth0 domain configured, running in mock mode")
+        log.info("No Auth0 domain configured, running in mock mode")
         return {"keys": []}
         
     try:
-        jsonurl = requests.get(f"https://{AUTH0_DOMAIN}/.well-known/jwks.json")
+        jsonurl = requests.get(JWKS_URL, timeout=JWKS_TIMEOUT)
+        jsonurl.raise_for_status()
         return jsonurl.json()
     except Exception as e:
-        print(f"[AUTH] Failed to fetch JWKS: {e}")
+        log.error("Failed to fetch JWKS: %s", e)
         return {"keys": []}
 
-# Only fetch JWKS if not in CI
-if IS_CI:
-    jwks = {"keys": []}
-    print("[AUTH] Running in CI environment, skipping Auth0 initialization")
-else:
-    jwks = get_jwk()
+
+class JWKSRegistry:
+    """Llaves públicas de Auth0 indexadas por ``kid`` y ya parseadas.
+
+    Se refrescan en un hilo de fondo. Si llega un token con un ``kid``
+    desconocido (rotación de llaves) se refresca una sola vez aunque lleguen
+    varios requests a la vez, y no más de una vez cada
+    ``JWKS_MIN_REFRESH_INTERVAL`` segundos.
+    """
+
+    def __init__(self, fetch=get_jwk, min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL):
+        self._fetch = fetch
+        self.min_refresh_interval = min_refresh_interval
+        self._keys = {}
+        self._refresh_lock = threading.Lock()
+        self._refreshed_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        keys = {}
+        for key in self._fetch().get("keys", []):
+            try:
+                keys[key["kid"]] = jwk.construct(key, key.get("alg", "RS256"))
+            except (KeyError, JOSEError) as e:
+                log.warning("Ignoring invalid JWK: %s", e)
+        # Si falla la descarga se mantienen las llaves anteriores
+        if keys:
+            self._keys = keys
+        self._refreshed_at = time.monotonic()
+
+    def get(self, kid):
+        key = self._keys.get(kid)
+        if key is not None:
+            return key
+        with self._refresh_lock:
+            # Otro hilo pudo haber refrescado mientras esperábamos el lock
+            key = self._keys.get(kid)
+            if key is None and (self._refreshed_at is None
+                                or time.monotonic() - self._refreshed_at >= self.min_refresh_interval):
+                self.refresh()
+                key = self._keys.get(kid)
+        return key
+
+    def start(self):
+        """Carga las llaves y las refresca periódicamente en un hilo de fondo."""
+        with self._refresh_lock:
+            self.refresh()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="jwks-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(JWKS_REFRESH_INTERVAL):
+            with self._refresh_lock:
+                self.refresh()
+
+
+class VerifiedTokenCache:
+    """LRU de tokens ya verificados, por hash del token, hasta su ``exp``.
+
+    Evita repetir la verificación RS256 cuando el frontend envía el mismo
+    token en cada request.
+    """
+
+    def __init__(self, max_entries=TOKEN_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            payload, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    def put(self, token, payload):
+        expires_at = payload.get("exp")
+        if not isinstance(expires_at, (int, float)):
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (payload, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+jwks_registry = JWKSRegistry()
+token_cache = VerifiedTokenCache()
 
 def verify_token(token: str = Depends(bearer_scheme)):
     """Verify JWT token - skip validation in CI environment"""
@@ -51,29 +171,23 @@ def verify_token(token: str = Depends(bearer_scheme)):
     
     # Skip auth validation in CI environment
     if IS_CI:
-        print("[AUTH] Running in CI environment, returning mock user")
+        log.debug("Running in CI environment, returning mock user")
         return {"sub": "test-user", "email": "test@example.com"}
     
     # Skip auth validation if no Auth0 domain configured
     if not AUTH0_DOMAIN:
-        print("[AUTH] No Auth0 domain configured, returning mock user")
+        log.debug("No Auth0 domain configured, returning mock user")
         return {"sub": "test-user", "email": "test@example.com"}
     
+    payload = token_cache.get(token.credentials)
+    if payload is not None:
+        return payload
+
     try:
         unverified_header = jwt.get_unverified_header(token.credentials)
-        rsa_key = {}
-        
-        for key in jwks["keys"]:
-            if key["kid"] == unverified_header["kid"]:
-                rsa_key = {
-                    "kty": key["kty"],
-                    "kid": key["kid"],
-                    "use": key["use"],
-                    "n": key["n"],
-                    "e": key["e"]
-                }
+        rsa_key = jwks_registry.get(unverified_header.get("kid"))
                 
-        if rsa_key:
+        if rsa_key is not None:
             payload = jwt.decode(
                 token.credentials,
                 rsa_key,
@@ -81,10 +195,10 @@ def verify_token(token: str = Depends(bearer_scheme)):
                 audience=API_AUDIENCE,
                 issuer=f"https://{AUTH0_DOMAIN}/"
             )
-            print("[DEBUG] Token payload:", payload)
+            token_cache.put(token.credentials, payload)
             return payload
     except Exception as e:
-        print(f"[AUTH] Token validation failed: {e}")
+        log.warning("Token validation failed: %s", e)
         raise credentials_exception
         
     raise credentials_exception
@@ -101,10 +215,10 @@ ROLE_CLAIM = "https://www.arquitecturadesoftware.me/roles"  # ✅ Usa el claim e
 
 def admin_required(user: dict = Depends(verify_token)):
     roles = user.get(ROLE_CLAIM, [])
-    print(f"[AUTH] User roles: {roles}")
+    log.debug("User roles: %s", roles)
     if "admin" not in roles:
         raise HTTPException(status_code=403, detail="Not authorized to access this resource.")
-    print("[AUTH] Admin access granted")
+    log.debug("Admin access granted")
     return user
 
 def is_admin(user: dict = Depends(verify_token)):
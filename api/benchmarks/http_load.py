@@ -0,0 +1,121 @@
+"""Benchmark de carga HTTP para la API.
+
+Lanza N clientes concurrentes (200 por defecto) contra uno o más endpoints y
+reporta throughput y latencias p50/p95/p99 por endpoint. Para comparar antes y
+después de un cambio se guarda el resultado en JSON y luego se pasa con
+``--compare``::
+
+    # con la versión anterior levantada
+    python benchmarks/http_load.py --output before.json
+    # con la versión nueva
+    python benchmarks/http_load.py --output after.json --compare before.json
+
+Los endpoints protegidos necesitan ``--token`` (o la variable BENCH_TOKEN).
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import httpx
+
+DEFAULT_ENDPOINTS = ["/stocks", "/events/all", "/stocks/{symbol}/event_log"]
+
+
+def percentile(sorted_values, pct):
+    """Percentil por rango más cercano sobre una lista ordenada."""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    total = len(latencies) + errors
+    return {
+        "requests": total,
+        "errors": errors,
+        "throughput_rps": round(total / elapsed, 2) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+    }
+
+
+async def run_endpoint(client, path, concurrency, total_requests):
+    latencies = []
+    errors = 0
+    remaining = total_requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            try:
+                response = await client.get(path)
+                if response.status_code >= 400:
+                    errors += 1
+                    continue
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+async def run(args):
+    headers = {"Authorization": f"Bearer {args.token}"} if args.token else {}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    results = {"concurrency": args.concurrency, "endpoints": {}}
+    async with httpx.AsyncClient(base_url=args.base_url, headers=headers, limits=limits, timeout=args.timeout) as client:
+        for endpoint in args.endpoint or DEFAULT_ENDPOINTS:
+            path = endpoint.format(symbol=args.symbol)
+            # Calentar conexiones antes de medir
+            await run_endpoint(client, path, args.concurrency, args.concurrency)
+            results["endpoints"][endpoint] = await run_endpoint(client, path, args.concurrency, args.requests)
+    return results
+
+
+def print_report(results, baseline=None):
+    print(f"Concurrencia: {results['concurrency']}")
+    for endpoint, stats in results["endpoints"].items():
+        line = (f"{endpoint:40} {stats['throughput_rps']:>10} req/s  p50 {stats['p50_ms']} ms  "
+                f"p95 {stats['p95_ms']} ms  p99 {stats['p99_ms']} ms  errores {stats['errors']}")
+        before = (baseline or {}).get("endpoints", {}).get(endpoint)
+        if before and before.get("p99_ms") and stats.get("p99_ms"):
+            line += f"  (p50 antes {before['p50_ms']} ms, p99 antes {before['p99_ms']} ms)"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default=os.getenv("BENCH_BASE_URL", "http://localhost:8000"))
+    parser.add_argument("--endpoint", action="append", help="Ruta a medir; se puede repetir")
+    parser.add_argument("--symbol", default="AAPL", help="Símbolo para rutas con {symbol}")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=5000, help="Requests por endpoint")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--token", default=os.getenv("BENCH_TOKEN"))
+    parser.add_argument("--output", help="Archivo JSON donde guardar el resultado")
+    parser.add_argument("--compare", help="Resultado JSON anterior para comparar")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,422 @@
+"""Prueba de carga reproducible de la API, sin servicios externos.
+
+Levanta un ``mongod`` local con un dataset sintético, reemplaza Auth0,
+Transbank, JobMaster y la lambda de boletas por ``stubs.StubServer``, inicia
+la API con uvicorn y recorre cada escenario con una concurrencia fija:
+
+- ``stocks``: ``GET /stocks``
+- ``stock_detail``: ``GET /stocks/{symbol}``
+- ``events``: ``GET /events/all``
+- ``transactions``: ``GET /transactions`` (token del usuario)
+- ``buy``: ``POST /stocks/{symbol}/buy``
+- ``webpay``: ``POST /webpay/create`` seguido de ``POST /webpay/commit``
+
+Reporta throughput y latencias p50/p95/p99 por request y guarda el
+resultado en JSON para comparar contra una línea base.
+
+Uso::
+
+    python benchmarks/loadtest.py --symbols 200 --events 200000 --users 500 \\
+        --concurrency 32 --duration 20 --output baseline.json
+    python benchmarks/loadtest.py --compare baseline.json
+
+Con ``--mongo-uri`` se usa un servidor existente en vez de iniciar ``mongod``
+(la base ``stocks_db`` se reemplaza con el dataset).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import httpx
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stubs import StubServer, TokenIssuer  # noqa: E402
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_NAME = "stocks_db"
+AUTH0_DOMAIN = "bench.auth0.local"
+AUTH0_AUDIENCE = "https://bench.api/"
+SEED = 20240501
+BATCH_SIZE = 5000
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until(check, timeout, what):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except Exception:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{what} no respondió en {timeout}s")
+
+
+class LocalMongod:
+    """``mongod`` en un directorio temporal, como réplica de un nodo.
+
+    Con replica set los change streams y las transacciones quedan
+    disponibles igual que en producción.
+    """
+
+    def __init__(self, binary="mongod"):
+        self.binary = shutil.which(binary)
+        if self.binary is None:
+            raise RuntimeError(f"No se encontró {binary} en el PATH; usa --mongo-uri")
+        self.port = free_port()
+        self.dbpath = tempfile.mkdtemp(prefix="bench-mongod-")
+        self.process = None
+
+    @property
+    def uri(self):
+        return f"mongodb://127.0.0.1:{self.port}/?replicaSet=bench&directConnection=true"
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [self.binary, "--port", str(self.port), "--dbpath", self.dbpath, "--bind_ip", "127.0.0.1",
+             "--replSet", "bench", "--quiet", "--logpath", os.path.join(self.dbpath, "mongod.log")],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        client = MongoClient(f"mongodb://127.0.0.1:{self.port}/?directConnection=true", serverSelectionTimeoutMS=1000)
+        wait_until(lambda: client.admin.command("ping"), 30, "mongod")
+        client.admin.command("replSetInitiate", {"_id": "bench", "members": [{"_id": 0, "host": f"127.0.0.1:{self.port}"}]})
+        wait_until(lambda: client.admin.command("hello").get("isWritablePrimary"), 30, "primario del replica set")
+        client.close()
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        shutil.rmtree(self.dbpath, ignore_errors=True)
+
+
+def seed(uri, symbols, events, users, transactions):
+    """Carga un dataset sintético y determinista; retorna símbolos y usuarios."""
+    rng = random.Random(SEED)
+    client = MongoClient(uri)
+    client.drop_database(DB_NAME)
+    db = client[DB_NAME]
+    now = datetime.utcnow().replace(microsecond=0)
+
+    symbol_names = [f"S{i:04d}" for i in range(symbols)]
+    prices = {symbol: round(rng.uniform(5, 500), 2) for symbol in symbol_names}
+    db["current_stocks"].insert_many([{
+        "symbol": symbol,
+        "shortName": symbol,
+        "longName": f"Synthetic {symbol} Inc.",
+        "price": prices[symbol],
+        "currency": "USD",
+        "quantity": 10_000_000,
+        "timestamp": now,
+    } for symbol in symbol_names])
+    db["admin_transactions"].insert_many([
+        {"symbol": symbol, "quantity": 10_000_000, "price": prices[symbol], "timestamp": now}
+        for symbol in symbol_names
+    ])
+
+    start = now - timedelta(seconds=events)
+    batch = []
+    for i in range(events):
+        symbol = symbol_names[i % symbols]
+        batch.append({
+            "type": "UPDATE",
+            "symbol": symbol,
+            "quantity": rng.randint(1, 100),
+            "price": round(prices[symbol] * rng.uniform(0.9, 1.1), 2),
+            "longName": f"Synthetic {symbol} Inc.",
+            "timestamp": start + timedelta(seconds=i),
+        })
+        if len(batch) == BATCH_SIZE:
+            db["event_log"].insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        db["event_log"].insert_many(batch, ordered=False)
+
+    user_ids = [f"bench-user-{i}" for i in range(users)]
+    db["users"].insert_many([{"correo": user_id, "saldo": 1e12} for user_id in user_ids])
+
+    batch = []
+    for i in range(transactions):
+        batch.append({
+            "request_id": f"seed-{i}",
+            "transaction_id": f"seed-{i}",
+            "symbol": symbol_names[rng.randrange(symbols)],
+            "quantity": rng.randint(1, 10),
+            "user_email": user_ids[i % users],
+            "timestamp": now - timedelta(minutes=i),
+            "status": rng.choice(("OK", "PENDING", "REJECTED")),
+            "estimated_gain": None,
+        })
+        if len(batch) == BATCH_SIZE:
+            db["transactions"].insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        db["transactions"].insert_many(batch, ordered=False)
+    client.close()
+    return symbol_names, user_ids
+
+
+class ApiProcess:
+    """La API con uvicorn apuntando a Mongo y a los stubs locales."""
+
+    def __init__(self, mongo_uri, stub_url, workers=1):
+        self.port = free_port()
+        self.workers = workers
+        self.env = {key: value for key, value in os.environ.items() if key not in ("CI", "GITHUB_ACTIONS")}
+        self.env.update({
+            "MONGO_URI": mongo_uri,
+            "AUTH0_DOMAIN": AUTH0_DOMAIN,
+            "AUTH0_AUDIENCE": AUTH0_AUDIENCE,
+            "AUTH0_JWKS_URL": f"{stub_url}/.well-known/jwks.json",
+            "JOBMASTER_URL": stub_url,
+            "RECEIPT_STORE": os.path.join(tempfile.gettempdir(), f"bench-receipts-{self.port}"),
+            "TRANSBANK_HOST": stub_url,
+            # Sin broker MQTT los publish quedan en modo mock
+            "MQTT_BROKER": "",
+            "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+        })
+        self.process = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(self.port),
+             "--workers", str(self.workers), "--no-access-log"],
+            cwd=API_DIR, env=self.env,
+        )
+        wait_until(lambda: httpx.get(self.url + "/").status_code == 200, 60, "la API")
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+def _is_error_body(response):
+    # Varios endpoints responden 200 con {"error": ...}
+    if not response.headers.get("content-type", "").startswith("application/json"):
+        return False
+    body = response.json()
+    return isinstance(body, dict) and ("error" in body or body.get("status") == "ERROR")
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    async def request(self, client, name, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            response = None
+        ok = response is not None and response.status_code < 400 and not _is_error_body(response)
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+        return response if ok else None
+
+
+class Workload:
+    """Escenarios; cada uno hace uno o más requests con datos al azar."""
+
+    def __init__(self, symbols, users, tokens, rng):
+        self.symbols = symbols
+        self.users = users
+        self.tokens = tokens
+        self.rng = rng
+
+    def _auth(self):
+        user = self.rng.choice(self.users)
+        return {"Authorization": f"Bearer {self.tokens[user]}"}
+
+    async def stocks(self, client, recorder):
+        await recorder.request(client, "GET /stocks", "GET", "/stocks",
+                               params={"page": self.rng.randint(1, 5), "count": 25})
+
+    async def stock_detail(self, client, recorder):
+        await recorder.request(client, "GET /stocks/{symbol}", "GET", f"/stocks/{self.rng.choice(self.symbols)}")
+
+    async def events(self, client, recorder):
+        await recorder.request(client, "GET /events/all", "GET", "/events/all",
+                               params={"page": self.rng.randint(1, 20), "count": 25})
+
+    async def transactions(self, client, recorder):
+        await recorder.request(client, "GET /transactions", "GET", "/transactions", headers=self._auth())
+
+    async def buy(self, client, recorder):
+        await recorder.request(client, "POST /stocks/{symbol}/buy", "POST", f"/stocks/{self.rng.choice(self.symbols)}/buy",
+                               params={"quantity": 1}, headers=self._auth())
+
+    async def webpay(self, client, recorder):
+        headers = self._auth()
+        created = await recorder.request(client, "POST /webpay/create", "POST", "/webpay/create", headers=headers,
+                                         json={"symbol": self.rng.choice(self.symbols), "quantity": 1, "amount": 1000})
+        if created is None:
+            return
+        data = created.json()
+        await recorder.request(client, "POST /webpay/commit", "POST", "/webpay/commit", headers=headers,
+                               json={"token_ws": data["token_ws"], "request_id": data["request_id"]})
+
+
+SCENARIOS = ("stocks", "stock_detail", "events", "transactions", "buy", "webpay")
+
+
+async def run_scenario(base_url, scenario, concurrency, duration, warmup):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        async def worker(recorder, deadline):
+            while time.perf_counter() < deadline:
+                await scenario(client, recorder)
+
+        if warmup:
+            await asyncio.gather(*(worker(Recorder(), time.perf_counter() + warmup) for _ in range(concurrency)))
+        recorder = Recorder()
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(recorder, started + duration) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return recorder, elapsed
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(recorder, elapsed):
+    results = {}
+    for name, latencies in recorder.latencies.items():
+        latencies.sort()
+        results[name] = {
+            "requests": len(latencies),
+            "errors": recorder.errors.get(name, 0),
+            "rps": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        }
+    return results
+
+
+def print_report(results, baseline=None):
+    print(f"{'request':30} {'reqs':>7} {'err':>5} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, result in results.items():
+        line = (f"{name:30} {result['requests']:7d} {result['errors']:5d} {result['rps']:9.1f} "
+                f"{result['p50_ms']:9.2f} {result['p95_ms']:9.2f} {result['p99_ms']:9.2f}")
+        before = (baseline or {}).get(name)
+        if before:
+            rps_delta = (result["rps"] / before["rps"] - 1) * 100 if before["rps"] else 0.0
+            p95_delta = (result["p95_ms"] / before["p95_ms"] - 1) * 100 if before["p95_ms"] else 0.0
+            line += f"   req/s {rps_delta:+6.1f}%  p95 {p95_delta:+6.1f}%"
+        print(line)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=API_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--symbols", type=int, default=100)
+    parser.add_argument("--events", type=int, default=50_000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--transactions", type=int, default=20_000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0, help="segundos medidos por escenario")
+    parser.add_argument("--warmup", type=float, default=2.0, help="segundos sin medir antes de cada escenario")
+    parser.add_argument("--workers", type=int, default=1, help="procesos de uvicorn")
+    parser.add_argument("--stub-latency-ms", type=float, default=0.0, help="latencia simulada de los servicios externos")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--mongo-uri", help="usar este servidor en vez de iniciar mongod")
+    parser.add_argument("--output", help="archivo JSON donde guardar el resultado")
+    parser.add_argument("--compare", help="resultado JSON anterior contra el que comparar")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    mongod = None
+    stubs = None
+    api = None
+    try:
+        if args.mongo_uri:
+            mongo_uri = args.mongo_uri
+        else:
+            mongod = LocalMongod().start()
+            mongo_uri = mongod.uri
+        print(f"Cargando dataset: {args.symbols} símbolos, {args.events} eventos, {args.users} usuarios, "
+              f"{args.transactions} transacciones")
+        symbols, users = seed(mongo_uri, args.symbols, args.events, args.users, args.transactions)
+
+        issuer = TokenIssuer(AUTH0_DOMAIN, AUTH0_AUDIENCE)
+        tokens = {user: issuer.token(user) for user in users}
+        stubs = StubServer(issuer, latency=args.stub_latency_ms / 1000).start()
+        api = ApiProcess(mongo_uri, stubs.url, workers=args.workers).start()
+
+        workload = Workload(symbols, users, tokens, random.Random(SEED))
+        results = {}
+        for name in args.scenarios.split(","):
+            recorder, elapsed = asyncio.run(run_scenario(api.url, getattr(workload, name.strip()),
+                                                         args.concurrency, args.duration, args.warmup))
+            results.update(summarize(recorder, elapsed))
+        print_report(results, baseline)
+
+        if args.output:
+            report = {
+                "revision": git_revision(),
+                "created_at": datetime.utcnow().isoformat(timespec="seconds"),
+                "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+                "stub_hits": dict(stubs.hits),
+                "results": results,
+            }
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"Resultado guardado en {args.output}")
+    finally:
+        if api is not None:
+            api.stop()
+        if stubs is not None:
+            stubs.stop()
+        if mongod is not None:
+            mongod.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Micro-benchmark de serialización de una página de ``/events/all``.
+
+Compara, para una página de 1.000 eventos sintéticos, el costo de:
+
+- ``jsonable_encoder`` + ``json.dumps`` (respuesta por defecto de FastAPI),
+- ``jsonable_encoder`` + orjson (ORJSONResponse retornando un dict),
+- filas serializadas con orjson al salir del cursor (``JSONRows``).
+
+Uso::
+
+    python benchmarks/serialization.py --rows 1000 --repeat 200
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+from fastapi.encoders import jsonable_encoder
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from responses import JSONRows, dumps  # noqa: E402
+
+
+def make_events(rows):
+    start = datetime(2024, 1, 1)
+    return [
+        {
+            "type": "UPDATE",
+            "symbol": f"SYM{i % 50}",
+            "quantity": i % 7,
+            "price": 100 + i * 0.01,
+            "longName": f"Company {i % 50}",
+            "timestamp": start + timedelta(seconds=i),
+        }
+        for i in range(rows)
+    ]
+
+
+def encoder_json(events):
+    content = jsonable_encoder({"event_log": events, "page": 1, "count": len(events), "total": len(events)})
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def encoder_orjson(events):
+    content = jsonable_encoder({"event_log": events, "page": 1, "count": len(events), "total": len(events)})
+    return dumps(content)
+
+
+def rows_orjson(events):
+    rows = JSONRows.from_documents(events)
+    return dumps({"event_log": rows, "page": 1, "count": len(rows), "total": len(rows)})
+
+
+CASES = {
+    "jsonable_encoder+json": encoder_json,
+    "jsonable_encoder+orjson": encoder_orjson,
+    "rows+orjson": rows_orjson,
+}
+
+
+def measure(fn, events, repeat):
+    timings = []
+    for _ in range(repeat):
+        # Copia para que cada vuelta parta de documentos recién leídos
+        page = [dict(event) for event in events]
+        started = time.perf_counter()
+        fn(page)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {
+        "median_ms": round(timings[len(timings) // 2] * 1000, 3),
+        "min_ms": round(timings[0] * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    events = make_events(args.rows)
+    # Todas las variantes deben producir el mismo JSON
+    expected = json.loads(encoder_json(events))
+    for name, fn in CASES.items():
+        assert json.loads(fn([dict(event) for event in events])) == expected, name
+
+    results = {name: measure(fn, events, args.repeat) for name, fn in CASES.items()}
+    baseline = results["jsonable_encoder+json"]["median_ms"]
+    for name, result in results.items():
+        speedup = baseline / result["median_ms"] if result["median_ms"] else None
+        print(f"{name:26} median {result['median_ms']:8.3f} ms  min {result['min_ms']:8.3f} ms  "
+              f"x{speedup:.1f}")
+
+
+if __name__ == "__main__":
+    main()
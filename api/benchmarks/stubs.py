@@ -0,0 +1,159 @@
+"""Servicios externos simulados para correr los benchmarks sin red.
+
+Un solo servidor HTTP local responde por:
+
+- Auth0: ``/.well-known/jwks.json`` con la llave pública de ``TokenIssuer``,
+- JobMaster: ``POST /job`` y ``GET /heartbeat``,
+- Webpay Plus: ``POST`` y ``PUT`` sobre ``/rswebpaytransaction/api/webpay/v1.2/transactions/``.
+
+``latency`` agrega una espera fija a cada respuesta para simular la red y
+``job_failures`` hace que los siguientes ``POST /job`` respondan 503.
+"""
+import base64
+import json
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import rsa
+from jose import jwt
+
+WEBPAY_TRANSACTIONS = "/rswebpaytransaction/api/webpay/v1.2/transactions/"
+
+
+def _b64_uint(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+class TokenIssuer:
+    """Firma tokens RS256 como los de Auth0 con una llave generada al vuelo."""
+
+    def __init__(self, domain, audience, kid="bench-key"):
+        self.domain = domain
+        self.audience = audience
+        self.kid = kid
+        self._public, self._private = rsa.newkeys(2048)
+        self._pem = self._private.save_pkcs1().decode("ascii")
+
+    def jwks(self):
+        return {"keys": [{
+            "kty": "RSA",
+            "kid": self.kid,
+            "use": "sig",
+            "alg": "RS256",
+            "n": _b64_uint(self._public.n),
+            "e": _b64_uint(self._public.e),
+        }]}
+
+    def token(self, sub, roles=(), ttl=3600):
+        now = int(time.time())
+        claims = {
+            "sub": sub,
+            "iss": f"https://{self.domain}/",
+            "aud": self.audience,
+            "iat": now,
+            "exp": now + ttl,
+            "https://www.arquitecturadesoftware.me/roles": list(roles),
+        }
+        return jwt.encode(claims, self._pem, algorithm="RS256", headers={"kid": self.kid})
+
+
+class StubServer:
+    def __init__(self, issuer, latency=0.0, host="127.0.0.1", port=0):
+        self.issuer = issuer
+        self.latency = latency
+        self.hits = Counter()
+        self.job_failures = 0
+        self._amounts = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="bench-stubs", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                try:
+                    return json.loads(raw) if raw else {}
+                except ValueError:
+                    return {}
+
+            def _reply(self, name, payload, status=200):
+                stub.hits[name] += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == "/.well-known/jwks.json":
+                    return self._reply("jwks", stub.issuer.jwks())
+                if self.path == "/heartbeat":
+                    return self._reply("jobmaster_heartbeat", {"status": "ok", "workers": 1})
+                return self._reply("not_found", {"error": self.path}, 404)
+
+            def do_POST(self):
+                body = self._body()
+                if self.path == "/job":
+                    with stub._lock:
+                        failing = stub.job_failures > 0
+                        stub.job_failures -= failing
+                    if failing:
+                        return self._reply("jobmaster_job_failed", {"error": "unavailable"}, 503)
+                    return self._reply("jobmaster_job", {"job_id": uuid.uuid4().hex})
+                if self.path == WEBPAY_TRANSACTIONS:
+                    token = uuid.uuid4().hex + uuid.uuid4().hex[:32]
+                    with stub._lock:
+                        stub._amounts[token] = (body.get("buy_order"), body.get("amount", 0))
+                    return self._reply("webpay_create", {"token": token, "url": f"{stub.url}/webpay"})
+                return self._reply("not_found", {"error": self.path}, 404)
+
+            def do_PUT(self):
+                self._body()
+                if self.path.startswith(WEBPAY_TRANSACTIONS):
+                    token = self.path[len(WEBPAY_TRANSACTIONS):]
+                    with stub._lock:
+                        buy_order, amount = stub._amounts.pop(token, (None, 0))
+                    return self._reply("webpay_commit", {
+                        "vci": "TSY",
+                        "amount": amount,
+                        "status": "AUTHORIZED",
+                        "buy_order": buy_order,
+                        "response_code": 0,
+                        "authorization_code": "1213",
+                        "payment_type_code": "VN",
+                        "installments_number": 0,
+                    })
+                return self._reply("not_found", {"error": self.path}, 404)
+
+        return Handler
@@ -3,7 +3,9 @@ import json
 from datetime import datetime, timezone
 import paho.mqtt.client as mqtt
 from dotenv import load_dotenv
-import requests  
+from logs import get_logger
+from metrics import register_stats, track_message
+from buy_requests.publisher import OutboundPublisher
 
 load_dotenv()
 
@@ -12,9 +14,12 @@ BROKER_PORT    = int(os.getenv("MQTT_PORT", "1883"))
 TOPIC_REQUESTS = "stocks/requests"
 TOPIC_VALIDATION = "stocks/validation"
 TOPIC_AUCTION = "stocks/auctions"
+TOPIC_UPDATES = "stocks/updates"
 MQTT_USER      = os.getenv("MQTT_USER")
 MQTT_PASSWORD  = os.getenv("MQTT_PASSWORD")
 
+log = get_logger("mqtt")
+
 # Detect if running in CI environment
 IS_CI = os.getenv("GITHUB_ACTIONS") == "true" or os.getenv("CI") == "true"
 
@@ -23,17 +28,21 @@ class MQTTManager:
         self.group_id = group_id
         self.client = None
         self._connected = False
+        # Cola y hilo de publicación; se crean al conectar
+        self.publisher = None
+        # Tópicos a los que se suscribe la API: topic -> callback(payload)
+        self._listeners = {}
         
         # Skip MQTT connection in CI environment
         if IS_CI:
-            print("[MQTT] Running in CI environment, skipping MQTT connection")
+            log.info("Running in CI environment, skipping MQTT connection")
             return
             
         # Only try to connect if we have a broker host
         if BROKER_HOST:
             self._connect()
         else:
-            print("[MQTT] No broker configured, running in mock mode")
+            log.info("No broker configured, running in mock mode")
 
     def _connect(self):
         """Try to connect to MQTT broker"""
@@ -41,18 +50,56 @@ class MQTTManager:
             self.client = mqtt.Client()
             if MQTT_USER:
                 self.client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
+            self.client.on_connect = self._on_connect
+            self.client.on_message = self._on_message
             self.client.connect(BROKER_HOST, BROKER_PORT, keepalive=60)
             self.client.loop_start()
+            self.publisher = OutboundPublisher(self.client).start()
+            register_stats("mqtt_outbound", self.publisher.stats)
             self._connected = True
-            print(f"[MQTT] Connected to {BROKER_HOST}:{BROKER_PORT}")
+            log.info("Connected to %s:%s", BROKER_HOST, BROKER_PORT)
         except Exception as e:
-            print(f"[MQTT] Connection failed: {e}")
+            log.error("Connection failed: %s", e)
             self._connected = False
 
-    def publish_buy_request(self, transaction_id: str, symbol: str, quantity: int, deposit_token: str = "") -> str:
-        if not self._connected:
-            print(f"[MQTT] Mock: Would publish BUY request {transaction_id}")
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        # Al reconectar se pierden las suscripciones
+        for topic in self._listeners:
+            client.subscribe(topic)
+
+    def _on_message(self, client, userdata, msg):
+        listener = self._listeners.get(msg.topic)
+        if listener is None:
             return
+        try:
+            with track_message(msg.topic):
+                listener(json.loads(msg.payload.decode("utf-8")))
+        except Exception as e:
+            log.error("Error procesando mensaje de %s: %s", msg.topic, e)
+
+    def subscribe(self, topic: str, listener) -> None:
+        """Llama a ``listener`` con el JSON de cada mensaje recibido en ``topic``."""
+        self._listeners[topic] = listener
+        if self._connected:
+            self.client.subscribe(topic)
+
+    def _publish(self, topic: str, payload: dict, qos: int) -> bool:
+        # El hilo de publicación serializa, publica y espera la confirmación;
+        # False si la cola de publicación está llena
+        return self.publisher.enqueue(topic, payload, qos)
+
+    def close(self, timeout: float = 10) -> None:
+        """Publica lo encolado y desconecta el cliente."""
+        if self.publisher is not None:
+            self.publisher.close(timeout)
+        if self.client is not None and self._connected:
+            self.client.loop_stop()
+            self.client.disconnect()
+
+    def publish_buy_request(self, transaction_id: str, symbol: str, quantity: int, deposit_token: str = "") -> bool:
+        if not self._connected:
+            log.debug("Mock: Would publish BUY request %s", transaction_id)
+            return True
             
         payload = {
             "request_id": transaction_id,
@@ -61,17 +108,18 @@ class MQTTManager:
             "symbol": symbol,
             "operation": "BUY",
         }
-        self.client.publish(TOPIC_REQUESTS, json.dumps(payload), qos=1)
-
-        print(f"[MQTT] Publicada solicitud BUY: {payload}")
+        if not self._publish(TOPIC_REQUESTS, payload, qos=1):
+            return False
+        log.info("Publicada solicitud BUY", extra={"fields": payload})
 
         #aun no se envia al JobMaster, se hace en el momento de la validación de la compra
         #enviar_estimacion_jobmaster(self.group_id, symbol, quantity) 
+        return True
     
-    def publish_validation(self, request_id: str, status_transaction: str, deposit_token: str = "") -> None:
+    def publish_validation(self, request_id: str, status_transaction: str, deposit_token: str = "") -> bool:
         if not self._connected:
-            print(f"[MQTT] Mock: Would publish validation {request_id}")
-            return
+            log.debug("Mock: Would publish validation %s", request_id)
+            return True
             
         payload = {
             "request_id": request_id,
@@ -80,13 +128,15 @@ class MQTTManager:
             "reason": "",
             "deposit_token": deposit_token
         }
-        self.client.publish(TOPIC_VALIDATION, json.dumps(payload), qos=0)
-        print(f"[MQTT] Published validation: {payload}")
+        if not self._publish(TOPIC_VALIDATION, payload, qos=0):
+            return False
+        log.info("Published validation", extra={"fields": payload})
+        return True
     
-    def publish_auction_offer(self, auction_id: str, stock_symbol: str, quantity: int) -> None:
+    def publish_auction_offer(self, auction_id: str, stock_symbol: str, quantity: int) -> bool:
         if not self._connected:
-            print(f"[MQTT] Mock: Would publish auction {auction_id}")
-            return
+            log.debug("Mock: Would publish auction %s", auction_id)
+            return True
             
         payload = {
             "auction_id": auction_id,
@@ -97,13 +147,15 @@ class MQTTManager:
             "group_id": self.group_id,
             "operation": "offer",
         }
-        self.client.publish(TOPIC_AUCTION, json.dumps(payload), qos=1)
-        print(f"[MQTT] Published auction offer: {payload}")
+        if not self._publish(TOPIC_AUCTION, payload, qos=1):
+            return False
+        log.info("Published auction offer", extra={"fields": payload})
+        return True
     
-    def publish_auction_proposal(self, auction_id: str, proposal_id: str, stock_symbol: str, quantity: int) -> None:
+    def publish_auction_proposal(self, auction_id: str, proposal_id: str, stock_symbol: str, quantity: int) -> bool:
         if not self._connected:
-            print(f"[MQTT] Mock: Would publish auction proposal {auction_id} {proposal_id}")
-            return
+            log.debug("Mock: Would publish auction proposal %s %s", auction_id, proposal_id)
+            return True
             
         payload = {
             "auction_id": auction_id,
@@ -114,13 +166,15 @@ class MQTTManager:
             "group_id": self.group_id,
             "operation": "proposal",
         }
-        self.client.publish(TOPIC_AUCTION, json.dumps(payload), qos=1)
-        print(f"[MQTT] Published auction proposal: {payload}")
+        if not self._publish(TOPIC_AUCTION, payload, qos=1):
+            return False
+        log.info("Published auction proposal", extra={"fields": payload})
+        return True
     
-    def publish_proposal_response(self, auction_id: str, proposal_id: str, stock_symbol: str, quantity: int, response: str) -> None:
+    def publish_proposal_response(self, auction_id: str, proposal_id: str, stock_symbol: str, quantity: int, response: str) -> bool:
         if not self._connected:
-            print(f"[MQTT] Mock: Would publish proposal acceptance {auction_id} {proposal_id}")
-            return
+            log.debug("Mock: Would publish proposal acceptance %s %s", auction_id, proposal_id)
+            return True
             
         payload = {
             "auction_id": auction_id,
@@ -131,24 +185,10 @@ class MQTTManager:
             "group_id": self.group_id,
             "operation": response  # "accept" or "reject"
         }
-        self.client.publish(TOPIC_AUCTION, json.dumps(payload), qos=1)
-        print(f"[MQTT] Published proposal acceptance: {payload}")
-
-    def enviar_estimacion_jobmaster(self,user_id, stock_symbol, quantity, price, request_id):
-        try:
-            res = requests.post("https://iic2175danielaarp.me/job", json={
-                "user_id": user_id,
-                "stock_symbol": stock_symbol,
-                "quantity": quantity,
-                "price": price,
-                "request_id": request_id
-            })
-            data = res.json()
-            print("[JobMaster] Estimación enviada, job_id:", data["job_id"])
-            return data["job_id"]
-        except Exception as e:
-            print("[JobMaster] Error al enviar estimación:", e)
-            return None
+        if not self._publish(TOPIC_AUCTION, payload, qos=1):
+            return False
+        log.info("Published proposal acceptance", extra={"fields": payload})
+        return True
 
 
 mqtt_manager = MQTTManager(group_id="27")
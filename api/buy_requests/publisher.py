@@ -0,0 +1,202 @@
+"""Publicación MQTT de la API fuera del request.
+
+Los handlers solo encolan el mensaje (``enqueue``) y responden. Un hilo
+dedicado lo serializa y lo publica manteniendo a lo más
+``MQTT_PUBLISH_WINDOW`` mensajes sin confirmar. La confirmación (PUBACK en
+QoS 1, escritura en el socket en QoS 0) se sigue con
+``MQTTMessageInfo.wait_for_publish``. Un mensaje que falla o que sigue sin
+confirmar después de ``MQTT_ACK_TIMEOUT_SECONDS`` se vuelve a publicar hasta
+``MQTT_PUBLISH_RETRIES`` veces; los brokers descartan los repetidos.
+
+Mientras el cliente está desconectado no se publica: los mensajes esperan en
+la cola (``MQTT_PUBLISH_QUEUE_SIZE``) y, si se llena, ``enqueue`` los
+rechaza en vez de bloquear al handler.
+"""
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+from paho.mqtt.client import MQTT_ERR_SUCCESS
+
+from logs import get_logger
+from metrics import observe_ack, observe_publish, observe_republish
+
+log = get_logger("mqtt")
+
+MQTT_PUBLISH_WINDOW = int(os.getenv("MQTT_PUBLISH_WINDOW", "20"))
+MQTT_PUBLISH_QUEUE_SIZE = int(os.getenv("MQTT_PUBLISH_QUEUE_SIZE", "10000"))
+MQTT_ACK_TIMEOUT_SECONDS = float(os.getenv("MQTT_ACK_TIMEOUT_SECONDS", "10"))
+MQTT_PUBLISH_RETRIES = int(os.getenv("MQTT_PUBLISH_RETRIES", "3"))
+# Espera antes de volver a publicar un mensaje que falló
+RETRY_DELAY = 1.0
+# Cada cuánto se revisan las confirmaciones y la conexión
+POLL_INTERVAL = 0.05
+
+
+class _Outbound:
+    __slots__ = ("topic", "payload", "qos", "data", "attempts", "sent_at", "info")
+
+    def __init__(self, topic, payload, qos):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.data = None
+        self.attempts = 0
+        self.sent_at = None
+        self.info = None
+
+
+def _published(info):
+    """True si se confirmó, False si sigue pendiente y None si falló."""
+    try:
+        return info.is_published()
+    except (RuntimeError, ValueError):
+        return None
+
+
+class OutboundPublisher:
+    def __init__(self, client, window=MQTT_PUBLISH_WINDOW, queue_size=MQTT_PUBLISH_QUEUE_SIZE,
+                 ack_timeout=MQTT_ACK_TIMEOUT_SECONDS, retries=MQTT_PUBLISH_RETRIES, retry_delay=RETRY_DELAY):
+        self.client = client
+        self.window = max(1, window)
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        # (listo_en, mensaje) que esperan para volver a publicarse
+        self._retry = deque()
+        self._in_flight = deque()
+        self._stop = threading.Event()
+        self._thread = None
+        self.enqueued = 0
+        self.rejected = 0
+        self.published = 0
+        self.acked = 0
+        self.republished = 0
+        self.failed = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="mqtt-publisher", daemon=True)
+        self._thread.start()
+        return self
+
+    def enqueue(self, topic, payload, qos):
+        """Encola un mensaje; retorna False si la cola está llena."""
+        try:
+            self._queue.put_nowait(_Outbound(topic, payload, qos))
+        except queue.Full:
+            self.rejected += 1
+            log.error("Cola de publicación llena, se descarta el mensaje a %s", topic)
+            return False
+        self.enqueued += 1
+        return True
+
+    def close(self, timeout=10):
+        """Publica lo pendiente (hasta ``timeout`` segundos) y detiene el hilo."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _idle(self):
+        return not self._in_flight and not self._retry and self._queue.empty()
+
+    def _run(self):
+        while not (self._stop.is_set() and self._idle()):
+            try:
+                if self.client.is_connected():
+                    self._fill()
+                if self._in_flight:
+                    self._wait_oldest()
+                elif not self._retry and self.client.is_connected():
+                    self._wait_queue()
+                else:
+                    time.sleep(POLL_INTERVAL)
+                self._sweep()
+            except Exception:
+                # El hilo sigue; lo que estaba en vuelo se revisa en la próxima vuelta
+                log.exception("Error en el hilo de publicación")
+                time.sleep(POLL_INTERVAL)
+
+    def _next(self):
+        if self._retry and self._retry[0][0] <= time.monotonic():
+            return self._retry.popleft()[1]
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            return None
+
+    def _fill(self):
+        while len(self._in_flight) < self.window:
+            message = self._next()
+            if message is None:
+                return
+            self._send(message)
+
+    def _send(self, message):
+        if message.data is None:
+            message.data = json.dumps(message.payload)
+        if message.attempts:
+            self.republished += 1
+            observe_republish(message.topic)
+        started = time.perf_counter()
+        message.info = self.client.publish(message.topic, message.data, qos=message.qos)
+        observe_publish(message.topic, started)
+        message.attempts += 1
+        message.sent_at = time.monotonic()
+        self.published += 1
+        self._in_flight.append(message)
+
+    def _wait_queue(self):
+        # Sin mensajes en vuelo se espera el próximo en la cola
+        try:
+            message = self._queue.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            return
+        self._send(message)
+
+    def _wait_oldest(self):
+        info = self._in_flight[0].info
+        if info.rc != MQTT_ERR_SUCCESS:
+            return
+        try:
+            info.wait_for_publish(timeout=POLL_INTERVAL)
+        except (RuntimeError, ValueError):
+            pass
+
+    def _sweep(self):
+        now = time.monotonic()
+        pending = deque()
+        for message in self._in_flight:
+            published = _published(message.info) if message.info.rc == MQTT_ERR_SUCCESS else None
+            if published:
+                self.acked += 1
+                observe_ack(message.topic, now - message.sent_at)
+            elif published is None or now - message.sent_at > self.ack_timeout:
+                self._give_up_or_retry(message, now)
+            else:
+                pending.append(message)
+        self._in_flight = pending
+
+    def _give_up_or_retry(self, message, now):
+        if message.attempts > self.retries:
+            self.failed += 1
+            log.error("Mensaje a %s sin confirmar después de %s intentos", message.topic, message.attempts)
+            return
+        self._retry.append((now + self.retry_delay, message))
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "in_flight": len(self._in_flight),
+            "retrying": len(self._retry),
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "published": self.published,
+            "acked": self.acked,
+            "republished": self.republished,
+            "failed": self.failed,
+        }
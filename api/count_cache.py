@@ -0,0 +1,92 @@
+"""Cache de totales para los endpoints de listado.
+
+Guarda el resultado de ``count_documents`` por colección y consulta
+normalizada durante un TTL corto. Cada colección tiene un contador de versión
+en el documento ``collection_versions/stocks_db`` que la API y los brokers
+incrementan cuando escriben; si la versión cambia, los totales cacheados de
+esa colección dejan de ser válidos aunque no haya vencido el TTL.
+
+Trabaja sobre colecciones del cliente asíncrono; como todo corre en el event
+loop no necesita locks.
+"""
+import os
+import time
+from collections import OrderedDict
+
+from bson import json_util
+
+COUNT_CACHE_TTL = float(os.getenv("COUNT_CACHE_TTL_SECONDS", "10"))
+# Cada cuánto se leen las versiones desde MongoDB
+VERSION_REFRESH_INTERVAL = float(os.getenv("COUNT_VERSION_REFRESH_SECONDS", "1"))
+COUNT_CACHE_MAX_ENTRIES = int(os.getenv("COUNT_CACHE_MAX_ENTRIES", "1024"))
+# Límite para el conteo aproximado cuando hay filtros
+ESTIMATED_COUNT_CAP = int(os.getenv("ESTIMATED_COUNT_CAP", "10000"))
+
+VERSIONS_COLLECTION = "collection_versions"
+VERSIONS_DOC_ID = "stocks_db"
+
+
+def normalize_query(query):
+    """Representación estable de una consulta para usarla como llave."""
+    return json_util.dumps(query, sort_keys=True)
+
+
+class CountCache:
+    def __init__(self, db, ttl=COUNT_CACHE_TTL, version_refresh=VERSION_REFRESH_INTERVAL,
+                 max_entries=COUNT_CACHE_MAX_ENTRIES):
+        self._versions_collection = db[VERSIONS_COLLECTION]
+        self.ttl = ttl
+        self.version_refresh = version_refresh
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._versions_read_at = None
+        self.hits = 0
+        self.misses = 0
+
+    async def _current_versions(self):
+        now = time.monotonic()
+        if self._versions_read_at is None or now - self._versions_read_at >= self.version_refresh:
+            doc = await self._versions_collection.find_one({"_id": VERSIONS_DOC_ID}) or {}
+            doc.pop("_id", None)
+            self._versions = doc
+            self._versions_read_at = now
+        return self._versions
+
+    async def count(self, collection, query, estimated=False):
+        """Total de documentos de ``collection`` que cumplen ``query``.
+
+        Con ``estimated=True`` usa ``estimated_document_count`` si no hay
+        filtros, o un conteo con tope ``ESTIMATED_COUNT_CAP`` si los hay.
+        """
+        key = (collection.name, normalize_query(query), estimated)
+        version = (await self._current_versions()).get(collection.name, 0)
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] == version and time.monotonic() - entry[2] < self.ttl:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+
+        if estimated and not query:
+            value = await collection.estimated_document_count()
+        elif estimated:
+            value = await collection.count_documents(query, limit=ESTIMATED_COUNT_CAP)
+        else:
+            value = await collection.count_documents(query)
+
+        self._entries[key] = (value, version, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return value
+
+    async def bump(self, *collection_names):
+        """Incrementa la versión de las colecciones después de escribir en ellas."""
+        await self._versions_collection.update_one(
+            {"_id": VERSIONS_DOC_ID},
+            {"$inc": {name: 1 for name in collection_names}},
+            upsert=True
+        )
+        # Forzar la relectura de versiones en el próximo conteo
+        self._versions_read_at = None
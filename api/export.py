@@ -0,0 +1,196 @@
+"""Exportación masiva de colecciones como NDJSON o CSV.
+
+Las filas se leen con un cursor del servidor y se escriben en bloques hacia
+un ``StreamingResponse``, por lo que la memoria no depende de cuántas filas
+se exporten. Un rango de fechas grande (con ``from_date`` y ``to_date``) se
+puede dividir en sub-rangos que se recorren en paralelo; cada sub-rango llena una cola acotada y las colas se
+vacían en orden, así la salida queda ordenada por ``timestamp``.
+"""
+import asyncio
+import csv
+import io
+import json
+import os
+import zlib
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING
+
+EXPORT_FORMATS = ("ndjson", "csv")
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+# Bytes acumulados antes de enviar un bloque al cliente
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", "65536"))
+# Lotes que cada sub-rango puede tener leídos antes de que se consuman
+EXPORT_QUEUE_BATCHES = int(os.getenv("EXPORT_QUEUE_BATCHES", "4"))
+EXPORT_MAX_PARALLEL = int(os.getenv("EXPORT_MAX_PARALLEL", "8"))
+
+CHRONOLOGICAL = [("timestamp", ASCENDING), ("_id", ASCENDING)]
+
+EVENT_LOG_COLUMNS = ["type", "symbol", "quantity", "price", "longName", "timestamp"]
+TRANSACTION_COLUMNS = [
+    "request_id", "transaction_id", "symbol", "quantity", "user_email",
+    "status", "owner_type", "estimated_gain", "timestamp",
+]
+
+# Marca de fin de un sub-rango en su cola
+_DONE = object()
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    return str(value)
+
+
+def _csv_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=_json_default)
+    return value
+
+
+def split_range(start, end, parts):
+    """Divide ``[start, end]`` en ``parts`` sub-rangos contiguos.
+
+    Cada sub-rango es ``(desde, hasta, incluye_hasta)``; solo el último
+    incluye su límite superior para que ninguna fila quede en dos rangos.
+    """
+    if parts <= 1 or end <= start:
+        return [(start, end, True)]
+    step = (end - start) / parts
+    bounds = [start + step * i for i in range(parts)] + [end]
+    return [(bounds[i], bounds[i + 1], i == parts - 1) for i in range(parts)]
+
+
+def _range_query(query, lower, upper, inclusive):
+    timestamp = dict(query.get("timestamp", {}))
+    timestamp["$gte"] = lower
+    timestamp.pop("$lte", None)
+    timestamp.pop("$lt", None)
+    timestamp["$lte" if inclusive else "$lt"] = upper
+    return {**query, "timestamp": timestamp}
+
+
+def plan_queries(query, parallel):
+    """Consultas a recorrer en paralelo para exportar ``query``.
+
+    Solo se divide si ``query`` trae ambos límites de fecha: esa consulta ya
+    deja fuera las filas con ``timestamp`` nulo o que no es fecha, así que los
+    sub-rangos cubren lo mismo. Sin ellos se recorre en un solo cursor, que
+    sí incluye esas filas.
+    """
+    if parallel <= 1:
+        return [query]
+    timestamp = query.get("timestamp", {})
+    lower, upper = timestamp.get("$gte"), timestamp.get("$lte")
+    if not isinstance(lower, datetime) or not isinstance(upper, datetime):
+        return [query]
+    return [_range_query(query, *sub_range) for sub_range in split_range(lower, upper, parallel)]
+
+
+async def _scan(collection, query, projection, queue):
+    batch = []
+    try:
+        cursor = collection.find(query, projection, batch_size=EXPORT_BATCH_SIZE).sort(CHRONOLOGICAL)
+        async for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                await queue.put(batch)
+                batch = []
+        if batch:
+            await queue.put(batch)
+        await queue.put(_DONE)
+    except Exception as e:
+        # El consumidor re-lanza el error para cortar la respuesta
+        await queue.put(e)
+
+
+async def iter_documents(collection, queries, projection):
+    """Recorre ``queries`` en paralelo y entrega los documentos en orden."""
+    queues = [asyncio.Queue(maxsize=EXPORT_QUEUE_BATCHES) for _ in queries]
+    tasks = [asyncio.create_task(_scan(collection, query, projection, queue))
+             for query, queue in zip(queries, queues)]
+    try:
+        for queue in queues:
+            while True:
+                item = await queue.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                for doc in item:
+                    yield doc
+    finally:
+        # Si el cliente se desconecta se cancelan los sub-rangos pendientes
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class _Encoder:
+    """Codifica filas en NDJSON o CSV y opcionalmente las comprime con gzip."""
+
+    def __init__(self, fmt, columns, gzip=False):
+        self.fmt = fmt
+        self.columns = columns
+        self._compressor = zlib.compressobj(wbits=31) if gzip else None
+        self._buffer = io.StringIO()
+        self._csv = csv.DictWriter(self._buffer, fieldnames=columns, extrasaction="ignore") if fmt == "csv" else None
+
+    def header(self):
+        if self._csv is not None:
+            self._csv.writeheader()
+
+    def write(self, doc):
+        if self._csv is not None:
+            self._csv.writerow({column: _csv_value(doc.get(column)) for column in self.columns})
+        else:
+            self._buffer.write(json.dumps(doc, default=_json_default))
+            self._buffer.write("\n")
+
+    def pending(self):
+        return self._buffer.tell()
+
+    def flush(self):
+        data = self._buffer.getvalue().encode("utf-8")
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        return data
+
+    def finish(self):
+        data = self.flush()
+        if self._compressor is not None:
+            data += self._compressor.flush()
+        return data
+
+
+async def stream_export(collection, queries, columns, fmt="ndjson", gzip=False):
+    """Genera los bytes de la exportación en bloques de ~``EXPORT_CHUNK_BYTES``."""
+    projection = {column: 1 for column in columns}
+    projection["_id"] = 0
+    encoder = _Encoder(fmt, columns, gzip)
+    encoder.header()
+    async for doc in iter_documents(collection, queries, projection):
+        encoder.write(doc)
+        if encoder.pending() >= EXPORT_CHUNK_BYTES:
+            chunk = encoder.flush()
+            if chunk:
+                yield chunk
+    chunk = encoder.finish()
+    if chunk:
+        yield chunk
+
+
+def export_headers(name, fmt, gzip=False):
+    headers = {"Content-Disposition": f'attachment; filename="{name}.{fmt}"'}
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    return headers
@@ -0,0 +1,258 @@
+"""Índices de MongoDB usados por la API y los brokers.
+
+Declara los índices que necesitan las consultas de la API, de
+``broker_updates`` y de ``broker_requests`` (todos comparten ``stocks_db``),
+los reconcilia de forma idempotente al iniciar la API y permite auditar con
+``explain()`` que ninguna consulta registrada termine en un COLLSCAN.
+
+Uso desde la línea de comandos::
+
+    python indexes.py ensure
+    python indexes.py audit
+"""
+import sys
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from database import get_db
+
+# Índices declarados por colección. El nombre es explícito para poder
+# reconciliar: si cambia la definición de un índice con el mismo nombre,
+# se elimina y se vuelve a crear.
+INDEXES = {
+    "current_stocks": [
+        IndexModel([("symbol", ASCENDING)], name="symbol"),
+    ],
+    "admin_transactions": [
+        IndexModel([("symbol", ASCENDING)], name="symbol"),
+    ],
+    "event_log": [
+        IndexModel([("symbol", ASCENDING), ("timestamp", DESCENDING)], name="symbol_timestamp"),
+        IndexModel([("timestamp", DESCENDING)], name="timestamp"),
+        # Único: broker_updates descarta los updates repetidos por su llave
+        IndexModel([("key", ASCENDING)], name="key", unique=True,
+                   partialFilterExpression={"key": {"$type": "string"}}),
+    ],
+    "requests": [
+        # Único: broker_requests descarta las solicitudes repetidas
+        IndexModel([("request_id", ASCENDING)], name="request_id", unique=True),
+    ],
+    "transactions": [
+        IndexModel([("request_id", ASCENDING)], name="request_id"),
+        IndexModel(
+            [("user_email", ASCENDING), ("status", ASCENDING), ("timestamp", DESCENDING)],
+            name="user_email_status_timestamp",
+        ),
+        IndexModel([("user_email", ASCENDING), ("timestamp", DESCENDING)], name="user_email_timestamp"),
+        IndexModel([("timestamp", DESCENDING)], name="timestamp"),
+    ],
+    "estimations": [
+        IndexModel([("transaction_id", ASCENDING)], name="transaction_id"),
+    ],
+    "estimation_jobs": [
+        IndexModel([("request_id", ASCENDING)], name="request_id", unique=True),
+        IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="status_next_attempt_at"),
+        IndexModel([("status", ASCENDING), ("lease_until", ASCENDING)], name="status_lease_until"),
+    ],
+    "auction_offers": [
+        IndexModel([("auction_id", ASCENDING)], name="auction_id", unique=True),
+        IndexModel([("group_id", ASCENDING), ("status", ASCENDING)], name="group_id_status"),
+    ],
+    "users": [
+        IndexModel([("correo", ASCENDING)], name="correo"),
+    ],
+    "wallet_ledger": [
+        IndexModel([("request_id", ASCENDING)], name="request_id", unique=True),
+        IndexModel([("correo", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)],
+                   name="correo_timestamp"),
+    ],
+    "candles": [
+        IndexModel(
+            [("symbol", ASCENDING), ("interval", ASCENDING), ("start", ASCENDING)],
+            name="symbol_interval_start",
+            unique=True,
+        ),
+    ],
+}
+
+# Formas de consulta que se ejecutan en caliente (handlers de la API y
+# on_message de los brokers). Cada una se audita con explain().
+QUERY_SHAPES = [
+    {"name": "stock_by_symbol", "collection": "current_stocks", "filter": {"symbol": "AAPL"}},
+    {"name": "admin_stock_by_symbol", "collection": "admin_transactions", "filter": {"symbol": "AAPL"}},
+    {"name": "event_log_by_symbol", "collection": "event_log", "filter": {"symbol": "AAPL"},
+     "sort": [("timestamp", DESCENDING)]},
+    {"name": "event_log_by_date", "collection": "event_log",
+     "filter": {"timestamp": {"$gte": datetime(2024, 1, 1), "$lte": datetime(2024, 12, 31)}}},
+    {"name": "request_by_id", "collection": "requests", "filter": {"request_id": "x"}},
+    {"name": "transaction_by_id", "collection": "transactions", "filter": {"request_id": "x"}},
+    {"name": "transaction_by_user_request", "collection": "transactions",
+     "filter": {"request_id": "x", "user_email": "x"}},
+    {"name": "transactions_by_user", "collection": "transactions", "filter": {"user_email": "x"},
+     "sort": [("timestamp", DESCENDING)]},
+    {"name": "transactions_ok_by_user", "collection": "transactions",
+     "filter": {"user_email": "x", "status": "OK"}, "sort": [("timestamp", DESCENDING)]},
+    {"name": "transactions_export_by_date", "collection": "transactions",
+     "filter": {"timestamp": {"$gte": datetime(2024, 1, 1), "$lt": datetime(2024, 7, 1)}},
+     "sort": [("timestamp", ASCENDING), ("_id", ASCENDING)]},
+    {"name": "estimation_by_transaction", "collection": "estimations", "filter": {"transaction_id": "x"}},
+    {"name": "estimation_jobs_ready", "collection": "estimation_jobs",
+     "filter": {"status": "pending", "next_attempt_at": {"$lte": datetime(2024, 1, 1)}},
+     "sort": [("next_attempt_at", ASCENDING)]},
+    {"name": "auction_by_id", "collection": "auction_offers", "filter": {"auction_id": "x"}},
+    {"name": "auction_offers_by_group", "collection": "auction_offers",
+     "filter": {"group_id": "27", "status": "OFFERED"}},
+    {"name": "user_by_email", "collection": "users", "filter": {"correo": "x"}},
+    {"name": "wallet_history_by_user", "collection": "wallet_ledger", "filter": {"correo": "x"},
+     "sort": [("timestamp", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "candles_by_symbol", "collection": "candles",
+     "filter": {"symbol": "AAPL", "interval": "1m", "start": {"$gte": datetime(2024, 1, 1)}},
+     "sort": [("start", ASCENDING)]},
+]
+
+
+def _same_definition(existing, model):
+    """Compara la definición de un índice existente con la declarada."""
+    spec = model.document
+    existing_key = [(field, int(direction)) for field, direction in existing["key"]]
+    if existing_key != list(spec["key"].items()):
+        return False
+    for option in ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression"):
+        if existing.get(option) != spec.get(option):
+            return False
+    return True
+
+
+def _duplicate_key(collection, model):
+    """Retorna un valor repetido de las llaves del índice, o None."""
+    fields = list(model.document["key"])
+    group = {"_id": {field.replace(".", "_"): f"${field}" for field in fields}, "n": {"$sum": 1}}
+    duplicate = next(collection.aggregate(
+        [{"$group": group}, {"$match": {"n": {"$gt": 1}}}, {"$limit": 1}], allowDiskUse=True), None)
+    return duplicate["_id"] if duplicate else None
+
+
+def _existing_model(name, info):
+    options = {key: value for key, value in info.items() if key not in ("key", "v", "ns")}
+    return IndexModel(info["key"], **{**options, "name": name})
+
+
+def _rebuild(collection, name, model, existing):
+    """Reemplaza un índice; si el nuevo no se puede crear, restaura el anterior.
+
+    MongoDB no permite dos índices sobre las mismas llaves con distintas
+    opciones, así que el nuevo no se puede construir antes de eliminar el
+    anterior. Si el nuevo es único se revisa antes que no haya repetidos.
+    """
+    if model.document.get("unique"):
+        duplicate = _duplicate_key(collection, model)
+        if duplicate is not None:
+            raise ValueError(f"hay documentos repetidos para {duplicate}")
+    collection.drop_index(name)
+    try:
+        collection.create_indexes([model])
+    except OperationFailure:
+        collection.create_indexes([_existing_model(name, existing)])
+        raise
+
+
+def ensure_indexes(db, indexes=None):
+    """Crea o reconstruye los índices declarados.
+
+    Es idempotente: los índices que ya existen con la misma definición no se
+    tocan y los índices no declarados tampoco se eliminan. Retorna un resumen
+    por colección con los índices creados, reconstruidos, sin cambios y los
+    que fallaron (con el error); un índice que no se puede reconstruir queda
+    con su definición anterior y las demás colecciones se siguen revisando.
+    """
+    indexes = INDEXES if indexes is None else indexes
+    summary = {}
+    for collection_name, models in indexes.items():
+        collection = db[collection_name]
+        result = {"created": [], "rebuilt": [], "unchanged": [], "failed": {}}
+        summary[collection_name] = result
+        try:
+            existing = collection.index_information()
+        except OperationFailure as e:
+            result["failed"]["*"] = str(e)
+            continue
+        for model in models:
+            name = model.document["name"]
+            try:
+                if name not in existing:
+                    collection.create_indexes([model])
+                    result["created"].append(name)
+                elif _same_definition(existing[name], model):
+                    result["unchanged"].append(name)
+                else:
+                    _rebuild(collection, name, model, existing[name])
+                    result["rebuilt"].append(name)
+            except (OperationFailure, ValueError) as e:
+                result["failed"][name] = str(e)
+    return summary
+
+
+def _plan_stages(plan):
+    """Recorre un plan de ejecución y retorna todas sus etapas."""
+    if not isinstance(plan, dict):
+        return []
+    stages = []
+    if "stage" in plan:
+        stages.append(plan["stage"])
+    # En motores con SBE el plan viene anidado en "queryPlan"
+    for key in ("queryPlan", "inputStage"):
+        stages.extend(_plan_stages(plan.get(key)))
+    for child in plan.get("inputStages", []):
+        stages.extend(_plan_stages(child))
+    return stages
+
+
+def audit_query_plans(db, shapes=None):
+    """Ejecuta explain() sobre cada forma de consulta registrada.
+
+    Retorna una lista con las etapas del plan ganador de cada consulta y si
+    alguna de ellas es un COLLSCAN.
+    """
+    shapes = QUERY_SHAPES if shapes is None else shapes
+    report = []
+    for shape in shapes:
+        cursor = db[shape["collection"]].find(shape["filter"])
+        if shape.get("sort"):
+            cursor = cursor.sort(shape["sort"])
+        try:
+            explanation = cursor.explain()
+        except OperationFailure as e:
+            report.append({"name": shape["name"], "collection": shape["collection"], "error": str(e)})
+            continue
+        stages = _plan_stages(explanation.get("queryPlanner", {}).get("winningPlan", {}))
+        report.append({
+            "name": shape["name"],
+            "collection": shape["collection"],
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages,
+        })
+    return report
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else "audit"
+    db = get_db()
+    if command == "ensure":
+        summary = ensure_indexes(db)
+        for collection_name, result in summary.items():
+            print(f"[INDEXES] {collection_name}: {result}")
+        return 1 if any(result["failed"] for result in summary.values()) else 0
+    if command == "audit":
+        report = audit_query_plans(db)
+        for entry in report:
+            status = "ERROR" if "error" in entry else ("COLLSCAN" if entry["collscan"] else "OK")
+            print(f"[INDEXES] {status:8} {entry['collection']}.{entry['name']} {entry.get('stages', entry.get('error'))}")
+        return 1 if any(entry.get("collscan") for entry in report) else 0
+    print(f"Uso: python {argv[0]} [ensure|audit]")
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
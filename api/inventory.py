@@ -0,0 +1,139 @@
+"""Snapshot en memoria del inventario del administrador.
+
+Mantiene ``symbol -> {quantity, price}`` de la colección
+``admin_transactions`` cargado una sola vez al iniciar y actualizado con un
+change stream de MongoDB, para que ``GET /stocks`` no vuelva a recorrer la
+colección en cada request. Si el servidor no soporta change streams (por
+ejemplo un mongod standalone) se recarga periódicamente.
+"""
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from logs import get_logger
+
+log = get_logger("inventory")
+
+POLL_INTERVAL = float(os.getenv("INVENTORY_POLL_SECONDS", "5"))
+RETRY_INTERVAL = 5
+
+# Código que entrega MongoDB cuando no hay change streams (no es replica set)
+CHANGE_STREAM_UNSUPPORTED = 40573
+
+
+class InventorySnapshot:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # Copy-on-write: cada cambio reemplaza el dict, las lecturas no bloquean
+        self._items = {}
+        self._symbols_by_id = {}
+        self.version = 0
+        self.loaded = False
+        self.mode = "idle"
+        self.synced_at = None
+
+    def load(self, collection):
+        """Carga el inventario completo desde la colección."""
+        items = {}
+        symbols_by_id = {}
+        for doc in collection.find({}, {"symbol": 1, "quantity": 1, "price": 1}):
+            items[doc["symbol"]] = {"quantity": doc.get("quantity", 0), "price": doc.get("price")}
+            symbols_by_id[doc["_id"]] = doc["symbol"]
+        with self._lock:
+            self._items = items
+            self._symbols_by_id = symbols_by_id
+            self.version += 1
+            self.loaded = True
+            self.synced_at = time.monotonic()
+
+    def apply_change(self, change):
+        """Aplica un evento del change stream al snapshot."""
+        operation = change.get("operationType")
+        doc_id = change.get("documentKey", {}).get("_id")
+        document = change.get("fullDocument")
+        with self._lock:
+            items = dict(self._items)
+            if operation == "delete" or (operation in ("update", "replace") and document is None):
+                symbol = self._symbols_by_id.pop(doc_id, None)
+                items.pop(symbol, None)
+            elif operation in ("insert", "update", "replace"):
+                items[document["symbol"]] = {"quantity": document.get("quantity", 0), "price": document.get("price")}
+                self._symbols_by_id[doc_id] = document["symbol"]
+            else:
+                return
+            self._items = items
+            self.version += 1
+            self.synced_at = time.monotonic()
+
+    def quantities(self):
+        """Retorna ``symbol -> quantity`` del snapshot actual."""
+        return {symbol: item["quantity"] for symbol, item in self._items.items()}
+
+    def get(self, symbol):
+        return self._items.get(symbol)
+
+    def stats(self):
+        age = time.monotonic() - self.synced_at if self.synced_at is not None else None
+        return {
+            "version": self.version,
+            "size": len(self._items),
+            "age_seconds": round(age, 3) if age is not None else None,
+            "mode": self.mode,
+            "loaded": self.loaded,
+            "checked_at": datetime.now(timezone.utc).isoformat(),
+        }
+
+    def start(self, collection):
+        """Carga el snapshot y lo mantiene al día en un hilo de fondo."""
+        self.load(collection)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(collection,), name="inventory-snapshot", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=POLL_INTERVAL + 1)
+            self._thread = None
+
+    def _run(self, collection):
+        resume_token = None
+        while not self._stop.is_set():
+            try:
+                with collection.watch(full_document="updateLookup", resume_after=resume_token) as stream:
+                    self.mode = "change_stream"
+                    if resume_token is None:
+                        # Recargar con el stream ya abierto para no perder cambios
+                        self.load(collection)
+                    while not self._stop.is_set():
+                        change = stream.try_next()
+                        if change is not None:
+                            self.apply_change(change)
+                        else:
+                            # El stream sigue vivo: el snapshot está al día
+                            self.synced_at = time.monotonic()
+                        resume_token = stream.resume_token
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_UNSUPPORTED:
+                    log.info("Change streams no soportados, recargando cada %ss", POLL_INTERVAL)
+                    self._poll(collection)
+                    return
+                log.warning("Change stream interrumpido: %s", e)
+                resume_token = None
+                self._stop.wait(RETRY_INTERVAL)
+            except PyMongoError as e:
+                log.error("Error en el change stream: %s", e)
+                self._stop.wait(RETRY_INTERVAL)
+
+    def _poll(self, collection):
+        self.mode = "polling"
+        while not self._stop.wait(POLL_INTERVAL):
+            try:
+                self.load(collection)
+            except PyMongoError as e:
+                log.error("Error recargando el inventario: %s", e)
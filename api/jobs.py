@@ -0,0 +1,257 @@
+"""Outbox de las estimaciones que se envían al JobMaster.
+
+Los handlers no llaman al JobMaster: escriben el trabajo en
+``estimation_jobs`` (``JobOutbox.enqueue``) junto con la transacción y
+responden. ``JobDispatcher`` corre en un hilo de fondo y vacía el outbox en
+lotes:
+
+1. Reclama hasta ``JOBMASTER_BATCH_SIZE`` trabajos pendientes (o con el
+   lease vencido) marcándolos con un id de reclamo, así varios procesos de
+   la API no envían el mismo trabajo.
+2. Los envía en paralelo con una ``requests.Session`` compartida
+   (conexiones keep-alive) y timeout.
+3. Guarda todos los resultados con un solo ``bulk_write``: enviado con su
+   ``job_id``, pendiente con backoff exponencial, o ``dead`` después de
+   ``JOBMASTER_MAX_ATTEMPTS`` intentos.
+
+``request_id`` es único en el outbox, así que un ``commit_transaction``
+reintentado no encola la estimación dos veces. Los trabajos ``dead`` quedan
+en la colección y se reintentan volviendo su ``status`` a ``pending``.
+"""
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from requests.adapters import HTTPAdapter
+
+from logs import get_logger
+from metrics import track_outbound
+
+log = get_logger("jobmaster")
+
+JOBMASTER_URL = os.getenv("JOBMASTER_URL", "https://iic2175danielaarp.me")
+JOBMASTER_TIMEOUT = float(os.getenv("JOBMASTER_TIMEOUT_SECONDS", "5"))
+JOBMASTER_BATCH_SIZE = int(os.getenv("JOBMASTER_BATCH_SIZE", "50"))
+JOBMASTER_CONCURRENCY = int(os.getenv("JOBMASTER_CONCURRENCY", "4"))
+JOBMASTER_MAX_ATTEMPTS = int(os.getenv("JOBMASTER_MAX_ATTEMPTS", "8"))
+JOBMASTER_POLL_SECONDS = float(os.getenv("JOBMASTER_POLL_SECONDS", "1"))
+# Backoff: BASE * 2^(intento - 1), hasta MAX, con jitter
+BACKOFF_BASE_SECONDS = 2.0
+BACKOFF_MAX_SECONDS = 300.0
+# Holgura del lease sobre el peor caso de un lote (lecturas y bulk_write)
+LEASE_MARGIN_SECONDS = 30
+
+OUTBOX_COLLECTION = "estimation_jobs"
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+DEAD = "dead"
+
+
+def estimation_job(user_id, symbol, quantity, price, request_id, now=None):
+    now = now or datetime.utcnow()
+    return {
+        "request_id": request_id,
+        "payload": {
+            "user_id": user_id,
+            "stock_symbol": symbol,
+            "quantity": quantity,
+            "price": price,
+            "request_id": request_id,
+        },
+        "status": PENDING,
+        "attempts": 0,
+        "next_attempt_at": now,
+        "created_at": now,
+    }
+
+
+def backoff_seconds(attempts, rng=random):
+    delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** max(0, attempts - 1))
+    return delay * rng.uniform(0.8, 1.2)
+
+
+def lease_seconds(batch_size, concurrency, timeout):
+    """Tiempo que un trabajo reclamado queda reservado para el proceso que lo envía.
+
+    Un lote se envía en ``ceil(batch_size / concurrency)`` tandas y cada envío
+    puede tardar hasta ``timeout`` en conectar y otro tanto en leer; el lease
+    tiene que cubrir el lote completo o otro proceso lo reclamaría a medias.
+    """
+    return math.ceil(batch_size / concurrency) * 2 * timeout + LEASE_MARGIN_SECONDS
+
+
+def result_operation(job, job_id=None, error=None, now=None, max_attempts=JOBMASTER_MAX_ATTEMPTS):
+    """Actualización del trabajo según el resultado del envío."""
+    now = now or datetime.utcnow()
+    query = {"_id": job["_id"], "claim": job.get("claim")}
+    attempts = job.get("attempts", 0) + 1
+    if error is None:
+        return UpdateOne(query, {"$set": {"status": SENT, "job_id": job_id, "sent_at": now, "attempts": attempts},
+                                 "$unset": {"claim": "", "lease_until": ""}})
+    fields = {"last_error": str(error)[:500], "attempts": attempts}
+    if attempts >= max_attempts:
+        fields.update(status=DEAD, dead_at=now)
+    else:
+        fields.update(status=PENDING, next_attempt_at=now + timedelta(seconds=backoff_seconds(attempts)))
+    return UpdateOne(query, {"$set": fields, "$unset": {"claim": "", "lease_until": ""}})
+
+
+class JobMasterClient:
+    """Cliente HTTP del JobMaster con un pool de conexiones keep-alive."""
+
+    def __init__(self, url=JOBMASTER_URL, timeout=JOBMASTER_TIMEOUT, pool_size=JOBMASTER_CONCURRENCY):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def submit(self, payload):
+        """Envía una estimación; retorna el ``job_id`` o lanza una excepción."""
+        with track_outbound("jobmaster"):
+            response = self.session.post(f"{self.url}/job", json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()["job_id"]
+
+    def close(self):
+        self.session.close()
+
+
+class JobOutbox:
+    """Lado de escritura del outbox, para los handlers (cliente asíncrono)."""
+
+    def __init__(self, db, dispatcher=None):
+        self.jobs = db[OUTBOX_COLLECTION]
+        self.dispatcher = dispatcher
+
+    async def enqueue(self, user_id, symbol, quantity, price, request_id):
+        """Encola la estimación; retorna False si ya estaba encolada."""
+        try:
+            result = await self.jobs.update_one(
+                {"request_id": request_id},
+                {"$setOnInsert": estimation_job(user_id, symbol, quantity, price, request_id)},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False
+        if result.upserted_id is None:
+            return False
+        if self.dispatcher is not None:
+            self.dispatcher.wake()
+        return True
+
+
+class JobDispatcher:
+    def __init__(self, client=None, batch_size=JOBMASTER_BATCH_SIZE, concurrency=JOBMASTER_CONCURRENCY,
+                 poll_interval=JOBMASTER_POLL_SECONDS, max_attempts=JOBMASTER_MAX_ATTEMPTS):
+        self.client = client or JobMasterClient()
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self.lease_seconds = lease_seconds(self.batch_size, self.concurrency,
+                                           getattr(self.client, "timeout", JOBMASTER_TIMEOUT))
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.batches = 0
+        self.sent = 0
+        self.failed_attempts = 0
+        self.dead = 0
+        self.last_batch_seconds = 0.0
+
+    def start(self, collection):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(collection,), name="jobmaster-outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=JOBMASTER_TIMEOUT + 1)
+            self._thread = None
+        self.client.close()
+
+    def wake(self):
+        """Despierta al hilo cuando hay un trabajo nuevo."""
+        self._wake.set()
+
+    def _run(self, collection):
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="jobmaster") as pool:
+            while not self._stop.is_set():
+                try:
+                    if self.drain(collection, pool) == self.batch_size:
+                        # Lote lleno: puede haber más pendientes
+                        continue
+                except PyMongoError as e:
+                    log.error("Error leyendo el outbox: %s", e)
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def claim(self, collection, now=None):
+        """Reserva un lote de trabajos; retorna los documentos reclamados."""
+        now = now or datetime.utcnow()
+        ready = {"$or": [
+            {"status": PENDING, "next_attempt_at": {"$lte": now}},
+            {"status": SENDING, "lease_until": {"$lte": now}},
+        ]}
+        ids = [doc["_id"] for doc in collection.find(ready, {"_id": 1}).sort("next_attempt_at", 1)
+               .limit(self.batch_size)]
+        if not ids:
+            return []
+        claim = uuid.uuid4().hex
+        collection.update_many({"$and": [{"_id": {"$in": ids}}, ready]}, {"$set": {
+            "status": SENDING, "claim": claim, "lease_until": now + timedelta(seconds=self.lease_seconds),
+        }})
+        return list(collection.find({"_id": {"$in": ids}, "claim": claim}))
+
+    def _send(self, job):
+        try:
+            return job, self.client.submit(job["payload"]), None
+        except (requests.RequestException, KeyError, ValueError) as e:
+            return job, None, e
+
+    def drain(self, collection, pool):
+        """Envía un lote; retorna cuántos trabajos se reclamaron."""
+        jobs = self.claim(collection)
+        if not jobs:
+            return 0
+        started = time.perf_counter()
+        now = datetime.utcnow()
+        operations = []
+        for job, job_id, error in pool.map(self._send, jobs):
+            operations.append(result_operation(job, job_id, error, now, self.max_attempts))
+            if error is None:
+                self.sent += 1
+                log.info("Estimación enviada, job_id: %s", job_id)
+            elif job.get("attempts", 0) + 1 >= self.max_attempts:
+                self.dead += 1
+                log.error("Estimación %s descartada después de %s intentos: %s",
+                          job["request_id"], job.get("attempts", 0) + 1, error)
+            else:
+                self.failed_attempts += 1
+                log.warning("Error al enviar estimación %s: %s", job["request_id"], error)
+        collection.bulk_write(operations, ordered=False)
+        self.batches += 1
+        self.last_batch_seconds = time.perf_counter() - started
+        return len(jobs)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "sent": self.sent,
+            "failed_attempts": self.failed_attempts,
+            "dead": self.dead,
+            "last_batch_seconds": self.last_batch_seconds,
+        }
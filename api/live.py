@@ -0,0 +1,219 @@
+"""Push de precios y estados de transacciones por Server-Sent Events.
+
+Un hilo por colección (``current_stocks`` y ``transactions``) sigue un
+change stream de MongoDB y entrega cada cambio al event loop, donde un
+``Broadcaster`` lo reparte a los suscriptores que lo filtran por llave
+(símbolo o ``request_id``). Cada suscriptor guarda solo el último cambio por
+llave hasta que su conexión lo envía, así una ráfaga de actualizaciones del
+mismo símbolo se envía como un solo evento. Un suscriptor inactivo es un
+``asyncio.Event`` y un dict, por lo que un proceso puede mantener miles.
+
+Si el servidor no soporta change streams se consulta periódicamente por
+``timestamp``.
+"""
+import asyncio
+import json
+import os
+import threading
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
+
+from inventory import CHANGE_STREAM_UNSUPPORTED, RETRY_INTERVAL
+from logs import get_logger
+
+log = get_logger("stream")
+
+# Ventana en que se juntan los cambios antes de enviarlos
+COALESCE_WINDOW = float(os.getenv("STREAM_COALESCE_SECONDS", "0.25"))
+# Comentario SSE para mantener viva la conexión a través de proxies
+HEARTBEAT_INTERVAL = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
+POLL_INTERVAL = float(os.getenv("STREAM_POLL_SECONDS", "2"))
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    return str(value)
+
+
+def price_delta(doc):
+    return {
+        "symbol": doc.get("symbol"),
+        "price": doc.get("price"),
+        "quantity": doc.get("quantity"),
+        "timestamp": doc.get("timestamp"),
+    }
+
+
+def transaction_delta(doc):
+    return {
+        "request_id": doc.get("request_id"),
+        "symbol": doc.get("symbol"),
+        "quantity": doc.get("quantity"),
+        "status": doc.get("status"),
+        "timestamp": doc.get("timestamp"),
+    }
+
+
+class Subscriber:
+    __slots__ = ("keys", "owner", "pending", "wakeup")
+
+    def __init__(self, keys=None, owner=None):
+        # None = todas las llaves
+        self.keys = keys
+        # Solo recibe cambios de este dueño (usuario de la transacción)
+        self.owner = owner
+        self.pending = {}
+        self.wakeup = asyncio.Event()
+
+
+class Broadcaster:
+    """Reparte cambios a los suscriptores; se usa solo desde el event loop."""
+
+    def __init__(self, event):
+        self.event = event
+        self._by_key = {}
+        self._by_owner = {}
+        self._all = set()
+        self.published = 0
+
+    def subscribe(self, keys=None, owner=None):
+        subscriber = Subscriber(set(keys) if keys else None, owner)
+        if subscriber.keys:
+            for key in subscriber.keys:
+                self._by_key.setdefault(key, set()).add(subscriber)
+        elif owner is not None:
+            self._by_owner.setdefault(owner, set()).add(subscriber)
+        else:
+            self._all.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        for key in subscriber.keys or ():
+            group = self._by_key.get(key, set())
+            group.discard(subscriber)
+            if not group:
+                self._by_key.pop(key, None)
+        if not subscriber.keys and subscriber.owner is not None:
+            owners = self._by_owner.get(subscriber.owner, set())
+            owners.discard(subscriber)
+            if not owners:
+                self._by_owner.pop(subscriber.owner, None)
+        self._all.discard(subscriber)
+
+    def publish(self, key, delta, owner=None):
+        self.published += 1
+        targets = self._all | self._by_key.get(key, set())
+        if owner is not None:
+            targets |= self._by_owner.get(owner, set())
+        for subscriber in targets:
+            if subscriber.owner is not None and subscriber.owner != owner:
+                continue
+            # Coalescing: se reemplaza el cambio anterior de la misma llave
+            subscriber.pending[key] = delta
+            subscriber.wakeup.set()
+
+    def subscriber_count(self):
+        subscribers = set(self._all)
+        for group in (*self._by_key.values(), *self._by_owner.values()):
+            subscribers |= group
+        return len(subscribers)
+
+    async def stream(self, subscriber):
+        """Genera los eventos SSE de un suscriptor hasta que se desconecte."""
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    await asyncio.wait_for(subscriber.wakeup.wait(), HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                await asyncio.sleep(COALESCE_WINDOW)
+                subscriber.wakeup.clear()
+                pending, subscriber.pending = subscriber.pending, {}
+                for delta in pending.values():
+                    yield f"event: {self.event}\ndata: {json.dumps(delta, default=_json_default)}\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+
+class ChangeFeed:
+    """Sigue los cambios de una colección en un hilo y los publica en el loop."""
+
+    def __init__(self, name, broadcaster, key_field, to_delta, owner_field=None):
+        self.name = name
+        self.broadcaster = broadcaster
+        self.key_field = key_field
+        self.to_delta = to_delta
+        self.owner_field = owner_field
+        self.mode = "idle"
+        self._stop = threading.Event()
+        self._thread = None
+        self._loop = None
+
+    def start(self, collection, loop):
+        self._loop = loop
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(collection,), name=f"{self.name}-feed", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=POLL_INTERVAL + 1)
+            self._thread = None
+
+    def _emit(self, doc):
+        key = doc.get(self.key_field)
+        if key is None:
+            return
+        owner = doc.get(self.owner_field) if self.owner_field else None
+        self._loop.call_soon_threadsafe(self.broadcaster.publish, key, self.to_delta(doc), owner)
+
+    def _run(self, collection):
+        resume_token = None
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}}]
+        while not self._stop.is_set():
+            try:
+                with collection.watch(pipeline, full_document="updateLookup", resume_after=resume_token) as stream:
+                    self.mode = "change_stream"
+                    while not self._stop.is_set():
+                        change = stream.try_next()
+                        if change is not None and change.get("fullDocument"):
+                            self._emit(change["fullDocument"])
+                        resume_token = stream.resume_token
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_UNSUPPORTED:
+                    log.info("Change streams no soportados en %s, consultando cada %ss", self.name, POLL_INTERVAL)
+                    self._poll(collection)
+                    return
+                log.warning("Change stream de %s interrumpido: %s", self.name, e)
+                resume_token = None
+                self._stop.wait(RETRY_INTERVAL)
+            except PyMongoError as e:
+                log.error("Error en el change stream de %s: %s", self.name, e)
+                self._stop.wait(RETRY_INTERVAL)
+
+    def _poll(self, collection):
+        self.mode = "polling"
+        last_seen = datetime.utcnow()
+        while not self._stop.wait(POLL_INTERVAL):
+            try:
+                for doc in collection.find({"timestamp": {"$gt": last_seen}}).sort("timestamp", 1):
+                    self._emit(doc)
+                    if isinstance(doc.get("timestamp"), datetime):
+                        last_seen = max(last_seen, doc["timestamp"])
+            except PyMongoError as e:
+                log.error("Error consultando %s: %s", self.name, e)
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "subscribers": self.broadcaster.subscriber_count(),
+            "published": self.broadcaster.published,
+        }
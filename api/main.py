@@ -1,18 +1,40 @@
 from fastapi import FastAPI, Query, Depends
 from typing import Optional
 from datetime import datetime
-from database import get_db
-from buy_requests.buy_requests import mqtt_manager
+from contextlib import asynccontextmanager
+from database import get_db, get_async_db, pool_stats, IS_CI
+from repository import Repository
+from indexes import ensure_indexes, audit_query_plans
+from inventory import InventorySnapshot
+from quotes import QuoteTable
+from live import Broadcaster, ChangeFeed, price_delta, transaction_delta
+from count_cache import CountCache
+from wallet import DEPOSIT, PURCHASE, REFUND, Wallet
+from export import (
+    EVENT_LOG_COLUMNS, EXPORT_FORMATS, EXPORT_MAX_PARALLEL, MEDIA_TYPES, TRANSACTION_COLUMNS, export_headers,
+    plan_queries, stream_export,
+)
+from pagination import (
+    NEWEST_FIRST, SYMBOL_ORDER, decode_cursor, encode_cursor, keyset_filter, keyset_page, page_size, split_page,
+)
+from pymongo.errors import PyMongoError
+from buy_requests.buy_requests import mqtt_manager, TOPIC_REQUESTS, TOPIC_UPDATES
+from jobs import JOBMASTER_URL, OUTBOX_COLLECTION, JobDispatcher, JobOutbox
+from receipts import MEDIA_TYPES as RECEIPT_MEDIA_TYPES, ReceiptService, receipt_data
 from fastapi.middleware.cors import CORSMiddleware 
 #from pydantic import BaseModel
 #from datetime import datetime
-from auth import verify_token, admin_required, is_admin
+from auth import verify_token, admin_required, is_admin, jwks_registry, AUTH0_DOMAIN
 from typing import Dict
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from responses import JSONRows, ORJSONResponse, dump_cursor
+from logs import get_logger
+from metrics import MetricsMiddleware, register_stats, render_latest, track_outbound
 #from fastapi.responses import RedirectResponse
 from fastapi import Request
+from starlette.concurrency import run_in_threadpool
 import utils.transbank as tx
-import utils.purchase_receip as purchase_receip
+import asyncio
 import uuid
 import base64
 import httpx
@@ -26,9 +48,55 @@ load_dotenv()
 
 URL_FRONTEND = os.getenv("URL_FRONTEND")
 
+log = get_logger("api")
+# Consultas de los handlers, solo con LOG_LEVEL=DEBUG
+query_log = get_logger("db.query")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Reconciliar índices al iniciar (idempotente)
+    if not IS_CI:
+        try:
+            summary = await run_in_threadpool(ensure_indexes, db)
+            log.info("Índices reconciliados", extra={"fields": {"indexes": summary}})
+            for collection_name, result in summary.items():
+                for name, error in result["failed"].items():
+                    log.error("No se pudo crear el índice %s.%s: %s", collection_name, name, error)
+        except PyMongoError as e:
+            log.error("No se pudieron reconciliar los índices: %s", e)
+        try:
+            await run_in_threadpool(inventory_snapshot.start, db["admin_transactions"])
+        except PyMongoError as e:
+            log.error("No se pudo cargar el inventario: %s", e)
+        try:
+            await run_in_threadpool(quote_table.warm, db["current_stocks"])
+        except PyMongoError as e:
+            log.error("No se pudieron precargar las cotizaciones: %s", e)
+        # Cambios para /stream/prices y /stream/transactions
+        loop = asyncio.get_running_loop()
+        price_feed.start(db["current_stocks"], loop)
+        transaction_feed.start(db["transactions"], loop)
+        mqtt_manager.subscribe(TOPIC_UPDATES, quote_table.apply_update)
+        mqtt_manager.subscribe(TOPIC_REQUESTS, quote_table.apply_request)
+        if AUTH0_DOMAIN:
+            # Llaves de Auth0 precargadas y refrescadas en segundo plano
+            await run_in_threadpool(jwks_registry.start)
+        # Estimaciones pendientes hacia el JobMaster
+        job_dispatcher.start(db[OUTBOX_COLLECTION])
+    yield
+    await run_in_threadpool(job_dispatcher.stop)
+    await run_in_threadpool(receipt_service.close)
+    inventory_snapshot.stop()
+    jwks_registry.stop()
+    price_feed.stop()
+    transaction_feed.stop()
+    await run_in_threadpool(mqtt_manager.close)
+
 app = FastAPI(
     title = "API de Stocks",
     version = __version__,
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 app.add_middleware(
@@ -38,27 +106,118 @@ app.add_middleware(
     allow_methods=["*"],  # Permite todos los métodos
     allow_headers=["*"],  # Permite todos los headers
 )
+# Latencia por ruta para /metrics
+app.add_middleware(MetricsMiddleware)
 
+# Los handlers usan el cliente asíncrono; el cliente síncrono queda para las
+# tareas de fondo en hilos (índices, snapshot del inventario)
+repo = Repository(get_async_db())
 db = get_db()
-collection = db["current_stocks"]
-transactions_collection = db["transactions"]
 
-#Stocks compradas por los administradores
-admin_transactions_collection = db["admin_transactions"]
-#Ofertas de subastas
-collection_auction_offers = db["auction_offers"]
+# Inventario del administrador en memoria, alimentado por un change stream
+inventory_snapshot = InventorySnapshot()
+
+# Última cotización por símbolo, alimentada por stocks/updates
+quote_table = QuoteTable()
+
+# Suscriptores de los streams SSE
+price_feed = ChangeFeed("current_stocks", Broadcaster("price"), "symbol", price_delta)
+transaction_feed = ChangeFeed("transactions", Broadcaster("transaction"), "request_id", transaction_delta,
+                              owner_field="user_email")
+
+# Totales cacheados de los endpoints de listado
+count_cache = CountCache(repo.db)
+
+# Saldo de los usuarios con su libro de movimientos
+wallet = Wallet(repo.db)
+
+# Estimaciones del JobMaster: los handlers escriben el outbox y un hilo lo envía
+job_dispatcher = JobDispatcher()
+job_outbox = JobOutbox(repo.db, job_dispatcher)
+
+# Boletas generadas en un pool de procesos; commit_transaction solo recibe la URL
+receipt_service = ReceiptService()
+
+
+def count_cache_stats():
+    return {"hits": count_cache.hits, "misses": count_cache.misses}
+
+
+def stream_stats():
+    return [{"feed": "prices", **price_feed.stats()}, {"feed": "transactions", **transaction_feed.stats()}]
+
+
+# Los contadores de cada módulo se leen al momento del scrape de /metrics
+register_stats("count_cache", count_cache_stats)
+register_stats("inventory", inventory_snapshot.stats)
+register_stats("quotes", quote_table.stats)
+register_stats("stream", stream_stats, label="feed")
+register_stats("jobmaster_outbox", job_dispatcher.stats)
+register_stats("receipts", receipt_service.stats)
+
+async def find_quote(symbol):
+    """Precio y cantidad actuales del símbolo; usa MongoDB solo si no está en la tabla."""
+    quote = quote_table.get(symbol)
+    if quote is not None:
+        return quote.as_document()
+    stock = await repo.find_stock(symbol)
+    if stock:
+        quote_table.put_document(stock)
+    return stock
+
+async def update_admin_inventory(symbol, quantity_change):
+    result = await repo.update_admin_inventory(symbol, quantity_change)
+    if result.upserted_id is not None:
+        await count_cache.bump("admin_transactions")
 
-users_db = get_db()
-users_collection = users_db["users"]
-collection_event_log = db["event_log"]
-#ESTO ES NUEVO
-estimations_collection = db["estimations"]
 
+# Respuesta para un parámetro cursor que no se pudo decodificar
+INVALID_CURSOR = {"error": "Cursor inválido."}
+
+
+def publish_unavailable():
+    # La cola de publicación MQTT está llena: no se registra nada
+    return JSONResponse(status_code=503, content={"error": "No se pudo enviar la solicitud al broker, intenta de nuevo."})
+
+# Etapas de agregación que unen cada transacción con su estimación; las fechas
+# las serializa ORJSONResponse
+TRANSACTION_ESTIMATION_STAGES = [
+    {"$lookup": {
+        "from": "estimations",
+        "localField": "transaction_id",
+        "foreignField": "transaction_id",
+        "pipeline": [
+            {"$limit": 1},
+            {"$project": {"_id": 0}},
+        ],
+        "as": "estimation",
+    }},
+    {"$set": {"estimation": {"$ifNull": [{"$first": "$estimation"}, None]}}},
+    {"$unset": "_id"},
+]
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "API for stocks"}
 
+@app.get("/admin/db/pool")
+async def get_pool_stats(user=Depends(admin_required)):
+    # Espera de checkout, tamaño del pool y churn de conexiones por cliente
+    return {"pools": pool_stats()}
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    # Formato de texto de Prometheus
+    body, content_type = render_latest()
+    return Response(body, media_type=content_type)
+
+@app.get("/admin/indexes/audit")
+async def audit_indexes(user=Depends(admin_required)):
+    # Ejecuta explain() sobre cada consulta registrada y reporta los COLLSCAN
+    report = await run_in_threadpool(audit_query_plans, db)
+    collscans = [entry["name"] for entry in report if entry.get("collscan")]
+    return {"queries": report, "collscan": collscans}
+
 def build_stocks_query(symbol=None, price=None, longName=None, timestamp=None, quantity=None):
     from datetime import datetime
     query = {}
@@ -124,7 +283,7 @@ def build_stocks_query(symbol=None, price=None, longName=None, timestamp=None, q
     return query
 
 @app.get("/admin/stocks")
-def get_stocks(
+async def get_stocks(
     symbol: Optional[str] = None, 
     price: Optional[str] = None,
     longName: Optional[str] = None,
@@ -132,38 +291,53 @@ def get_stocks(
     quantity: Optional[str] = None,  # Modificado para aceptar un rango en formato "min-max"
     page: int = Query(1, ge=1), 
     count: int = Query(25, ge=1),
+    cursor: Optional[str] = None,
+    estimated: bool = False,
     user=Depends(admin_required)
 ):
     # Verifica si el usuario es un administrador
     if not user:
         return JSONResponse(status_code=403, content={"error": "Acceso denegado. Usuario no autorizado."})
+    count = page_size(count)
     skip = (page - 1) * count
     query = build_stocks_query(symbol, price, longName, timestamp, quantity)
-    print(f"MongoDB query: {query}")
-    if collection is not None:
-        stocks = list(collection.find(query, {"_id": 0}).skip(skip).limit(count))
-        total_count = collection.count_documents(query)
-        return {"stocks": stocks, "page": page, "count": total_count}
+    query_log.debug("MongoDB query: %s", query)
+    if repo.stocks is not None:
+        if cursor is not None:
+            # Paginación por cursor ordenada por (symbol, _id)
+            try:
+                position = decode_cursor(cursor)
+            except ValueError:
+                return INVALID_CURSOR
+            stocks, next_cursor = await keyset_page(repo.stocks, query, SYMBOL_ORDER, position, count, {"_id": 0})
+            total_count = await count_cache.count(repo.stocks, query, estimated)
+            return ORJSONResponse({"stocks": JSONRows.from_documents(stocks), "page": page, "count": total_count,
+                                   "next_cursor": next_cursor})
+        stocks = await dump_cursor(repo.stocks.find(query, {"_id": 0}).skip(skip).limit(count))
+        total_count = await count_cache.count(repo.stocks, query, estimated)
+        return ORJSONResponse({"stocks": stocks, "page": page, "count": total_count})
     else:
         return {"error": "No hay stocks disponibles."}
     
 @app.get("/stocks")
-def get_stocksv2(
+async def get_stocksv2(
     symbol: Optional[str] = None, 
     price: Optional[str] = None,
     longName: Optional[str] = None,
     timestamp: Optional[str] = None,
     quantity: Optional[str] = None,
     page: int = Query(1, ge=1), 
-    count: int = Query(25, ge=1)
+    count: int = Query(25, ge=1),
+    cursor: Optional[str] = None,
+    estimated: bool = False
 ):
-    if admin_transactions_collection is None or collection is None:
+    if repo.admin_transactions is None or repo.stocks is None:
         return {"error": "No hay stocks disponibles."}
     
-    print(admin_transactions_collection)
-    # Obtener todos los símbolos disponibles en admin_transactions_collection
-    available_admin_stocks = list(admin_transactions_collection.find({}, {"_id": 0, "symbol": 1, "quantity": 1}))
-    available_symbols = {item["symbol"]: item["quantity"] for item in available_admin_stocks}
+    # Símbolos disponibles desde el snapshot del inventario del administrador
+    if not inventory_snapshot.loaded:
+        await run_in_threadpool(inventory_snapshot.load, db["admin_transactions"])
+    available_symbols = inventory_snapshot.quantities()
     
     if not available_symbols:
         return {"error": "No hay acciones disponibles para compra."}
@@ -184,29 +358,90 @@ def get_stocksv2(
     if timestamp:
         query["timestamp"] = timestamp
 
+    count = page_size(count)
     skip = (page - 1) * count
+    next_cursor = None
 
-    # Buscar en la colección principal
-    matching_stocks = list(collection.find(query, {"_id": 0}).skip(skip).limit(count))
-    total_count = collection.count_documents(query)
-
-    # Enriquecer con cantidad disponible desde admin_transactions_collection
-    for stock in matching_stocks:
+    # Enriquecer con cantidad disponible desde repo.admin_transactions
+    def with_available_quantity(stock):
         stock["quantity"] = available_symbols.get(stock["symbol"], 0)
+        return stock
+
+    # Buscar en la colección principal
+    if cursor is not None:
+        try:
+            position = decode_cursor(cursor)
+        except ValueError:
+            return INVALID_CURSOR
+        docs, next_cursor = await keyset_page(repo.stocks, query, SYMBOL_ORDER, position, count, {"_id": 0})
+        matching_stocks = JSONRows.from_documents(docs, with_available_quantity)
+    else:
+        matching_stocks = await dump_cursor(repo.stocks.find(query, {"_id": 0}).skip(skip).limit(count),
+                                            with_available_quantity)
+    total_count = await count_cache.count(repo.stocks, query, estimated)
 
     if not matching_stocks:
         return {"error": "No se encontraron acciones que coincidan con los criterios de búsqueda."}
 
-    return {
+    response = {
         "stocks": matching_stocks,
         "page": page,
         "count": total_count
     }
+    if cursor is not None:
+        response["next_cursor"] = next_cursor
+    return ORJSONResponse(response)
+
+@app.get("/inventory/status")
+async def get_inventory_status():
+    # Edad y tamaño del snapshot del inventario para monitoreo
+    return inventory_snapshot.stats()
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def _split_param(value):
+    return [item.strip() for item in value.split(",") if item.strip()] if value else None
+
+
+@app.get("/stream/prices")
+async def stream_prices(symbols: Optional[str] = None):
+    # symbols=AAPL,MSFT filtra los símbolos; sin filtro se reciben todos
+    subscriber = price_feed.broadcaster.subscribe(keys=_split_param(symbols))
+    return StreamingResponse(price_feed.broadcaster.stream(subscriber), media_type="text/event-stream",
+                             headers=SSE_HEADERS)
+
+
+@app.get("/stream/transactions")
+async def stream_transactions(request_ids: Optional[str] = None, user=Depends(verify_token)):
+    # Solo se envían las transacciones del usuario autenticado
+    subscriber = transaction_feed.broadcaster.subscribe(keys=_split_param(request_ids), owner=user["sub"])
+    return StreamingResponse(transaction_feed.broadcaster.stream(subscriber), media_type="text/event-stream",
+                             headers=SSE_HEADERS)
+
+
+@app.get("/stream/status")
+async def stream_status():
+    return {"prices": price_feed.stats(), "transactions": transaction_feed.stats()}
+
+
+@app.get("/quotes/status")
+async def quotes_status():
+    return quote_table.stats()
 
 @app.get("/stocks/{symbol}")
-def get_stock_detail(symbol: str, price: Optional[float] = None, quantity: Optional[int] = None, date: Optional[str] = None, longName: Optional[str] = None,shortName: Optional[str] = None, page: int = Query(1, ge=1), count: int = Query(25, ge=1)):
+async def get_stock_detail(symbol: str, price: Optional[float] = None, quantity: Optional[int] = None, date: Optional[str] = None, longName: Optional[str] = None,shortName: Optional[str] = None, page: int = Query(1, ge=1), count: int = Query(25, ge=1)):
+    count = page_size(count)
     skip = (page - 1) * count
     query = {"symbol": symbol}
+
+    # Sin filtros el detalle es la cotización actual
+    if page == 1 and not any((price, quantity, date, longName, shortName)):
+        stock = await find_quote(symbol)
+        if stock:
+            stock.pop("_id", None)
+            return {"symbol": symbol, "stock": [stock], "page": page, "count": count}
+        return {"error": f"Stock con símbolo {symbol} no encontrado."}
     
     if price:
         query["price"] = {"$lt": price}
@@ -225,32 +460,33 @@ def get_stock_detail(symbol: str, price: Optional[float] = None, quantity: Optio
     if shortName:
         query["shortName"] = {"$regex": shortName, "$options": "i"}
 
-    stocks = list(collection.find(query, {"_id": 0}).skip(skip).limit(count))
+    stocks = await dump_cursor(repo.stocks.find(query, {"_id": 0}).skip(skip).limit(count))
     
     if stocks:
-        return {"symbol": symbol, "stock": stocks, "page": page, "count": count}
+        return ORJSONResponse({"symbol": symbol, "stock": stocks, "page": page, "count": count})
     else:
         return {"error": f"Stock con símbolo {symbol} no encontrado."}
 
 @app.post("/stocks/{symbol}/buy")
-def buy_stock(symbol: str, quantity: int, user=Depends(verify_token)):
+async def buy_stock(symbol: str, quantity: int, user=Depends(verify_token)):
     user_id = user["sub"]
-    print(f"User email: {user_id}")
+    log.debug("User email: %s", user_id)
     if quantity <= 0:
         return {"error": "La cantidad debe ser mayor que cero."} #quizas que las acciones que se quieran/puedan se vean en el frontend
-    stock = collection.find_one({"symbol": symbol})
+    stock = await find_quote(symbol)
     if not stock:
         return {"error": f"Stock con símbolo {symbol} no encontrado."}
     if stock["quantity"] < quantity:
         return {"error": "No hay suficientes acciones disponibles."}
-    user = users_collection.find_one({"correo": user_id})
+    user = await repo.find_user(user_id)
     if not user:
         return {"error": "Usuario no encontrado."}
     if user["saldo"] < stock["price"] * quantity:
         return {"error": "Saldo insuficiente."}
 
     transaction_id = str(uuid.uuid4())
-    mqtt_manager.publish_buy_request(transaction_id, symbol, quantity)
+    if not mqtt_manager.publish_buy_request(transaction_id, symbol, quantity):
+        return publish_unavailable()
     transaction = {
         "request_id": transaction_id,
         "symbol": symbol,
@@ -259,21 +495,24 @@ def buy_stock(symbol: str, quantity: int, user=Depends(verify_token)):
         "timestamp": datetime.utcnow(),
         "status": "PENDING"
     }
-    result = transactions_collection.insert_one(transaction)
+    # La transacción y su estimación se escriben juntas; el JobMaster se llama en segundo plano
+    result, _ = await asyncio.gather(
+        repo.transactions.insert_one(transaction),
+        job_outbox.enqueue(user_id, symbol, quantity, stock["price"], transaction_id),
+    )
+    await count_cache.bump("transactions")
     transaction["_id"] = str(result.inserted_id)
-    price = stock["price"]
-    mqtt_manager.enviar_estimacion_jobmaster(user_id, symbol, quantity, price,transaction_id)
     return {"message": "Solicitud de compra exitosa.", "transaction": transaction}
 
 #Descuento Acciones compradas
 @app.post("/admin/stocks/discount")
-def apply_discount_to_admin_stocks(discount: float, user=Depends(admin_required)):
+async def apply_discount_to_admin_stocks(discount: float, user=Depends(admin_required)):
     #user_id = user["sub"]
     if discount <= 0 or discount > 100:
         return {"error": "El descuento debe ser un valor entre 0 y 100."}
     discount_factor = (100 - discount) / 100
 
-    result = admin_transactions_collection.update_many(
+    result = await repo.admin_transactions.update_many(
         {},
         {"$mul": {"price": discount_factor}}
     )
@@ -285,12 +524,12 @@ def apply_discount_to_admin_stocks(discount: float, user=Depends(admin_required)
 
 # Usuario normal compra del administrador
 @app.post("/webpay/create")
-def iniciar_webpay_user(data: dict, user=Depends(verify_token)):
+async def iniciar_webpay_user(data: dict, user=Depends(verify_token)):
     user_id = user["sub"]
-    user = users_collection.find_one({"correo": user_id})
+    user = await repo.find_user(user_id)
     if not user:
         return {"error": "Usuario no encontrado."}
-    stock = collection.find_one({"symbol": data["symbol"]})
+    stock = await find_quote(data["symbol"])
     if not stock:
         return {"error": f"Stock con símbolo {data['symbol']} no encontrado."}
     if stock["quantity"] < data["quantity"]:
@@ -306,7 +545,7 @@ def iniciar_webpay_user(data: dict, user=Depends(verify_token)):
     
     # Build the frontend payment URL from the environment variable
     frontend_payment_url = f"{URL_FRONTEND}/payment" if URL_FRONTEND else "https://www.arquitecturadesoftware.me/payment"
-    trx_resp = tx.get_tx().create(transaction_id, "stocks_buy", amount, frontend_payment_url)
+    trx_resp = await run_in_threadpool(tx.create, transaction_id, "stocks_buy", amount, frontend_payment_url)
     
     #Ya no envia la solicitud al broker
     # if data.get("owner_type", False) == "platform":
@@ -315,11 +554,7 @@ def iniciar_webpay_user(data: dict, user=Depends(verify_token)):
     #     mqtt_manager.publish_validation(request_id, "ACCEPTED", trx_resp["token"])
 
     #Actualizar la colección de las transacciones del administrador
-    admin_transactions_collection.update_one(
-        {"symbol": data["symbol"]},
-        {"$inc": {"quantity": -data["quantity"]}, "$set": {"timestamp": datetime.utcnow()}},
-        upsert=True
-    )
+    await update_admin_inventory(data["symbol"], -data["quantity"])
     
     transaction = {
         "request_id": request_id,
@@ -334,17 +569,18 @@ def iniciar_webpay_user(data: dict, user=Depends(verify_token)):
         "owner_type": data.get("owner_type", "platform")  # Agregar owner_type
     }
 
-    transactions_collection.insert_one(transaction)
+    await repo.transactions.insert_one(transaction)
+    await count_cache.bump("transactions")
     return {"url": trx_resp["url"], "token_ws": trx_resp["token"], "request_id": request_id}
 
 #Administrador compra de inventario
 @app.post("/admin/webpay/create")
-def iniciar_webpay_admin(data: dict, user=Depends(admin_required)):
+async def iniciar_webpay_admin(data: dict, user=Depends(admin_required)):
     user_id = user["sub"]
-    user = users_collection.find_one({"correo": user_id})
+    user = await repo.find_user(user_id)
     if not user:
         return {"error": "Usuario no encontrado."}
-    stock = collection.find_one({"symbol": data["symbol"]})
+    stock = await find_quote(data["symbol"])
     if not stock:
         return {"error": f"Stock con símbolo {data['symbol']} no encontrado."}
     if stock["quantity"] < data["quantity"]:
@@ -360,9 +596,10 @@ def iniciar_webpay_admin(data: dict, user=Depends(admin_required)):
     
     # Build the frontend payment URL from the environment variable
     frontend_payment_url = f"{URL_FRONTEND}/payment" if URL_FRONTEND else "https://www.arquitecturadesoftware.me/payment"
-    trx_resp = tx.get_tx().create(transaction_id, "stocks_buy", amount, frontend_payment_url)
+    trx_resp = await run_in_threadpool(tx.create, transaction_id, "stocks_buy", amount, frontend_payment_url)
     
-    mqtt_manager.publish_buy_request(request_id, data["symbol"], data["quantity"], trx_resp["token"])
+    if not mqtt_manager.publish_buy_request(request_id, data["symbol"], data["quantity"], trx_resp["token"]):
+        return publish_unavailable()
     mqtt_manager.publish_validation(request_id, "ACCEPTED", trx_resp["token"])
     transaction = {
         "request_id": request_id,
@@ -376,22 +613,28 @@ def iniciar_webpay_admin(data: dict, user=Depends(admin_required)):
         "estimated_gain": None,  # Inicializar como None
     }
 
-    transactions_collection.insert_one(transaction)
+    await repo.transactions.insert_one(transaction)
+    await count_cache.bump("transactions")
     
     # Guardar la transacción en la colección de transacciones del administrador
     #Que actualice la transacción aumentando la cantidad de acciones
-    admin_transactions_collection.update_one(
-        {"symbol": data["symbol"]},
-        {"$inc": {"quantity": data["quantity"]}, "$set": {"timestamp": datetime.utcnow()}},
-        upsert=True
-    )
+    await update_admin_inventory(data["symbol"], data["quantity"])
     return {"url": trx_resp["url"], "token_ws": trx_resp["token"], "request_id": request_id}
 
+@app.get("/receipts/{key}", include_in_schema=False)
+async def get_receipt(key: str):
+    # Solo con RECEIPT_STORE local; con S3 la URL apunta al bucket
+    media_type = RECEIPT_MEDIA_TYPES.get(key.rpartition(".")[2])
+    body = await run_in_threadpool(receipt_service.store.get, key) if media_type else None
+    if body is None:
+        return JSONResponse(status_code=404, content={"error": "Boleta no encontrada o en proceso."})
+    return Response(body, media_type=media_type, headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
 @app.post("/webpay/commit")
 async def commit_transaction(request: Request, user=Depends(verify_token)):
     body = await request.json()
     token_ws = body.get("token_ws")
-    transaction = transactions_collection.find_one({"request_id": body.get("request_id")})
+    transaction = await repo.find_transaction(body.get("request_id"))
 
     # TRANSACCIÓN ANULADA POR EL USUARIO
     if not token_ws or token_ws == "":
@@ -399,21 +642,14 @@ async def commit_transaction(request: Request, user=Depends(verify_token)):
             mqtt_manager.publish_validation(body.get("request_id"), "REJECTED", transaction["token_ws"])
         else:
             #Retornar cantidad de acciones al inventario del administrador
-            admin_transactions_collection.update_one(
-                {"symbol": transaction["symbol"]},
-                {"$inc": {"quantity": transaction["quantity"]}, "$set": {"timestamp": datetime.utcnow()}},
-                upsert=True
-            )
+            await update_admin_inventory(transaction["symbol"], transaction["quantity"])
             #Actualizar status de la transaccctions collection
-            transactions_collection.update_one(
-                {"request_id": body.get("request_id")},
-                {"$set": {"status": "CANCEL", "timestamp": datetime.utcnow()}}
-            )
+            await repo.set_transaction_fields(body.get("request_id"), {"status": "CANCEL", "timestamp": datetime.utcnow()})
         return {"status": "CANCEL",
                 "message": "Transacción anulada por el usuario."}
 
     try:
-        response = tx.get_tx().commit(token_ws)
+        response = await run_in_threadpool(tx.commit, token_ws)
 
         response_status = "OK" if response["response_code"] == 0 else "REJECTED"
         if is_admin(user):
@@ -423,58 +659,36 @@ async def commit_transaction(request: Request, user=Depends(verify_token)):
         if response["response_code"] != 0:
             if not is_admin(user):
                 # Retornar cantidad de acciones al inventario del administrador
-                admin_transactions_collection.update_one(
-                    {"symbol": transaction["symbol"]},
-                    {"$inc": {"quantity": transaction["quantity"]}, "$set": {"timestamp": datetime.utcnow()}},
-                    upsert=True
-                )
-                # Actualizar status de la transacción en transactions_collection
-                transactions_collection.update_one(
-                    {"request_id": body.get("request_id")},
-                    {"$set": {"status": "REJECTED", "timestamp": datetime.utcnow()}}
-                )
+                await update_admin_inventory(transaction["symbol"], transaction["quantity"])
+                # Actualizar status de la transacción en repo.transactions
+                await repo.set_transaction_fields(body.get("request_id"), {"status": "REJECTED", "timestamp": datetime.utcnow()})
             return {"status":"REJECTED",
                     "message": "Transacción ha sido rechazada.",
                     }
         
         # TRANSACCIÓN ACEPTADA
-        #Generación de boleta
-        receipt_url = purchase_receip.generate_receipt(
-            user_data={"email": user["sub"]},
-            stock_data={
-                "name": transaction["symbol"],
-                "quantity": transaction["quantity"],
-                "total": response["amount"]
-            }
-        )
+        #Generación de boleta: la URL queda asignada y se genera en segundo plano
+        receipt_url = receipt_service.submit(receipt_data(
+            transaction["request_id"], user["sub"], transaction["symbol"], transaction["quantity"],
+            response["amount"], response.get("buy_order"),
+        ))
+        # Generar estimación solo si el pago fue exitoso; queda en el outbox
+        # en el mismo paso que el nuevo estado de la transacción
+        log.debug("Generando estimación para %s", body.get("request_id"))
+        stock = await find_quote(transaction["symbol"])
+        price = stock["price"] if stock else response["amount"] / transaction["quantity"]
+        writes = [job_outbox.enqueue(user["sub"], transaction["symbol"], transaction["quantity"], price,
+                                     transaction["request_id"])]
         #ESTO ES NUEVO
-        # Si es un usuario normal actualiza su estado aca
+        # Si es un usuario normal actualiza su estado aca, junto con la boleta
         if not is_admin(user):
-            # Actualizar el status de la transacción en transactions_collection
-            transactions_collection.update_one(
-                {"request_id": body.get("request_id")},
-                {"$set": {"status": "OK", "timestamp": datetime.utcnow()}}
-            )
-        # Generar estimación solo si el pago fue exitoso
-        #FALTA PROBAR
-        print("request_id:", body.get("request_id"))
-        stock = collection.find_one({"symbol": transaction["symbol"]})
-        price = stock["price"] if stock else response["amount"] / transaction["quantity"]
-
-        mqtt_manager.enviar_estimacion_jobmaster(
-            user["sub"],
-            transaction["symbol"],
-            transaction["quantity"],
-            price,
-            transaction["request_id"]
-        )
-        # revisar
+            # Actualizar el status de la transacción en repo.transactions
+            writes.append(repo.set_transaction_fields(body.get("request_id"), {
+                "status": "OK", "timestamp": datetime.utcnow(), "receipt_url": receipt_url}))
+        else:
+            writes.append(repo.set_transaction_fields(body.get("request_id"), {"receipt_url": receipt_url}))
+        await asyncio.gather(*writes)
 
-        # modificar transaccion con receipt_url
-        transactions_collection.update_one(
-            {"request_id": body.get("request_id")},
-            {"$set": {"receipt_url": receipt_url}}
-        )
 
         # INCLUIR MÁS INFORMACIÓN EN LA RESPUESTA
         return {
@@ -496,29 +710,41 @@ async def commit_transaction(request: Request, user=Depends(verify_token)):
         }
     
     except Exception as e:
-        print("Error en la transacción:", e)
+        log.exception("Error en la transacción: %s", e)
         return {"status": "ERROR",
                 "message": "Error en la transacción."}
     
 @app.get("/admin/transactions")
-def get_admin_transactions(user=Depends(admin_required), page: int = Query(1, ge=1), count: int = Query(25, ge=1)):
+async def get_admin_transactions(user=Depends(admin_required), page: int = Query(1, ge=1), count: int = Query(25, ge=1), cursor: Optional[str] = None, estimated: bool = False):
     # Solo usuarios administradores pueden acceder
     #user_email = user["sub"]
+    count = page_size(count)
     skip = (page - 1) * count
-    transactions = list(
-        admin_transactions_collection.find({}, {"_id": 0})
-        .skip(skip)
-        .limit(count)
-    )
-    total_count = admin_transactions_collection.count_documents({})
-    return {
+    if cursor is not None:
+        try:
+            position = decode_cursor(cursor)
+        except ValueError:
+            return INVALID_CURSOR
+        docs, next_cursor = await keyset_page(repo.admin_transactions, {}, SYMBOL_ORDER, position, count, {"_id": 0})
+        transactions = JSONRows.from_documents(docs)
+    else:
+        transactions = await dump_cursor(
+            repo.admin_transactions.find({}, {"_id": 0})
+            .skip(skip)
+            .limit(count)
+        )
+    total_count = await count_cache.count(repo.admin_transactions, {}, estimated)
+    response = {
         "stocks": transactions,
         "page": page,
         "count": total_count
     }
+    if cursor is not None:
+        response["next_cursor"] = next_cursor
+    return ORJSONResponse(response)
 
 @app.post("/admin/auction")
-def start_auction(data: dict, user=Depends(admin_required)):
+async def start_auction(data: dict, user=Depends(admin_required)):
     # Solo usuarios administradores pueden iniciar una subasta
     #user_email = user["sub"]
 
@@ -544,39 +770,67 @@ def start_auction(data: dict, user=Depends(admin_required)):
     auction_id = str(uuid.uuid4())
 
    # Publicar compra y enviar estimación
-    mqtt_manager.publish_auction_offer(auction_id, symbol, quantity)
+    if not mqtt_manager.publish_auction_offer(auction_id, symbol, quantity):
+        return publish_unavailable()
     # Quitar la cantidad de acciones del inventario del administrador
-    admin_transactions_collection.update_one(
-        {"symbol": symbol},
-        {"$inc": {"quantity": -quantity}, "$set": {"timestamp": datetime.utcnow()}},
-        upsert=True
-    )
+    await update_admin_inventory(symbol, -quantity)
     
     # result = admin_transactions_collection.insert_one(symbol, quantity)
     return {"message": "Subasta iniciada exitosamente.", "auction_id": str(auction_id), "symbol": symbol, "quantity": quantity}
 
+# Marca en el cursor de ofertas para una lista que ya no tiene más páginas
+OFFERS_EXHAUSTED = "done"
+
+async def _offers_page(query, position, count):
+    if position == OFFERS_EXHAUSTED:
+        return [], None
+    return await keyset_page(repo.auction_offers, query, NEWEST_FIRST, position, count, {"_id": 0})
+
 @app.get("/admin/auction/offers")
-def get_auction_offers(page: int = Query(1, ge=1), count: int = Query(25, ge=1), user=Depends(admin_required)):
+async def get_auction_offers(page: int = Query(1, ge=1), count: int = Query(25, ge=1), cursor: Optional[str] = None, estimated: bool = False, user=Depends(admin_required)):
+    count = page_size(count)
     skip = (page - 1) * count
-    # Ofertas de otros grupos
-    offers = list(collection_auction_offers.find({"group_id": {"$ne": "27"}, "status":"OFFERED"}, {"_id": 0}).skip(skip).limit(count))
-    # Ofertas del grupo 27 (administrador)
-    admin_offers = list(collection_auction_offers.find({"group_id": "27", "status":"OFFERED"}, {"_id": 0}).skip(skip).limit(count))
-    offers_total_count = collection_auction_offers.count_documents({"group_id": {"$ne": "27"}})
-    admin_offers_total_count = collection_auction_offers.count_documents({"group_id": "27"})
+    group_query = {"group_id": {"$ne": "27"}, "status": "OFFERED"}
+    admin_query = {"group_id": "27", "status": "OFFERED"}
+    if cursor is not None:
+        # El cursor guarda una posición para cada lista de ofertas
+        try:
+            position = decode_cursor(cursor) or {}
+        except ValueError:
+            return INVALID_CURSOR
+        (offers, group_cursor), (admin_offers, admin_cursor) = await asyncio.gather(
+            _offers_page(group_query, position.get("group"), count),
+            _offers_page(admin_query, position.get("admin"), count),
+        )
+        next_cursor = None
+        if group_cursor or admin_cursor:
+            next_cursor = encode_cursor({
+                "group": decode_cursor(group_cursor) if group_cursor else OFFERS_EXHAUSTED,
+                "admin": decode_cursor(admin_cursor) if admin_cursor else OFFERS_EXHAUSTED,
+            })
+    else:
+        # Ofertas de otros grupos
+        offers = await repo.auction_offers.find(group_query, {"_id": 0}).skip(skip).limit(count).to_list()
+        # Ofertas del grupo 27 (administrador)
+        admin_offers = await repo.auction_offers.find(admin_query, {"_id": 0}).skip(skip).limit(count).to_list()
+    offers_total_count = await count_cache.count(repo.auction_offers, {"group_id": {"$ne": "27"}}, estimated)
+    admin_offers_total_count = await count_cache.count(repo.auction_offers, {"group_id": "27"}, estimated)
     if offers or admin_offers:
-        return {
+        response = {
             "group_offers": offers,
             "admin_offers": admin_offers,
             "page": page,
             "count": offers_total_count,
             "admin_count": admin_offers_total_count
         }
+        if cursor is not None:
+            response["next_cursor"] = next_cursor
+        return response
     else:
         return {"error": "No se encontraron ofertas de subasta."}
 
 @app.post("/admin/auction/proposal")
-def make_auction_proposal(data: dict, user=Depends(admin_required)):
+async def make_auction_proposal(data: dict, user=Depends(admin_required)):
     # Solo usuarios administradores pueden hacer propuestas de subasta
     #user_email = user["sub"]
 
@@ -594,21 +848,18 @@ def make_auction_proposal(data: dict, user=Depends(admin_required)):
     
     proposal_id = str(uuid.uuid4())
     
-    mqtt_manager.publish_auction_proposal(auction_id, proposal_id, symbol, quantity)
+    if not mqtt_manager.publish_auction_proposal(auction_id, proposal_id, symbol, quantity):
+        return publish_unavailable()
 
     # Quitar la cantidad de acciones del inventario del administrador
-    admin_transactions_collection.update_one(
-        {"symbol": symbol},
-        {"$inc": {"quantity": -quantity}, "$set": {"timestamp": datetime.utcnow()}},
-        upsert=True
-    )
+    await update_admin_inventory(symbol, -quantity)
     
     
     # result = collection_auction_offers.insert_one(proposal_data)
     return {"message": "Propuesta de subasta creada exitosamente.", "proposal_id": proposal_id}
 
 @app.post("/admin/auction/proposal/accept")
-def accept_auction_proposal(data: dict, user=Depends(admin_required)):
+async def accept_auction_proposal(data: dict, user=Depends(admin_required)):
     # Solo usuarios administradores pueden aceptar propuestas de subasta
     proposal_id = data.get("proposal_id", None)
     auction_id = data.get("auction_id", None)
@@ -618,7 +869,7 @@ def accept_auction_proposal(data: dict, user=Depends(admin_required)):
         return {"error": "Faltan datos requeridos: 'proposal_id' y 'auction_id' son obligatorios."}
 
     # Buscar la propuesta en la colección de ofertas de subasta
-    admin_offer = collection_auction_offers.find_one(
+    admin_offer = await repo.auction_offers.find_one(
     {
         "auction_id": auction_id,
         "proposals": {
@@ -640,12 +891,13 @@ def accept_auction_proposal(data: dict, user=Depends(admin_required)):
 
 
     # Publicar la aceptación de la propuesta al broker
-    mqtt_manager.publish_proposal_response(auction_id, proposal_id, proposal.get("symbol"), proposal.get("quantity", 0), "acceptance")
+    if not mqtt_manager.publish_proposal_response(auction_id, proposal_id, proposal.get("symbol"), proposal.get("quantity", 0), "acceptance"):
+        return publish_unavailable()
 
     return {"message": "Propuesta de subasta aceptada exitosamente.", "proposal_id": proposal_id}
 
 @app.post("/admin/auction/proposal/reject")
-def reject_auction_proposal(data: dict, user=Depends(admin_required)):
+async def reject_auction_proposal(data: dict, user=Depends(admin_required)):
     # Solo usuarios administradores pueden rechazar propuestas de subasta
     proposal_id = data.get("proposal_id", None)
     auction_id = data.get("auction_id", None)
@@ -655,7 +907,7 @@ def reject_auction_proposal(data: dict, user=Depends(admin_required)):
         return {"error": "Faltan datos requeridos: 'proposal_id' y 'auction_id' son obligatorios."}
 
     # Buscar la propuesta en la colección de ofertas de subasta
-    admin_offer = collection_auction_offers.find_one(
+    admin_offer = await repo.auction_offers.find_one(
         {
             "auction_id": auction_id,
             "proposals": {
@@ -675,7 +927,8 @@ def reject_auction_proposal(data: dict, user=Depends(admin_required)):
     if not proposal:
         return {"error": "Propuesta de subasta no válida."}
     # Publicar la respuesta de rechazo al broker
-    mqtt_manager.publish_proposal_response(auction_id, proposal_id, proposal.get("symbol"), proposal.get("quantity", 0), "rejection")
+    if not mqtt_manager.publish_proposal_response(auction_id, proposal_id, proposal.get("symbol"), proposal.get("quantity", 0), "rejection"):
+        return publish_unavailable()
     # # Actualizar el estado de la propuesta a "REJECTED"
     # collection_auction_offers.update_one(
     #     {"_id": admin_offer["_id"], "proposals.proposal_id": proposal_id},
@@ -685,44 +938,38 @@ def reject_auction_proposal(data: dict, user=Depends(admin_required)):
 
 #historial de transacciones
 @app.post("/stocks/{symbol}/buy")
-def buy_stockv2(symbol: str, quantity: int, user=Depends(verify_token)):
+async def buy_stockv2(symbol: str, quantity: int, user=Depends(verify_token)):
     user_id = user["sub"]
-    print(f"User email: {user_id}")
+    log.debug("User email: %s", user_id)
 
     if quantity <= 0:
         return {"error": "La cantidad debe ser mayor que cero."}
 
-    stock = collection.find_one({"symbol": symbol})
+    stock = await find_quote(symbol)
     if not stock:
         return {"error": f"Stock con símbolo {symbol} no encontrado."}
 
     if stock["quantity"] < quantity:
         return {"error": "No hay suficientes acciones disponibles."}
 
-    user_data = users_collection.find_one({"correo": user_id})
+    user_data = await repo.find_user(user_id)
     if not user_data:
         return {"error": "Usuario no encontrado."}
 
     total_price = stock["price"] * quantity
-    if user_data["saldo"] < total_price:
-        return {"error": "Saldo insuficiente."}
-
-    # Descontar saldo al usuario
-    users_collection.update_one(
-        {"correo": user_id},
-        {"$inc": {"saldo": -total_price}}
-    )
-
     transaction_id = str(uuid.uuid4())
 
-   
-   # Publicar compra y enviar estimación
-    mqtt_manager.publish_buy_request(transaction_id, symbol, quantity)
-
-    # ✅ Agregar el price al enviar la estimación
-    price = stock["price"]
-    mqtt_manager.enviar_estimacion_jobmaster(user_id, symbol, quantity, price, transaction_id)
+    # Descontar saldo al usuario solo si alcanza, en la misma escritura. El
+    # broker usa la misma llave del libro, así que no se cobra dos veces
+    debit = await wallet.post(user_id, -total_price, f"{transaction_id}:{PURCHASE}", PURCHASE,
+                              reference=transaction_id, minimum=total_price)
+    if debit["insufficient"]:
+        return {"error": "Saldo insuficiente."}
 
+    # Publicar compra; si no se puede encolar se devuelve el cargo
+    if not mqtt_manager.publish_buy_request(transaction_id, symbol, quantity):
+        await wallet.post(user_id, total_price, f"{transaction_id}:{REFUND}", REFUND, reference=transaction_id)
+        return publish_unavailable()
 
     transaction = {
         "request_id": transaction_id,
@@ -735,34 +982,84 @@ def buy_stockv2(symbol: str, quantity: int, user=Depends(verify_token)):
         "estimated_gain": None
     }
 
-    result = transactions_collection.insert_one(transaction)
+    # La transacción y su estimación se escriben juntas
+    result, _ = await asyncio.gather(
+        repo.transactions.insert_one(transaction),
+        job_outbox.enqueue(user_id, symbol, quantity, stock["price"], transaction_id),
+    )
+    await count_cache.bump("transactions")
     transaction["_id"] = str(result.inserted_id)
 
     return {"message": "Compra con saldo registrada exitosamente.", "transaction": transaction}
 
 
+CANDLE_INTERVALS = ("1m", "5m", "1h", "1d")
+MAX_CANDLES = 5000
+
+
+@app.get("/stocks/{symbol}/candles")
+async def get_candles(
+    symbol: str,
+    interval: str = "1m",
+    from_date: Optional[str] = Query(None, alias="from"),
+    to_date: Optional[str] = Query(None, alias="to"),
+    limit: int = Query(500, ge=1, le=MAX_CANDLES)
+):
+    # Lee solo las velas precalculadas por broker_updates, sin recorrer event_log
+    if interval not in CANDLE_INTERVALS:
+        return {"error": f"interval debe ser uno de {', '.join(CANDLE_INTERVALS)}"}
+    query = {"symbol": symbol, "interval": interval}
+    try:
+        if from_date:
+            query.setdefault("start", {})["$gte"] = datetime.fromisoformat(from_date)
+        if to_date:
+            query.setdefault("start", {})["$lte"] = datetime.fromisoformat(to_date)
+    except ValueError:
+        return {"error": "from y to deben tener formato ISO 8601 (YYYY-MM-DD o YYYY-MM-DDTHH:MM:SS)"}
+
+    # Sin "from" se entregan las últimas velas, en orden cronológico
+    direction = 1 if from_date else -1
+    candles = await (
+        repo.candles.find(query, {"_id": 0, "symbol": 0, "interval": 0, "open_at": 0, "close_at": 0})
+        .sort("start", direction)
+        .limit(limit)
+    ).to_list()
+    if direction == -1:
+        candles.reverse()
+    return ORJSONResponse({"symbol": symbol, "interval": interval, "candles": candles})
+
+
 @app.get("/stocks/{symbol}/event_log")
-def get_event_log(symbol: str, page: int = Query(1, ge=1), count: int = Query(25, ge=1)):
+async def get_event_log(symbol: str, page: int = Query(1, ge=1), count: int = Query(25, ge=1), cursor: Optional[str] = None):
+    count = page_size(count)
     skip = (page - 1) * count
     query = {"symbol": symbol}
     
-    events = list(collection_event_log.find(query, {"_id": 0}).skip(skip).limit(count))
+    if cursor is not None:
+        # Paginación por cursor ordenada por (timestamp, _id), del más reciente
+        try:
+            position = decode_cursor(cursor)
+        except ValueError:
+            return INVALID_CURSOR
+        docs, next_cursor = await keyset_page(repo.event_log, query, NEWEST_FIRST, position, count, {"_id": 0})
+        events = JSONRows.from_documents(docs)
+    else:
+        events = await dump_cursor(repo.event_log.find(query, {"_id": 0}).skip(skip).limit(count))
 
     if events:
-        return {"symbol": symbol, "event_log": events, "page": page, "count": count}
+        response = {"symbol": symbol, "event_log": events, "page": page, "count": count}
+        if cursor is not None:
+            response["next_cursor"] = next_cursor
+        return ORJSONResponse(response)
     else:
         return {"error": f"No se encontraron eventos para el símbolo {symbol}."}
 
 
-@app.get("/events/all")  # Cambio de ruta para evitar conflictos
-def get_all_event_logs(
-    symbol: Optional[str] = None,
-    from_date: Optional[str] = None,
-    to_date: Optional[str] = None,
-    page: int = Query(1, ge=1), 
-    count: int = Query(25, ge=1)
-):
-    skip = (page - 1) * count
+def build_history_query(symbol=None, from_date=None, to_date=None):
+    """Filtros de símbolo y rango de fechas de ``/events/all`` y las exportaciones.
+
+    Lanza ValueError con el mensaje para el cliente si una fecha no es válida.
+    """
     query = {}
     
     # Add optional filters
@@ -775,58 +1072,124 @@ def get_all_event_logs(
         if from_date:
             try:
                 dt_from = datetime.fromisoformat(from_date)
-                start = datetime(dt_from.year, dt_from.month, dt_from.day, 0, 0, 0)
-                query["timestamp"]["$gte"] = start
             except ValueError:
-                return {"error": "from_date debe tener el formato 'YYYY-MM-DD'"}
+                raise ValueError("from_date debe tener el formato 'YYYY-MM-DD'")
+            query["timestamp"]["$gte"] = datetime(dt_from.year, dt_from.month, dt_from.day, 0, 0, 0)
                 
         if to_date:
             try:
                 dt_to = datetime.fromisoformat(to_date)
-                end = datetime(dt_to.year, dt_to.month, dt_to.day, 23, 59, 59)
-                query["timestamp"]["$lte"] = end
             except ValueError:
-                return {"error": "to_date debe tener el formato 'YYYY-MM-DD'"}
+                raise ValueError("to_date debe tener el formato 'YYYY-MM-DD'")
+            query["timestamp"]["$lte"] = datetime(dt_to.year, dt_to.month, dt_to.day, 23, 59, 59)
+    return query
+
+
+@app.get("/events/all")  # Cambio de ruta para evitar conflictos
+async def get_all_event_logs(
+    symbol: Optional[str] = None,
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    page: int = Query(1, ge=1), 
+    count: int = Query(25, ge=1),
+    cursor: Optional[str] = None,
+    estimated: bool = False
+):
+    count = page_size(count)
+    skip = (page - 1) * count
+    try:
+        query = build_history_query(symbol, from_date, to_date)
+    except ValueError as e:
+        return {"error": str(e)}
     
-    events = list(collection_event_log.find(query, {"_id": 0}).skip(skip).limit(count))
-    total_count = collection_event_log.count_documents(query)
+    if cursor is not None:
+        try:
+            position = decode_cursor(cursor)
+        except ValueError:
+            return INVALID_CURSOR
+        docs, next_cursor = await keyset_page(repo.event_log, query, NEWEST_FIRST, position, count, {"_id": 0})
+        events = JSONRows.from_documents(docs)
+    else:
+        events = await dump_cursor(repo.event_log.find(query, {"_id": 0}).skip(skip).limit(count))
+    total_count = await count_cache.count(repo.event_log, query, estimated)
     
     # Cambio en la estructura de respuesta para que sea igual que get_event_log
     if events:
-        return {
+        response = {
             "event_log": events,
             "page": page,
             "count": len(events),
             "total": total_count
         }
+        if cursor is not None:
+            response["next_cursor"] = next_cursor
+        return ORJSONResponse(response)
     else:
         return {"error": "No se encontraron eventos con los filtros especificados."}
 
+
+async def _export_response(collection, name, columns, symbol, from_date, to_date, format, gzip, parallel):
+    if format not in EXPORT_FORMATS:
+        return {"error": f"format debe ser uno de {', '.join(EXPORT_FORMATS)}"}
+    try:
+        query = build_history_query(symbol, from_date, to_date)
+    except ValueError as e:
+        return {"error": str(e)}
+    queries = plan_queries(query, parallel)
+    return StreamingResponse(
+        stream_export(collection, queries, columns, format, gzip),
+        media_type=MEDIA_TYPES[format],
+        headers=export_headers(name, format, gzip)
+    )
+
+
+@app.get("/events/export")
+async def export_event_logs(
+    symbol: Optional[str] = None,
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    format: str = "ndjson",
+    gzip: bool = False,
+    parallel: int = Query(1, ge=1, le=EXPORT_MAX_PARALLEL)
+):
+    # Mismos filtros que /events/all, sin paginar
+    return await _export_response(repo.event_log, "event_log", EVENT_LOG_COLUMNS,
+                                  symbol, from_date, to_date, format, gzip, parallel)
+
+
+@app.get("/admin/transactions/export")
+async def export_transactions(
+    user=Depends(admin_required),
+    symbol: Optional[str] = None,
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    format: str = "ndjson",
+    gzip: bool = False,
+    parallel: int = Query(1, ge=1, le=EXPORT_MAX_PARALLEL)
+):
+    # Historial de compras de todos los usuarios
+    return await _export_response(repo.transactions, "transactions", TRANSACTION_COLUMNS,
+                                  symbol, from_date, to_date, format, gzip, parallel)
+
 @app.post("/wallet")
-def add_funds(monto: float, user: Dict = Depends(verify_token)):
+async def add_funds(monto: float, request_id: Optional[str] = None, user: Dict = Depends(verify_token)):
     user_id = user["sub"]
     if monto <= 0:
         return {"error": "El monto debe ser mayor que cero."}
-    
-    user_db = users_collection.find_one({"correo": user_id})
-    if not user_db:
-        # Si el usuario no existe, lo creamos
-        users_collection.insert_one({
-            "correo": user_id,
-            "saldo": monto
-        })
-        return {"message": "Usuario creado y fondos añadidos exitosamente.", "new_balance": monto}
-    else:
-        # Si el usuario existe, actualizamos su saldo
-        new_balance = user_db["saldo"] + monto
-        users_collection.update_one({"correo": user_id}, {"$set": {"saldo": new_balance}})
-        return {"message": "Fondos añadidos exitosamente.", "new_balance": new_balance}
+
+    # request_id permite reintentar la carga sin abonar dos veces
+    posting = await wallet.post(user_id, monto, request_id or str(uuid.uuid4()), DEPOSIT)
+    if not posting["applied"]:
+        return {"message": "Fondos ya añadidos para esta solicitud.", "new_balance": posting["balance"]}
+    if posting["created"]:
+        return {"message": "Usuario creado y fondos añadidos exitosamente.", "new_balance": posting["balance"]}
+    return {"message": "Fondos añadidos exitosamente.", "new_balance": posting["balance"]}
 
 @app.get("/wallet")
-def get_wallet(user: Dict = Depends(verify_token)):
+async def get_wallet(user: Dict = Depends(verify_token)):
     user_id = user["sub"]
     
-    user_db = users_collection.find_one({"correo": user_id})
+    user_db = await repo.find_user(user_id)
     if user_db:
         return {
             "correo": user_id, 
@@ -835,78 +1198,107 @@ def get_wallet(user: Dict = Depends(verify_token)):
     else:
         return {"error": "Usuario no encontrado."}
 
+@app.get("/wallet/history")
+async def get_wallet_history(user: Dict = Depends(verify_token), count: int = Query(25, ge=1), cursor: Optional[str] = None):
+    # Movimientos del saldo, del más reciente, paginados por cursor
+    try:
+        position = decode_cursor(cursor)
+    except ValueError:
+        return INVALID_CURSOR
+    entries, next_cursor = await wallet.history(user["sub"], position, page_size(count))
+    return ORJSONResponse({"entries": JSONRows.from_documents(entries), "next_cursor": next_cursor})
+
     
 @app.get("/transactions")
-def get_transactions(user: Dict = Depends(verify_token), page: int = Query(1, ge=1), count: int = Query(25, ge=1)):
+async def get_transactions(user: Dict = Depends(verify_token), page: int = Query(1, ge=1), count: int = Query(25, ge=1), cursor: Optional[str] = None, estimated: bool = False):
     user_id = user["sub"]
+    count = page_size(count)
     skip = (page - 1) * count
-    transactions = list(
-        transactions_collection.find({"user_email": user_id}, {"_id": 0})
-        .skip(skip)
-        .limit(count)
-    )
-    
-    # Para cada transacción, agregar la estimación si existe y formatear fechas
-    for tx_ in transactions:
-        estimation = estimations_collection.find_one({"transaction_id": tx_.get("transaction_id")}, {"_id": 0})
-        
-        if estimation:
-            # Formatear fecha completed_at si existe
-            if estimation.get("completed_at"):
-                estimation["completed_at"] = estimation["completed_at"].isoformat()
-            tx_["estimation"] = estimation
-        else:
-            tx_["estimation"] = None
-        
-        if tx_.get("timestamp"):
-            tx_["timestamp"] = tx_["timestamp"].isoformat()
+    match = {"user_email": user_id}
+
+    if cursor is not None:
+        # Paginación por cursor: la posición se guarda antes de formatear fechas
+        try:
+            position = decode_cursor(cursor)
+        except ValueError:
+            return INVALID_CURSOR
+        pipeline = [
+            {"$match": keyset_filter(match, NEWEST_FIRST, position)},
+            {"$sort": dict(NEWEST_FIRST)},
+            {"$limit": count + 1},
+            {"$set": {"_cursor": {"timestamp": "$timestamp", "_id": "$_id"}}},
+        ] + TRANSACTION_ESTIMATION_STAGES
+        docs = await (await repo.transactions.aggregate(pipeline)).to_list()
+        transactions, next_cursor = split_page(docs, NEWEST_FIRST, count)
+        if transactions:
+            total_count = await count_cache.count(repo.transactions, match, estimated)
+            return ORJSONResponse({"stocks": JSONRows.from_documents(transactions), "page": page,
+                                   "count": total_count, "next_cursor": next_cursor})
+        return {"error": f"No se encontraron transacciones para el usuario {user_id}."}
+
+    # Página, estimaciones y total en un solo viaje a la base de datos
+    pipeline = [
+        {"$match": match},
+        {"$sort": dict(NEWEST_FIRST)},
+        {"$facet": {
+            "stocks": [{"$skip": skip}, {"$limit": count}] + TRANSACTION_ESTIMATION_STAGES,
+            "total": [{"$count": "count"}],
+        }},
+    ]
+    results = await (await repo.transactions.aggregate(pipeline)).to_list()
+    result = results[0] if results else {"stocks": [], "total": []}
+    transactions = result["stocks"]
 
     if transactions:
-        total_count = transactions_collection.count_documents({"user_email": user_id})
-        return {"stocks": transactions, "page": page, "count": total_count}
+        total_count = result["total"][0]["count"] if result["total"] else 0
+        return ORJSONResponse({"stocks": JSONRows.from_documents(transactions), "page": page, "count": total_count})
     else:
         return {"error": f"No se encontraron transacciones para el usuario {user_id}."}
     
 
 
 @app.get("/transactions/ok")
-def get_transactions_ok(user: Dict = Depends(verify_token), page: int = Query(1, ge=1), count: int = Query(25, ge=1)):
+async def get_transactions_ok(user: Dict = Depends(verify_token), page: int = Query(1, ge=1), count: int = Query(25, ge=1)):
     user_id = user["sub"]
+    count = page_size(count)
     skip = (page - 1) * count
-    transactions = list(
-        transactions_collection.find({"user_email": user_id, "status": "OK"}, {"_id": 0})
+    transactions = await dump_cursor(
+        repo.transactions.find({"user_email": user_id, "status": "OK"}, {"_id": 0})
         .skip(skip)
         .limit(count)
     )
     
     if transactions:
-        return {"transactions": transactions, "page": page, "count": count}
+        return ORJSONResponse({"transactions": transactions, "page": page, "count": count})
     else:
         return {"error": f"No se encontraron transacciones OK para el usuario {user_id}."}
     
 #  ESTO ES NUEVO
 @app.get("/transactions/{request_id}") #FALTA PROBAR
-def get_transaction(request_id: str, user=Depends(verify_token)):
+async def get_transaction(request_id: str, user=Depends(verify_token)):
     user_email = user["sub"]
-    transaction = transactions_collection.find_one({"request_id": request_id, "user_email": user_email})
+    pipeline = [
+        {"$match": {"request_id": request_id, "user_email": user_email}},
+        {"$limit": 1},
+    ] + TRANSACTION_ESTIMATION_STAGES
+    results = await (await repo.transactions.aggregate(pipeline)).to_list()
+    transaction = results[0] if results else None
     if not transaction:
         return {"error": "Transacción no encontrada"}
 
-    estimation = estimations_collection.find_one({"transaction_id": transaction.get("transaction_id")})
- 
-    if transaction.get("timestamp"):
-        transaction["timestamp"] = transaction["timestamp"].isoformat()
+    estimation = transaction.pop("estimation")
 
-    return {
+    return ORJSONResponse({
         "transaction": transaction,
         "estimation": estimation
-    }
+    })
  
 @app.get("/heartbeat") #FUNCIONA
 async def estado_workers():
     try:
         async with httpx.AsyncClient() as client:
-            resp = await client.get("https://iic2175danielaarp.me/heartbeat")
+            with track_outbound("jobmaster"):
+                resp = await client.get(f"{JOBMASTER_URL}/heartbeat")
             if resp.status_code == 200:
                 return resp.json()
             else:
@@ -918,31 +1310,26 @@ async def estado_workers():
 
 
 @app.post("/internal/update_job")
-def update_job(data: dict = Body(...)):
+async def update_job(data: dict = Body(...)):
     #job_id = data.get("job_id")
     result = data.get("result")
     request_id = result.get("request_id")
 
-    print("result:", result)
-    print("estimated_gain:", result.get("estimated_gain"))
-    print("request:_id:", request_id)
+    log.debug("Resultado del JobMaster", extra={"fields": {"request_id": request_id, "result": result}})
 
-    transaction = transactions_collection.find_one({"request_id": request_id})
+    transaction = await repo.find_transaction(request_id)
 
     if not transaction:
-        print(f"⚠️ Request con ID {request_id} no encontrada")
+        log.warning("Request con ID %s no encontrada", request_id)
         return {"error": "REQUEST no encontrada"}
 
     # Actualiza el campo estimated_gain en la transacción
-    update_result = transactions_collection.update_one(
-        {"request_id": request_id},
-        {"$set": {"estimated_gain": result.get("estimated_gain")}}
-    )
+    update_result = await repo.set_transaction_fields(request_id, {"estimated_gain": result.get("estimated_gain")})
 
-    print("Mongo update result:", update_result.modified_count)
+    log.debug("estimated_gain actualizado en %s documentos", update_result.modified_count)
 
     # Inserta también en la colección 'estimations'
-    estimations_collection.insert_one({
+    await repo.estimations.insert_one({
         "transaction_id": transaction.get("transaction_id"),
         "estimated_gain": result.get("estimated_gain"),
         "status": result.get("status"),
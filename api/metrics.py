@@ -0,0 +1,221 @@
+"""Métricas en formato Prometheus.
+
+- Latencia por ruta desde un middleware ASGI (``http_request_duration_seconds``).
+- Latencia de cada comando de MongoDB por colección y operación, con un
+  ``CommandListener`` de pymongo.
+- Publicaciones de MQTT (con su confirmación y reintentos) y latencia de las llamadas HTTP salientes
+  (JobMaster, lambda de boletas, Transbank).
+- Los contadores que ya exponían otros módulos (pool de conexiones, cache de
+  totales, inventario, ...) se registran como colectores que leen su
+  ``stats()`` al momento del scrape.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from pymongo import monitoring
+
+from logs import log_stats
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Tiempo hasta el inicio de la respuesta, por ruta",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+MONGO_COMMAND_DURATION = Histogram(
+    "mongodb_command_duration_seconds",
+    "Latencia de comandos de MongoDB por colección y operación",
+    ["client", "collection", "command"],
+    buckets=LATENCY_BUCKETS,
+)
+MONGO_COMMAND_FAILURES = Counter(
+    "mongodb_command_failures_total",
+    "Comandos de MongoDB que fallaron",
+    ["client", "collection", "command"],
+)
+MQTT_PUBLISHED = Counter("mqtt_messages_published_total", "Mensajes publicados por tópico", ["topic"])
+MQTT_PUBLISH_DURATION = Histogram(
+    "mqtt_publish_duration_seconds",
+    "Duración de client.publish por tópico",
+    ["topic"],
+    buckets=LATENCY_BUCKETS,
+)
+MQTT_PUBLISH_ACK_DURATION = Histogram(
+    "mqtt_publish_ack_duration_seconds",
+    "Tiempo desde la publicación hasta la confirmación del broker, por tópico",
+    ["topic"],
+    buckets=LATENCY_BUCKETS,
+)
+MQTT_REPUBLISHED = Counter("mqtt_messages_republished_total", "Mensajes publicados de nuevo por tópico", ["topic"])
+MQTT_RECEIVED = Counter("mqtt_messages_received_total", "Mensajes recibidos por tópico", ["topic"])
+MQTT_HANDLE_DURATION = Histogram(
+    "mqtt_message_handle_duration_seconds",
+    "Tiempo de procesamiento de un mensaje recibido por tópico",
+    ["topic"],
+    buckets=LATENCY_BUCKETS,
+)
+OUTBOUND_DURATION = Histogram(
+    "outbound_request_duration_seconds",
+    "Latencia de llamadas HTTP a servicios externos",
+    ["target", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+
+# Comandos sin colección (ping, hello, ...) se agrupan aquí
+NO_COLLECTION = "-"
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def __init__(self, client_name):
+        self.client_name = client_name
+        self._lock = threading.Lock()
+        # (request_id, connection_id) -> collection
+        self._in_flight = {}
+
+    @staticmethod
+    def _collection(event):
+        command = event.command
+        if event.command_name == "getMore":
+            return command.get("collection", NO_COLLECTION)
+        target = command.get(event.command_name)
+        return target if isinstance(target, str) else NO_COLLECTION
+
+    def started(self, event):
+        with self._lock:
+            self._in_flight[(event.request_id, event.connection_id)] = self._collection(event)
+
+    def _finish(self, event):
+        with self._lock:
+            collection = self._in_flight.pop((event.request_id, event.connection_id), NO_COLLECTION)
+        return collection
+
+    def succeeded(self, event):
+        collection = self._finish(event)
+        MONGO_COMMAND_DURATION.labels(self.client_name, collection, event.command_name).observe(
+            event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self._finish(event)
+        MONGO_COMMAND_DURATION.labels(self.client_name, collection, event.command_name).observe(
+            event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.labels(self.client_name, collection, event.command_name).inc()
+
+
+@contextmanager
+def track_outbound(target):
+    """Mide una llamada a un servicio externo; ``outcome`` es ok o error."""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        OUTBOUND_DURATION.labels(target, outcome).observe(time.perf_counter() - started)
+
+
+def observe_publish(topic, started):
+    MQTT_PUBLISHED.labels(topic).inc()
+    MQTT_PUBLISH_DURATION.labels(topic).observe(time.perf_counter() - started)
+
+
+def observe_ack(topic, seconds):
+    MQTT_PUBLISH_ACK_DURATION.labels(topic).observe(seconds)
+
+
+def observe_republish(topic):
+    MQTT_REPUBLISHED.labels(topic).inc()
+
+
+@contextmanager
+def track_message(topic):
+    """Cuenta un mensaje recibido y mide su procesamiento."""
+    MQTT_RECEIVED.labels(topic).inc()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        MQTT_HANDLE_DURATION.labels(topic).observe(time.perf_counter() - started)
+
+
+class StatsCollector:
+    """Expone como gauges los valores numéricos de ``stats()`` de un módulo.
+
+    ``stats`` retorna un dict o una lista de dicts; ``label`` indica qué
+    llave de cada dict se usa como etiqueta en el caso de la lista.
+    """
+
+    def __init__(self, prefix, stats, label=None):
+        self.prefix = prefix
+        self.stats = stats
+        self.label = label
+
+    def collect(self):
+        snapshots = self.stats()
+        if isinstance(snapshots, dict):
+            snapshots = [snapshots]
+        families = {}
+        for snapshot in snapshots:
+            labels = [str(snapshot.get(self.label))] if self.label else []
+            for key, value in snapshot.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{self.prefix}_{key}"
+                if name not in families:
+                    families[name] = GaugeMetricFamily(name, f"{self.prefix} {key}",
+                                                       labels=[self.label] if self.label else [])
+                families[name].add_metric(labels, value)
+        return list(families.values())
+
+
+def register_stats(prefix, stats, label=None):
+    REGISTRY.register(StatsCollector(prefix, stats, label))
+
+
+register_stats("logging", log_stats)
+
+
+class MetricsMiddleware:
+    """Middleware ASGI que registra la latencia por plantilla de ruta.
+
+    Se mide hasta el inicio de la respuesta para que los streams (SSE,
+    exportaciones) no cuenten el tiempo que la conexión queda abierta.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        observed = False
+
+        def observe(status):
+            nonlocal observed
+            if observed:
+                return
+            observed = True
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            HTTP_REQUEST_DURATION.labels(scope["method"], path, str(status)).observe(time.perf_counter() - started)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                observe(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            observe(500)
+            raise
+
+
+def render_latest():
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
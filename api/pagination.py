@@ -0,0 +1,96 @@
+"""Paginación por cursor (keyset) para los endpoints de listado.
+
+En lugar de ``.skip((page - 1) * count)``, que recorre todas las filas
+anteriores, el cursor guarda los valores de orden de la última fila entregada
+(por ejemplo ``(timestamp, _id)`` o ``(symbol, _id)``) y la siguiente página
+continúa desde ahí usando el índice. El cursor es opaco para el cliente:
+JSON extendido de BSON codificado en base64 url-safe.
+"""
+import base64
+import binascii
+
+from bson import json_util
+from pymongo import ASCENDING, DESCENDING
+
+# Máximo de elementos por página aceptado por los endpoints de listado
+MAX_PAGE_SIZE = 100
+
+SYMBOL_ORDER = [("symbol", ASCENDING), ("_id", ASCENDING)]
+NEWEST_FIRST = [("timestamp", DESCENDING), ("_id", DESCENDING)]
+
+
+def page_size(count):
+    """Limita el tamaño de página al máximo permitido por el servidor."""
+    return min(count, MAX_PAGE_SIZE)
+
+
+def encode_cursor(position):
+    raw = json_util.dumps(position).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decodifica un cursor; retorna None si es vacío (primera página).
+
+    Lanza ValueError si el cursor no es válido.
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        position = json_util.loads(raw)
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise ValueError("Cursor inválido") from e
+    if not isinstance(position, dict):
+        raise ValueError("Cursor inválido")
+    return position
+
+
+def keyset_filter(query, sort, position):
+    """Agrega a ``query`` la condición para continuar después de ``position``.
+
+    Para un orden ``[(a, 1), (b, 1)]`` genera
+    ``{a > va} OR {a == va AND b > vb}``.
+    """
+    if not position:
+        return query
+    branches = []
+    for i, (field, direction) in enumerate(sort):
+        branch = {prev: position.get(prev) for prev, _ in sort[:i]}
+        branch[field] = {"$gt" if direction == ASCENDING else "$lt": position.get(field)}
+        branches.append(branch)
+    keyset = {"$or": branches}
+    return {"$and": [query, keyset]} if query else keyset
+
+
+def split_page(docs, sort, count):
+    """Separa la página de la fila extra usada para saber si hay más.
+
+    Retorna ``(docs, next_cursor)``; ``next_cursor`` es None en la última
+    página. Si los documentos traen ``_cursor`` se usa como posición (útil
+    cuando una agregación ya formateó los campos de orden).
+    """
+    next_cursor = None
+    if len(docs) > count:
+        last = docs[count - 1]
+        position = last.get("_cursor") or {field: last.get(field) for field, _ in sort}
+        next_cursor = encode_cursor(position)
+    docs = docs[:count]
+    for doc in docs:
+        doc.pop("_cursor", None)
+    return docs, next_cursor
+
+
+async def keyset_page(collection, query, sort, position, count, projection=None):
+    """Obtiene una página ordenada por ``sort`` a partir de ``position``.
+
+    Retorna ``(docs, next_cursor)``. ``_id`` se usa para el orden y no se
+    incluye en los documentos.
+    """
+    projection = {k: v for k, v in (projection or {}).items() if k != "_id"} or None
+    cursor = collection.find(keyset_filter(query, sort, position), projection).sort(sort).limit(count + 1)
+    docs = await cursor.to_list()
+    docs, next_cursor = split_page(docs, sort, count)
+    for doc in docs:
+        doc.pop("_id", None)
+    return docs, next_cursor
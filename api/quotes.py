@@ -0,0 +1,134 @@
+"""Tabla en memoria con la última cotización de cada símbolo.
+
+La API lee precio y cantidad de ``current_stocks`` en cada compra y en el
+detalle de un stock. Esta tabla se precarga desde ``current_stocks`` al
+iniciar y se mantiene con la suscripción de la API a ``stocks/updates``, así
+esas lecturas no van a MongoDB. La cantidad también cambia por las compras
+que procesa ``broker_requests``: un mensaje en ``stocks/requests`` marca el
+símbolo como vencido y ninguna cotización se usa pasado
+``QUOTE_MAX_AGE_SECONDS``; en ambos casos se vuelve a leer de MongoDB.
+"""
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from dateutil import parser
+
+QUOTE_MAX_AGE = float(os.getenv("QUOTE_MAX_AGE_SECONDS", "10"))
+
+
+class Quote:
+    __slots__ = ("symbol", "price", "quantity", "long_name", "timestamp", "owner_type", "refreshed_at")
+
+    def __init__(self, symbol, price, quantity, long_name=None, timestamp=None, owner_type=None, refreshed_at=None):
+        self.symbol = symbol
+        self.price = price
+        self.quantity = quantity
+        self.long_name = long_name
+        self.timestamp = timestamp
+        self.owner_type = owner_type
+        self.refreshed_at = time.monotonic() if refreshed_at is None else refreshed_at
+
+    @classmethod
+    def from_document(cls, doc):
+        return cls(doc["symbol"], doc.get("price"), doc.get("quantity", 0), doc.get("longName"),
+                   doc.get("timestamp"), doc.get("owner_type"))
+
+    def as_document(self):
+        """Mismos campos que el documento de ``current_stocks``."""
+        return {
+            "symbol": self.symbol,
+            "quantity": self.quantity,
+            "price": self.price,
+            "longName": self.long_name,
+            "timestamp": self.timestamp,
+            "owner_type": self.owner_type,
+        }
+
+
+class QuoteTable:
+    def __init__(self, max_age=QUOTE_MAX_AGE):
+        self.max_age = max_age
+        # Las lecturas no toman el lock: cada cambio reemplaza el Quote completo
+        self._quotes = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+        self.warmed_at = None
+
+    def warm(self, collection):
+        """Carga todas las cotizaciones desde ``current_stocks``."""
+        quotes = {}
+        for doc in collection.find({}, {"_id": 0, "symbol": 1, "price": 1, "quantity": 1,
+                                         "longName": 1, "timestamp": 1, "owner_type": 1}):
+            if doc.get("symbol"):
+                quotes[doc["symbol"]] = Quote.from_document(doc)
+        with self._lock:
+            self._quotes = quotes
+            self.warmed_at = datetime.now(timezone.utc).isoformat()
+
+    def get(self, symbol):
+        """Cotización vigente del símbolo o None si falta o está vencida."""
+        quote = self._quotes.get(symbol)
+        if quote is None or time.monotonic() - quote.refreshed_at > self.max_age:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return quote
+
+    def put_document(self, doc):
+        """Guarda un documento recién leído de MongoDB."""
+        with self._lock:
+            self._quotes[doc["symbol"]] = Quote.from_document(doc)
+
+    def invalidate(self, symbol):
+        with self._lock:
+            self._quotes.pop(symbol, None)
+
+    def apply_update(self, data):
+        """Aplica un mensaje de ``stocks/updates`` igual que broker_updates."""
+        kind = data.get("kind")
+        symbol = data.get("symbol")
+        if not symbol or kind not in ("IPO", "EMIT", "UPDATE"):
+            return
+        timestamp = data.get("timestamp")
+        if isinstance(timestamp, str):
+            try:
+                timestamp = parser.isoparse(timestamp)
+            except ValueError:
+                timestamp = None
+        with self._lock:
+            current = self._quotes.get(symbol)
+            if kind == "IPO":
+                quote = Quote(symbol, data.get("price", 0), data.get("quantity", 0), data.get("longName"),
+                              timestamp, "platform")
+            elif current is None:
+                # Sin la cantidad actual no se puede aplicar EMIT/UPDATE; se
+                # leerá de MongoDB cuando se pida
+                return
+            elif kind == "EMIT":
+                quote = Quote(symbol, data.get("price", 0), current.quantity + float(data.get("quantity", 0)),
+                              current.long_name, timestamp, "platform")
+            else:
+                quote = Quote(symbol, data.get("price", 0), current.quantity, current.long_name,
+                              timestamp, "platform")
+            self._quotes[symbol] = quote
+            self.updates += 1
+
+    def apply_request(self, data):
+        """Un mensaje de ``stocks/requests`` cambiará la cantidad del símbolo."""
+        symbol = data.get("symbol")
+        if symbol:
+            self.invalidate(symbol)
+
+    def stats(self):
+        return {
+            "size": len(self._quotes),
+            "hits": self.hits,
+            "misses": self.misses,
+            "updates": self.updates,
+            "max_age_seconds": self.max_age,
+            "warmed_at": self.warmed_at,
+        }
@@ -0,0 +1,312 @@
+"""Boletas de compra generadas por la API.
+
+``commit_transaction`` no espera la boleta: ``ReceiptService.submit`` calcula
+la llave de la boleta y retorna su URL de inmediato, y la boleta se genera
+en un pool de procesos y se guarda en el almacenamiento configurado.
+
+La llave es el SHA-256 de los datos de la boleta (más el formato), así que
+la misma compra siempre tiene la misma URL. Un ``commit_transaction``
+reintentado no vuelve a generarla: el servicio recuerda las llaves ya
+enviadas y el proceso que genera revisa primero si el archivo existe, lo que
+también cubre reinicios y varias réplicas de la API con el mismo
+almacenamiento.
+
+Configuración:
+
+- ``RECEIPT_FORMAT``: ``pdf`` (por defecto) o ``html``.
+- ``RECEIPT_STORE``: directorio local (``receipts``) o ``s3://bucket/prefijo``
+  para un almacenamiento compatible con S3 (requiere ``boto3``;
+  ``RECEIPT_S3_ENDPOINT_URL`` para MinIO u otro proveedor).
+- ``RECEIPT_PUBLIC_URL``: base de las URLs. Con un directorio local las
+  boletas se sirven en ``/receipts/{llave}`` de la API.
+- ``RECEIPT_WORKERS``: procesos que generan boletas (2).
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from html import escape
+from importlib.util import find_spec
+
+from logs import get_logger
+
+log = get_logger("receipts")
+
+RECEIPT_FORMAT = os.getenv("RECEIPT_FORMAT", "pdf")
+RECEIPT_STORE = os.getenv("RECEIPT_STORE", "receipts")
+RECEIPT_PUBLIC_URL = os.getenv("RECEIPT_PUBLIC_URL", "")
+RECEIPT_S3_ENDPOINT_URL = os.getenv("RECEIPT_S3_ENDPOINT_URL") or None
+RECEIPT_WORKERS = int(os.getenv("RECEIPT_WORKERS", "2"))
+# Llaves recordadas en memoria para no volver a enviarlas al pool
+RECEIPT_CACHE_ENTRIES = int(os.getenv("RECEIPT_CACHE_ENTRIES", "10000"))
+
+MEDIA_TYPES = {"pdf": "application/pdf", "html": "text/html; charset=utf-8"}
+
+
+def receipt_data(request_id, email, symbol, quantity, total, buy_order=None):
+    """Datos de la boleta; solo campos que no cambian entre reintentos."""
+    return {
+        "request_id": request_id,
+        "email": email,
+        "symbol": symbol,
+        "quantity": quantity,
+        "total": total,
+        "buy_order": buy_order,
+    }
+
+
+def receipt_key(data, fmt=RECEIPT_FORMAT):
+    canonical = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str)
+    digest = hashlib.sha256(f"{fmt}:{canonical}".encode("utf-8")).hexdigest()
+    return f"{digest}.{fmt}"
+
+
+def _lines(data):
+    return [
+        f"Orden: {data['buy_order'] or data['request_id']}",
+        f"Solicitud: {data['request_id']}",
+        f"Cliente: {data['email']}",
+        f"Acción: {data['symbol']}",
+        f"Cantidad: {data['quantity']}",
+        f"Total: ${data['total']}",
+    ]
+
+
+def render_html(data):
+    rows = "".join(f"<li>{escape(line)}</li>" for line in _lines(data))
+    return (
+        "<!DOCTYPE html><html lang=\"es\"><head><meta charset=\"utf-8\"><title>Boleta de compra</title></head>"
+        f"<body><h1>Boleta de compra</h1><ul>{rows}</ul></body></html>"
+    ).encode("utf-8")
+
+
+def _pdf_string(text):
+    text = text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    return b"(" + text.encode("cp1252", "replace") + b")"
+
+
+def render_pdf(data):
+    """PDF de una página con Helvetica; no necesita librerías externas."""
+    content = b"BT /F1 18 Tf 72 740 Td 22 TL " + _pdf_string("Boleta de compra") + b" Tj /F1 12 Tf"
+    for line in _lines(data):
+        content += b" " + _pdf_string(line) + b" '"
+    content += b" ET"
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+        b"/Resources << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content),
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+RENDERERS = {"pdf": render_pdf, "html": render_html}
+
+
+class LocalStore:
+    """Boletas en un directorio, servidas por la API."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, os.path.basename(key))
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def put(self, key, body, media_type):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        # Se escribe aparte y se renombra: nunca se sirve una boleta a medias
+        partial = f"{path}.{os.getpid()}.tmp"
+        with open(partial, "wb") as f:
+            f.write(body)
+        os.replace(partial, path)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def public_url(self):
+        return "/receipts"
+
+
+class S3Store:
+    """Boletas en un bucket compatible con S3. El cliente se crea en cada proceso."""
+
+    def __init__(self, bucket, prefix="", endpoint_url=None):
+        if find_spec("boto3") is None:
+            raise RuntimeError("RECEIPT_STORE usa S3 pero boto3 no está instalado")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.endpoint_url = endpoint_url
+        self._client = None
+
+    def __getstate__(self):
+        # El cliente no se pasa a los procesos del pool
+        return {**self.__dict__, "_client": None}
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client("s3", endpoint_url=self.endpoint_url)
+        return self._client
+
+    def _name(self, key):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._name(key))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    def put(self, key, body, media_type):
+        self.client.put_object(Bucket=self.bucket, Key=self._name(key), Body=body, ContentType=media_type)
+
+    def get(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._name(key))["Body"].read()
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def public_url(self):
+        base = (self.endpoint_url.rstrip("/") + f"/{self.bucket}" if self.endpoint_url
+                else f"https://{self.bucket}.s3.amazonaws.com")
+        return f"{base}/{self.prefix}" if self.prefix else base
+
+
+def open_store(location=RECEIPT_STORE, endpoint_url=RECEIPT_S3_ENDPOINT_URL):
+    if location.startswith("s3://"):
+        bucket, _, prefix = location[len("s3://"):].partition("/")
+        return S3Store(bucket, prefix, endpoint_url)
+    return LocalStore(location)
+
+
+def render_to_store(store, key, data, fmt):
+    """Corre en un proceso del pool; retorna False si la boleta ya existía."""
+    if store.exists(key):
+        return False
+    store.put(key, RENDERERS[fmt](data), MEDIA_TYPES[fmt])
+    return True
+
+
+class ReceiptService:
+    def __init__(self, store=None, fmt=RECEIPT_FORMAT, public_url=RECEIPT_PUBLIC_URL, workers=RECEIPT_WORKERS,
+                 cache_entries=RECEIPT_CACHE_ENTRIES):
+        if fmt not in RENDERERS:
+            raise ValueError(f"Formato de boleta no soportado: {fmt}")
+        self.store = store or open_store()
+        self.fmt = fmt
+        self.public_url = (public_url or self.store.public_url()).rstrip("/")
+        self.workers = max(1, workers)
+        self.cache_entries = max(1, cache_entries)
+        # llave -> Future mientras se genera, None cuando ya está guardada
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = None
+        self.submitted = 0
+        self.cached = 0
+        self.rendered = 0
+        self.already_stored = 0
+        self.failed = 0
+        self.last_render_seconds = 0.0
+
+    def url_for(self, key):
+        return f"{self.public_url}/{key}"
+
+    def _executor(self):
+        if self._pool is None:
+            # spawn: los procesos no heredan los hilos ni los sockets de la API
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def submit(self, data):
+        """Encola la boleta si hace falta y retorna su URL."""
+        key = receipt_key(data, self.fmt)
+        with self._lock:
+            if key in self._keys:
+                self.cached += 1
+                self._keys.move_to_end(key)
+                return self.url_for(key)
+            self.submitted += 1
+            started = time.perf_counter()
+            future = self._executor().submit(render_to_store, self.store, key, data, self.fmt)
+            self._keys[key] = future
+        future.add_done_callback(lambda done: self._finished(key, done, started))
+        return self.url_for(key)
+
+    def _finished(self, key, future, started):
+        with self._lock:
+            self.last_render_seconds = time.perf_counter() - started
+            try:
+                created = future.result()
+            except Exception as e:
+                # Se olvida la llave para que un reintento la vuelva a generar
+                self.failed += 1
+                self._keys.pop(key, None)
+                log.error("No se pudo generar la boleta %s: %s", key, e)
+                return
+            if created:
+                self.rendered += 1
+            else:
+                self.already_stored += 1
+            if key in self._keys:
+                self._keys[key] = None
+            while len(self._keys) > self.cache_entries:
+                oldest = next(iter(self._keys))
+                if self._keys[oldest] is not None:
+                    break
+                del self._keys[oldest]
+
+    def pending(self):
+        with self._lock:
+            return [future for future in self._keys.values() if future is not None]
+
+    def close(self, wait=True):
+        """Espera las boletas en curso y detiene el pool."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
+
+    def stats(self):
+        with self._lock:
+            in_progress = sum(1 for future in self._keys.values() if future is not None)
+            return {
+                "submitted": self.submitted,
+                "cached": self.cached,
+                "rendered": self.rendered,
+                "already_stored": self.already_stored,
+                "failed": self.failed,
+                "in_progress": in_progress,
+                "last_render_seconds": self.last_render_seconds,
+            }
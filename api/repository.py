@@ -0,0 +1,43 @@
+"""Capa de acceso a datos asíncrona de la API.
+
+Agrupa las colecciones de ``stocks_db`` sobre el cliente asíncrono de
+pymongo para que los handlers no bloqueen el event loop, junto con las
+operaciones que se repiten entre handlers.
+"""
+from datetime import datetime
+
+
+class Repository:
+    def __init__(self, db):
+        self.db = db
+        self.stocks = db["current_stocks"]
+        self.transactions = db["transactions"]
+        # Stocks compradas por los administradores
+        self.admin_transactions = db["admin_transactions"]
+        # Ofertas de subastas
+        self.auction_offers = db["auction_offers"]
+        self.users = db["users"]
+        self.event_log = db["event_log"]
+        self.estimations = db["estimations"]
+        # Velas OHLCV que mantiene broker_updates
+        self.candles = db["candles"]
+
+    async def find_stock(self, symbol):
+        return await self.stocks.find_one({"symbol": symbol})
+
+    async def find_user(self, correo):
+        return await self.users.find_one({"correo": correo})
+
+    async def find_transaction(self, request_id):
+        return await self.transactions.find_one({"request_id": request_id})
+
+    async def set_transaction_fields(self, request_id, fields):
+        return await self.transactions.update_one({"request_id": request_id}, {"$set": fields})
+
+    async def update_admin_inventory(self, symbol, quantity_change):
+        """Ajusta el inventario del administrador (lo crea si no existe)."""
+        return await self.admin_transactions.update_one(
+            {"symbol": symbol},
+            {"$inc": {"quantity": quantity_change}, "$set": {"timestamp": datetime.utcnow()}},
+            upsert=True
+        )
@@ -0,0 +1,61 @@
+"""Respuestas JSON serializadas con orjson.
+
+``ORJSONResponse`` es la respuesta por defecto de la app y serializa
+``datetime`` y ``ObjectId`` sin pasar por ``jsonable_encoder``. Los
+endpoints de listado la retornan directamente con un ``JSONRows``: cada
+documento se serializa apenas sale del cursor y la respuesta solo junta los
+bytes, sin copias intermedias de los documentos.
+"""
+import orjson
+from bson import Decimal128, ObjectId
+from starlette.responses import JSONResponse
+
+
+class JSONRows:
+    """Filas ya serializadas de una página."""
+
+    __slots__ = ("_chunks",)
+
+    def __init__(self, chunks=None):
+        self._chunks = chunks if chunks is not None else []
+
+    @classmethod
+    def from_documents(cls, docs, transform=None):
+        if transform is not None:
+            docs = map(transform, docs)
+        return cls([dumps(doc) for doc in docs])
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def fragment(self):
+        return orjson.Fragment(b"[" + b",".join(self._chunks) + b"]")
+
+
+def _default(value):
+    if isinstance(value, JSONRows):
+        return value.fragment()
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return str(value.to_decimal())
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def dumps(content):
+    return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+async def dump_cursor(cursor, transform=None):
+    """Serializa los documentos de un cursor asíncrono a medida que llegan.
+
+    ``transform`` permite completar cada documento antes de serializarlo.
+    """
+    if transform is None:
+        return JSONRows([dumps(doc) async for doc in cursor])
+    return JSONRows([dumps(transform(doc)) async for doc in cursor])
+
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content):
+        return dumps(content)
@@ -1,3 +1,5 @@
+import pytest
+
 from main import build_stocks_query
 
 def test_price_range():
@@ -12,3 +14,538 @@ def test_symbol_prefix():
     query = build_stocks_query(symbol="AAPL")
     assert "symbol" in query
     assert query["symbol"] == {"$regex": "^AAPL", "$options": "i"}
+
+def test_plan_stages_detects_collscan():
+    # Prueba que la auditoría encuentra un COLLSCAN anidado en el plan ganador
+    from indexes import _plan_stages
+    plan = {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}
+    assert _plan_stages(plan) == ["SORT", "COLLSCAN"]
+
+def test_inventory_snapshot_applies_changes():
+    # Prueba que el snapshot aplica inserciones y eliminaciones del change stream
+    from inventory import InventorySnapshot
+    snapshot = InventorySnapshot()
+    snapshot.apply_change({"operationType": "insert", "documentKey": {"_id": 1},
+                           "fullDocument": {"_id": 1, "symbol": "AAPL", "quantity": 5, "price": 10.0}})
+    assert snapshot.quantities() == {"AAPL": 5}
+    snapshot.apply_change({"operationType": "delete", "documentKey": {"_id": 1}})
+    assert snapshot.quantities() == {}
+    assert snapshot.version == 2
+
+def test_keyset_cursor_roundtrip():
+    # Prueba que el cursor opaco conserva fechas y ObjectId y arma el filtro keyset
+    from datetime import datetime
+    from bson import ObjectId
+    from pagination import NEWEST_FIRST, decode_cursor, encode_cursor, keyset_filter
+    position = {"timestamp": datetime(2024, 5, 1, 12, 0), "_id": ObjectId()}
+    assert decode_cursor(encode_cursor(position)) == position
+    query = keyset_filter({"symbol": "AAPL"}, NEWEST_FIRST, position)
+    assert query == {"$and": [{"symbol": "AAPL"}, {"$or": [
+        {"timestamp": {"$lt": position["timestamp"]}},
+        {"timestamp": position["timestamp"], "_id": {"$lt": position["_id"]}},
+    ]}]}
+
+@pytest.mark.asyncio
+async def test_count_cache_invalidates_on_version_bump():
+    # Prueba que el total cacheado se recalcula cuando cambia la versión de la colección
+    from count_cache import CountCache
+
+    class FakeCollection:
+        def __init__(self, name):
+            self.name = name
+            self.calls = 0
+            self.doc = None
+
+        async def count_documents(self, query, **kwargs):
+            self.calls += 1
+            return 42
+
+        async def find_one(self, query):
+            return dict(self.doc) if self.doc else None
+
+    versions = FakeCollection("collection_versions")
+    events = FakeCollection("event_log")
+    cache = CountCache({"collection_versions": versions}, ttl=60, version_refresh=0)
+    assert await cache.count(events, {"symbol": "AAPL"}) == 42
+    assert await cache.count(events, {"symbol": "AAPL"}) == 42
+    assert events.calls == 1
+    versions.doc = {"_id": "stocks_db", "event_log": 1}
+    await cache.count(events, {"symbol": "AAPL"})
+    assert events.calls == 2
+
+def test_pool_metrics_tracks_wait_and_churn():
+    # Prueba que el listener del pool acumula espera de checkout y conexiones abiertas
+    from types import SimpleNamespace
+    from database import PoolMetrics
+    metrics = PoolMetrics("test")
+    metrics.connection_created(SimpleNamespace())
+    metrics.connection_checked_out(SimpleNamespace(duration=0.002))
+    stats = metrics.snapshot()
+    assert stats["pool_size"] == 1
+    assert stats["in_use"] == 1
+    assert stats["wait_seconds_buckets"]["0.005"] == 1
+
+def test_verified_token_cache_expires_and_registry_refreshes_once():
+    # Prueba que los tokens vencidos salen del cache y que un kid desconocido refresca una sola vez
+    import time
+    from auth import JWKSRegistry, VerifiedTokenCache
+    cache = VerifiedTokenCache(max_entries=1)
+    cache.put("a", {"sub": "1", "exp": time.time() + 60})
+    cache.put("b", {"sub": "2", "exp": time.time() - 1})
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+
+    fetches = []
+    registry = JWKSRegistry(fetch=lambda: fetches.append(1) or {"keys": []}, min_refresh_interval=60)
+    assert registry.get("desconocido") is None
+    assert registry.get("desconocido") is None
+    assert len(fetches) == 1
+
+@pytest.mark.asyncio
+async def test_export_streams_parallel_ranges_in_order():
+    # Prueba que los sub-rangos en paralelo se entregan en orden cronológico y comprimidos
+    import gzip
+    import json
+    from datetime import datetime, timedelta
+    import export
+
+    start = datetime(2024, 1, 1)
+    rows = [{"symbol": "AAPL", "price": i, "timestamp": start + timedelta(hours=i)} for i in range(50)]
+
+    class FakeCursor:
+        def __init__(self, docs):
+            self.docs = docs
+
+        def sort(self, sort):
+            self.docs = sorted(self.docs, key=lambda doc: doc["timestamp"])
+            return self
+
+        def __aiter__(self):
+            return self._iter()
+
+        async def _iter(self):
+            for doc in self.docs:
+                yield dict(doc)
+
+    class FakeCollection:
+        def find(self, query, projection=None, **kwargs):
+            bounds = query["timestamp"]
+            upper = bounds.get("$lte", bounds.get("$lt"))
+            return FakeCursor([doc for doc in rows if bounds["$gte"] <= doc["timestamp"]
+                               and (doc["timestamp"] <= upper if "$lte" in bounds else doc["timestamp"] < upper)])
+
+    query = {"timestamp": {"$gte": start, "$lte": start + timedelta(hours=49)}}
+    queries = export.plan_queries(query, 4)
+    assert len(queries) == 4
+    # Sin ambos límites no se divide: no se pierden filas sin fecha
+    assert export.plan_queries({"timestamp": {"$gte": start}}, 4) == [{"timestamp": {"$gte": start}}]
+    assert export.plan_queries({"symbol": "AAPL"}, 4) == [{"symbol": "AAPL"}]
+    body = b"".join([chunk async for chunk in export.stream_export(
+        FakeCollection(), queries, export.EVENT_LOG_COLUMNS, "ndjson", gzip=True)])
+    prices = [json.loads(line)["price"] for line in gzip.decompress(body).splitlines()]
+    assert prices == list(range(50))
+
+def test_quote_table_applies_updates_and_expires():
+    # Prueba que stocks/updates actualiza la cotización y que una vencida obliga a leer MongoDB
+    from quotes import QuoteTable
+    table = QuoteTable(max_age=60)
+    table.apply_update({"kind": "UPDATE", "symbol": "AAPL", "price": 10})
+    assert table.get("AAPL") is None
+    table.apply_update({"kind": "IPO", "symbol": "AAPL", "price": 10, "quantity": 5, "longName": "Apple"})
+    table.apply_update({"kind": "EMIT", "symbol": "AAPL", "price": 12, "quantity": 3})
+    assert table.get("AAPL").as_document()["quantity"] == 8
+    assert table.get("AAPL").price == 12
+    table.apply_request({"symbol": "AAPL", "quantity": 1})
+    assert table.get("AAPL") is None
+
+@pytest.mark.asyncio
+async def test_broadcaster_coalesces_and_filters_by_owner(monkeypatch):
+    # Prueba que una ráfaga del mismo símbolo se envía una vez y que solo llegan las transacciones propias
+    import live
+    monkeypatch.setattr(live, "COALESCE_WINDOW", 0)
+    prices = live.Broadcaster("price")
+    subscriber = prices.subscribe(keys=["AAPL"])
+    stream = prices.stream(subscriber)
+    assert await stream.__anext__() == "retry: 3000\n\n"
+    for price in (10, 11, 12):
+        prices.publish("AAPL", {"symbol": "AAPL", "price": price})
+    prices.publish("MSFT", {"symbol": "MSFT", "price": 1})
+    event = await stream.__anext__()
+    assert '"price": 12' in event and "MSFT" not in event
+    assert subscriber.pending == {}
+    await stream.aclose()
+    assert prices.subscriber_count() == 0
+
+    transactions = live.Broadcaster("transaction")
+    mine = transactions.subscribe(owner="user-1")
+    transactions.publish("r1", {"status": "OK"}, owner="user-2")
+    assert mine.pending == {}
+    transactions.publish("r2", {"status": "OK"}, owner="user-1")
+    assert mine.pending == {"r2": {"status": "OK"}}
+
+def test_orjson_rows_serialize_dates_and_object_ids():
+    # Prueba que las filas serializadas se insertan tal cual y que fechas y ObjectId se convierten
+    import json
+    from datetime import datetime
+    from bson import ObjectId
+    from responses import JSONRows, dumps
+    oid = ObjectId()
+    rows = JSONRows.from_documents([{"_id": oid, "timestamp": datetime(2024, 1, 1, 12, 30)}])
+    body = json.loads(dumps({"event_log": rows, "count": len(rows)}))
+    assert body == {"event_log": [{"_id": str(oid), "timestamp": "2024-01-01T12:30:00"}], "count": 1}
+
+def test_log_handler_samples_and_never_blocks():
+    # Prueba que el muestreo descarta mensajes de la categoría y que una cola llena no bloquea
+    import logging
+    import queue
+    from logs import NonBlockingQueueHandler, SamplingFilter
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=1))
+    handler.addFilter(SamplingFilter({"mqtt.message": 0.0}))
+
+    def record(name, level=logging.INFO):
+        return logging.LogRecord(f"stocks.{name}", level, __file__, 1, "msg %s", (1,), None)
+
+    handler.handle(record("mqtt.message"))
+    handler.handle(record("mqtt.message", logging.ERROR))
+    handler.handle(record("auth"))
+    assert handler.queue.get_nowait().getMessage() == "msg 1"
+    assert handler.dropped == 1
+
+def test_metrics_label_routes_by_template():
+    # Prueba que la latencia se registra con la plantilla de la ruta y que los stats se exponen como gauges
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from metrics import MetricsMiddleware, StatsCollector, render_latest
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/metrics-test/{symbol}")
+    async def detail(symbol: str):
+        return {"symbol": symbol}
+
+    client = TestClient(app)
+    assert client.get("/metrics-test/AAPL").status_code == 200
+    body = render_latest()[0].decode()
+    assert 'route="/metrics-test/{symbol}"' in body and "AAPL" not in body
+
+    collector = StatsCollector("pool", lambda: [{"client": "sync", "in_use": 3, "mode": "x"}], label="client")
+    (family,) = collector.collect()
+    assert family.name == "pool_in_use" and family.samples[0].labels == {"client": "sync"}
+
+def test_transbank_host_transaction_against_bench_stub():
+    # Prueba que create y commit de Webpay funcionan contra el stub local de los benchmarks
+    from benchmarks.stubs import StubServer
+    from transbank.common.integration_api_keys import IntegrationApiKeys
+    from transbank.common.integration_commerce_codes import IntegrationCommerceCodes
+    from transbank.common.integration_type import IntegrationType
+    from transbank.common.options import WebpayOptions
+    from utils.transbank import HostTransaction
+    stub = StubServer(issuer=None).start()
+    try:
+        options = WebpayOptions(IntegrationCommerceCodes.WEBPAY_PLUS, IntegrationApiKeys.WEBPAY, IntegrationType.TEST)
+        transaction = HostTransaction(options, stub.url)
+        created = transaction.create("order-1", "stocks_buy", 1500, "http://localhost/payment")
+        committed = transaction.commit(created["token"])
+        assert committed["response_code"] == 0 and committed["amount"] == 1500
+        assert committed["buy_order"] == "order-1"
+        assert stub.hits["webpay_create"] == stub.hits["webpay_commit"] == 1
+    finally:
+        stub.stop()
+
+@pytest.mark.asyncio
+async def test_wallet_post_is_idempotent_per_request_id():
+    # Prueba que un request_id repetido no vuelve a mover el saldo, que completa un movimiento
+    # interrumpido y que un cargo con mínimo no deja el saldo negativo
+    from types import SimpleNamespace
+    from wallet import APPLIED_FIELD, DEPOSIT, PURCHASE, Wallet
+
+    class FakeLedger:
+        def __init__(self):
+            self.entries = {}
+            self.fail_next = False
+
+        async def update_one(self, query, update, upsert=False):
+            if self.fail_next:
+                self.fail_next = False
+                raise ConnectionError("caída entre escrituras")
+            if query["request_id"] in self.entries:
+                return SimpleNamespace(upserted_id=None)
+            self.entries[query["request_id"]] = update["$setOnInsert"]
+            return SimpleNamespace(upserted_id=len(self.entries))
+
+    class FakeUsers:
+        def __init__(self):
+            self.user = None
+
+        async def find_one(self, query, projection=None):
+            if self.user is None:
+                return None
+            request_id = projection[APPLIED_FIELD]["$elemMatch"]["$eq"]
+            return {"saldo": self.user["saldo"],
+                    APPLIED_FIELD: [r for r in self.user[APPLIED_FIELD] if r == request_id]}
+
+        async def insert_one(self, document):
+            self.user = dict(document)
+
+        async def find_one_and_update(self, query, update, **kwargs):
+            user = self.user
+            if user is None or query[APPLIED_FIELD]["$ne"] in user[APPLIED_FIELD]:
+                return None
+            if "saldo" in query and user["saldo"] < query["saldo"]["$gte"]:
+                return None
+            before = {"saldo": user["saldo"]}
+            user["saldo"] += update["$inc"]["saldo"]
+            user[APPLIED_FIELD] += update["$push"][APPLIED_FIELD]["$each"]
+            return before
+
+    wallet = Wallet({"wallet_ledger": FakeLedger(), "users": FakeUsers()})
+    assert await wallet.post("a@b.cl", 100, "r1", DEPOSIT) == {
+        "balance": 100, "applied": True, "created": True, "insufficient": False}
+    assert (await wallet.post("a@b.cl", 100, "r1", DEPOSIT))["applied"] is False
+    assert (await wallet.post("a@b.cl", 50, "r2", DEPOSIT))["balance"] == 150
+
+    # Caída después del $inc: el reintento no vuelve a abonar y registra el movimiento
+    wallet.ledger.fail_next = True
+    with pytest.raises(ConnectionError):
+        await wallet.post("a@b.cl", 10, "r3", DEPOSIT)
+    retry = await wallet.post("a@b.cl", 10, "r3", DEPOSIT)
+    assert retry["applied"] is False and retry["balance"] == 160
+    assert "r3" in wallet.ledger.entries
+
+    debit = await wallet.post("a@b.cl", -500, "r4", PURCHASE, minimum=500)
+    assert debit["insufficient"] and wallet.users.user["saldo"] == 160
+    assert "r4" not in wallet.ledger.entries
+    assert len(wallet.ledger.entries) == 3
+
+def test_outbound_publisher_acks_and_republishes():
+    # Prueba que el publicador confirma con wait_for_publish y republica lo que no se confirma
+    import time
+    from paho.mqtt.client import MQTTMessageInfo
+    from buy_requests.publisher import OutboundPublisher
+
+    class FakeClient:
+        def __init__(self):
+            self.sent = []
+
+        def is_connected(self):
+            return True
+
+        def publish(self, topic, data, qos=0):
+            info = MQTTMessageInfo(len(self.sent) + 1)
+            info.rc = 0
+            if topic == "ok":
+                info._set_as_published()
+            self.sent.append((topic, data))
+            return info
+
+    client = FakeClient()
+    publisher = OutboundPublisher(client, window=2, ack_timeout=0.05, retries=1, retry_delay=0).start()
+    assert publisher.enqueue("ok", {"a": 1}, 1) and publisher.enqueue("lost", {"b": 2}, 1)
+    deadline = time.monotonic() + 5
+    while publisher.failed == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    publisher.close()
+    stats = publisher.stats()
+    assert stats["acked"] == 1 and stats["republished"] == 1 and stats["failed"] == 1
+    assert client.sent[0] == ("ok", '{"a": 1}') and [t for t, _ in client.sent].count("lost") == 2
+
+def test_jobmaster_client_retries_with_backoff_and_dead_letters():
+    # Prueba el cliente del JobMaster contra el stub local y el resultado que se guarda en el outbox
+    from datetime import datetime
+    import requests
+    from benchmarks.stubs import StubServer
+    from jobs import DEAD, PENDING, SENT, JobMasterClient, result_operation
+    stub = StubServer(issuer=None).start()
+    stub.job_failures = 1
+    client = JobMasterClient(stub.url, timeout=2)
+    try:
+        with pytest.raises(requests.HTTPError):
+            client.submit({"request_id": "r1"})
+        assert client.submit({"request_id": "r1"})
+        assert stub.hits["jobmaster_job_failed"] == stub.hits["jobmaster_job"] == 1
+    finally:
+        client.close()
+        stub.stop()
+
+    now = datetime(2024, 1, 1)
+    job = {"_id": 1, "claim": "c", "attempts": 0}
+    retry = result_operation(job, error="503", now=now, max_attempts=3)._doc["$set"]
+    assert retry["status"] == PENDING and retry["next_attempt_at"] > now
+    assert result_operation(dict(job, attempts=2), error="503", now=now, max_attempts=3)._doc["$set"]["status"] == DEAD
+    assert result_operation(job, job_id="j1", now=now)._doc["$set"]["status"] == SENT
+
+    # El lease cubre un lote completo: 50 envíos de a 4 con timeout de 5 s
+    from jobs import JobDispatcher
+    dispatcher = JobDispatcher(JobMasterClient(stub.url, timeout=5), batch_size=50, concurrency=4)
+    assert dispatcher.lease_seconds > 13 * 5
+    dispatcher.client.close()
+
+def test_receipts_are_rendered_once_per_content(tmp_path):
+    # La URL se asigna antes de generar y la misma compra reutiliza la boleta guardada
+    from receipts import LocalStore, ReceiptService, receipt_data, receipt_key
+    data = receipt_data("r1", "a@b.cl", "AAPL", 2, 1500, "bo-1")
+    service = ReceiptService(LocalStore(str(tmp_path)), fmt="pdf", public_url="https://api.test/receipts/", workers=1)
+    try:
+        url = service.submit(data)
+        assert url == f"https://api.test/receipts/{receipt_key(data, 'pdf')}"
+        assert service.submit(dict(data)) == url
+        for future in service.pending():
+            future.result(timeout=60)
+    finally:
+        service.close()
+    body = LocalStore(str(tmp_path)).get(url.rpartition("/")[2])
+    assert body.startswith(b"%PDF-") and b"AAPL" in body
+
+    # Después de un reinicio la boleta ya existe y no se vuelve a generar
+    restarted = ReceiptService(LocalStore(str(tmp_path)), fmt="pdf", public_url="https://api.test/receipts", workers=1)
+    try:
+        assert restarted.submit(data) == url
+        for future in restarted.pending():
+            future.result(timeout=60)
+    finally:
+        restarted.close()
+    assert service.stats()["rendered"] == 1 and service.stats()["cached"] == 1
+    assert restarted.stats()["already_stored"] == 1 and restarted.stats()["rendered"] == 0
+    assert receipt_key(dict(data, total=1600), "pdf") != receipt_key(data, "pdf")
+
+@pytest.mark.asyncio
+async def test_auction_offers_cursor_pages_both_lists(monkeypatch):
+    # Prueba la rama con cursor de /admin/auction/offers: cada lista avanza por separado
+    from datetime import datetime, timedelta
+    from types import SimpleNamespace
+    import main
+    from pagination import encode_cursor
+
+    start = datetime(2024, 1, 1)
+    docs = [{"_id": i, "group_id": "27" if i % 2 else "10", "status": "OFFERED",
+             "timestamp": start + timedelta(minutes=i)} for i in range(5)]
+
+    class FakeCursor:
+        def __init__(self, rows):
+            self.rows = rows
+
+        def sort(self, sort):
+            self.rows = sorted(self.rows, key=lambda d: (d["timestamp"], d["_id"]), reverse=True)
+            return self
+
+        def limit(self, count):
+            self.rows = self.rows[:count]
+            return self
+
+        async def to_list(self):
+            return [dict(row) for row in self.rows]
+
+    def matches(doc, query):
+        if "$and" in query:
+            return all(matches(doc, part) for part in query["$and"])
+        if "$or" in query:
+            return any(matches(doc, part) for part in query["$or"])
+        for field, cond in query.items():
+            value = doc[field]
+            if isinstance(cond, dict):
+                if "$ne" in cond and value == cond["$ne"]:
+                    return False
+                if "$lt" in cond and not value < cond["$lt"]:
+                    return False
+            elif value != cond:
+                return False
+        return True
+
+    class FakeOffers:
+        def find(self, query, projection=None):
+            return FakeCursor([doc for doc in docs if matches(doc, query)])
+
+    class FakeCounts:
+        async def count(self, collection, query, estimated=False):
+            return 0
+
+    monkeypatch.setattr(main, "repo", SimpleNamespace(auction_offers=FakeOffers()))
+    monkeypatch.setattr(main, "count_cache", FakeCounts())
+    first = await main.get_auction_offers(page=1, count=2, cursor=encode_cursor({}), estimated=False, user={})
+    assert [o["timestamp"].minute for o in first["group_offers"]] == [4, 2]
+    assert [o["timestamp"].minute for o in first["admin_offers"]] == [3, 1]
+    second = await main.get_auction_offers(page=1, count=2, cursor=first["next_cursor"], estimated=False, user={})
+    assert [o["timestamp"].minute for o in second["group_offers"]] == [0]
+    assert second["admin_offers"] == [] and second["next_cursor"] is None
+
+def test_ensure_indexes_keeps_old_index_when_unique_rebuild_fails():
+    # Prueba que un índice único con repetidos no deja la colección sin índice ni corta la reconciliación
+    from pymongo import ASCENDING, IndexModel
+    from pymongo.errors import OperationFailure
+    from indexes import ensure_indexes
+
+    class FakeCollection:
+        def __init__(self, indexes, duplicates=False, fail_create=False):
+            self.indexes = indexes
+            self.duplicates = duplicates
+            self.fail_create = fail_create
+
+        def index_information(self):
+            return {name: dict(info) for name, info in self.indexes.items()}
+
+        def aggregate(self, pipeline, **kwargs):
+            return iter([{"_id": {"request_id": "r1"}, "n": 2}] if self.duplicates else [])
+
+        def drop_index(self, name):
+            del self.indexes[name]
+
+        def create_indexes(self, models):
+            for model in models:
+                spec = dict(model.document)
+                if self.fail_create and spec.get("unique"):
+                    raise OperationFailure("E11000 duplicate key error", 11000)
+                self.indexes[spec.pop("name")] = {**spec, "key": list(spec["key"].items())}
+
+    old = {"request_id": {"key": [("request_id", 1)], "v": 2}}
+    db = {
+        "requests": FakeCollection(dict(old), duplicates=True),
+        "auction_offers": FakeCollection({"auction_id": {"key": [("auction_id", 1)], "v": 2}}, fail_create=True),
+        "wallet_ledger": FakeCollection({}),
+    }
+    declared = {
+        "requests": [IndexModel([("request_id", ASCENDING)], name="request_id", unique=True)],
+        "auction_offers": [IndexModel([("auction_id", ASCENDING)], name="auction_id", unique=True)],
+        "wallet_ledger": [IndexModel([("request_id", ASCENDING)], name="request_id", unique=True)],
+    }
+    summary = ensure_indexes(db, declared)
+    assert "request_id" in summary["requests"]["failed"]
+    assert db["requests"].indexes == old
+    assert "auction_id" in summary["auction_offers"]["failed"]
+    assert db["auction_offers"].indexes["auction_id"]["key"] == [("auction_id", 1)]
+    assert not db["auction_offers"].indexes["auction_id"].get("unique")
+    assert summary["wallet_ledger"]["created"] == ["request_id"]
+
+@pytest.mark.asyncio
+async def test_buy_returns_503_and_refunds_when_publish_queue_is_full(monkeypatch):
+    # Prueba que una solicitud que no se pudo encolar devuelve el cargo y no queda registrada
+    from types import SimpleNamespace
+    import main
+    from buy_requests.buy_requests import MQTTManager
+    from buy_requests.publisher import OutboundPublisher
+
+    manager = MQTTManager(group_id="27")
+    manager._connected = True
+    manager.publisher = OutboundPublisher(client=None, queue_size=1)
+    assert manager.publish_validation("r0", "ACCEPTED") is True
+    assert manager.publish_buy_request("r1", "AAPL", 1) is False
+
+    charges = []
+
+    async def find_quote(symbol):
+        return {"symbol": symbol, "price": 10.0, "quantity": 100}
+
+    async def find_user(user_id):
+        return {"correo": user_id, "saldo": 1000}
+
+    class FakeWallet:
+        async def post(self, correo, amount, *args, **kwargs):
+            charges.append(amount)
+            return {"balance": 0, "applied": True, "created": False, "insufficient": False}
+
+    monkeypatch.setattr(main, "mqtt_manager", manager)
+    monkeypatch.setattr(main, "find_quote", find_quote)
+    monkeypatch.setattr(main, "repo", SimpleNamespace(find_user=find_user))
+    monkeypatch.setattr(main, "wallet", FakeWallet())
+    response = await main.buy_stockv2("AAPL", 2, user={"sub": "a@b.cl"})
+    assert response.status_code == 503
+    assert charges == [-20.0, 20.0]
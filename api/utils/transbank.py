@@ -3,9 +3,43 @@ from transbank.common.options import WebpayOptions
 from transbank.common.integration_type import IntegrationType
 from transbank.common.integration_commerce_codes import IntegrationCommerceCodes
 from transbank.common.integration_api_keys import IntegrationApiKeys
+from transbank.common.headers_builder import HeadersBuilder
+from transbank.common.request_service import RequestService
+import json
+import os
+import requests
+
+from metrics import track_outbound
+
+# Servidor compatible con la API de Webpay Plus (el stub de los benchmarks);
+# sin definir se usa el ambiente de integración de Transbank
+TRANSBANK_HOST = os.getenv("TRANSBANK_HOST")
 
 _tx = None
 
+
+class HostTransaction(Transaction):
+    """Transaction de Webpay Plus contra ``TRANSBANK_HOST``.
+
+    El SDK elige el host solo a partir del tipo de integración, por lo que
+    create y commit se reimplementan con los mismos endpoints y headers.
+    """
+
+    def __init__(self, options, host):
+        super().__init__(options)
+        self.host = host.rstrip("/")
+
+    def create(self, buy_order, session_id, amount, return_url):
+        body = {"buy_order": buy_order, "session_id": session_id, "amount": amount, "return_url": return_url}
+        response = requests.post(self.host + Transaction.CREATE_ENDPOINT, data=json.dumps(body),
+                                 headers=HeadersBuilder.build(self.options), timeout=self.options.timeout)
+        return RequestService.process_response(response)
+
+    def commit(self, token):
+        response = requests.put(self.host + Transaction.COMMIT_ENDPOINT.format(token), data="{}",
+                                headers=HeadersBuilder.build(self.options), timeout=self.options.timeout)
+        return RequestService.process_response(response)
+
 def get_tx():
     global _tx
     if _tx is not None:
@@ -17,5 +51,15 @@ def get_tx():
         IntegrationType.TEST
     )
 
-    _tx = Transaction(options)
+    _tx = HostTransaction(options, TRANSBANK_HOST) if TRANSBANK_HOST else Transaction(options)
     return _tx
+
+
+def create(buy_order, session_id, amount, return_url):
+    with track_outbound("transbank"):
+        return get_tx().create(buy_order, session_id, amount, return_url)
+
+
+def commit(token):
+    with track_outbound("transbank"):
+        return get_tx().commit(token)
@@ -0,0 +1,214 @@
+"""Billetera de los usuarios respaldada por un libro de movimientos.
+
+Cada cambio de saldo se registra en ``wallet_ledger`` (solo inserciones) con
+una llave de idempotencia ``request_id`` (índice único) y el saldo de
+``users`` se mantiene con ``$inc``, sin leerlo antes. Un ``request_id``
+repetido no vuelve a mover el saldo.
+
+El ``$inc`` se aplica primero y agrega el ``request_id`` a
+``wallet_applied`` del usuario (los últimos ``WALLET_RECENT_REQUESTS``), en
+la misma escritura y condicionado a que no esté ahí; después se registra el
+movimiento. Si el proceso se cae entre ambas escrituras, reintentar con el
+mismo ``request_id`` no vuelve a mover el saldo y completa el movimiento
+faltante. Un cargo puede exigir saldo suficiente (``minimum``) en la misma
+escritura.
+
+``broker_requests/wallet.py`` escribe los mismos documentos (compras y
+devoluciones) dentro de la transacción de cada respuesta.
+
+El saldo materializado se puede reconstruir desde el libro con una sola
+agregación::
+
+    python wallet.py reconcile [--apply]
+    python wallet.py backfill
+
+``backfill`` registra como movimiento de apertura el saldo que los usuarios
+tenían antes de existir el libro. ``reconcile`` solo muestra las
+diferencias; con ``--apply`` reescribe los saldos, y se niega si el libro
+tiene movimientos pero ninguna apertura (``backfill`` no ha corrido). Debe
+aplicarse con la API y los brokers detenidos: un movimiento registrado cuyo
+``$inc`` aún no se aplica se contaría dos veces.
+"""
+import os
+import sys
+from datetime import datetime
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from database import get_db
+from pagination import NEWEST_FIRST, keyset_page
+
+LEDGER_COLLECTION = "wallet_ledger"
+# request_id recientes aplicados al saldo de cada usuario
+APPLIED_FIELD = "wallet_applied"
+WALLET_RECENT_REQUESTS = int(os.getenv("WALLET_RECENT_REQUESTS", "100"))
+
+# Tipos de movimiento
+DEPOSIT = "deposit"
+PURCHASE = "purchase"
+REFUND = "refund"
+OPENING = "opening"
+
+# Diferencia de saldo que se considera redondeo de punto flotante
+BALANCE_TOLERANCE = 1e-6
+
+
+def ledger_entry(request_id, correo, amount, kind, reference=None, timestamp=None):
+    return {
+        "request_id": request_id,
+        "correo": correo,
+        "amount": amount,
+        "kind": kind,
+        "reference": reference,
+        "timestamp": timestamp or datetime.utcnow(),
+    }
+
+
+class Wallet:
+    def __init__(self, db):
+        self.ledger = db[LEDGER_COLLECTION]
+        self.users = db["users"]
+
+    async def _record(self, entry):
+        """Inserta el movimiento si su ``request_id`` es nuevo."""
+        try:
+            result = await self.ledger.update_one(
+                {"request_id": entry["request_id"]}, {"$setOnInsert": entry}, upsert=True)
+        except DuplicateKeyError:
+            # Otra solicitud insertó la misma llave al mismo tiempo
+            return False
+        return result.upserted_id is not None
+
+    async def _apply(self, correo, amount, request_id, minimum):
+        """``$inc`` del saldo, una vez por ``request_id``; retorna el saldo previo o None."""
+        query = {"correo": correo, APPLIED_FIELD: {"$ne": request_id}}
+        if minimum is not None:
+            query["saldo"] = {"$gte": minimum}
+        return await self.users.find_one_and_update(
+            query,
+            {"$inc": {"saldo": amount},
+             "$push": {APPLIED_FIELD: {"$each": [request_id], "$slice": -WALLET_RECENT_REQUESTS}}},
+            projection={"_id": 0, "saldo": 1},
+            return_document=ReturnDocument.BEFORE,
+        )
+
+    async def post(self, correo, amount, request_id, kind, reference=None, minimum=None):
+        """Ajusta el saldo y registra el movimiento (crea el usuario si no existe).
+
+        Con ``minimum`` solo se aplica si el saldo es al menos ese valor y no
+        crea usuarios. Retorna ``{"balance", "applied", "created",
+        "insufficient"}``; ``applied`` es False si el ``request_id`` ya estaba
+        aplicado o si el saldo no alcanzó (``insufficient``).
+        """
+        result = {"balance": 0, "applied": True, "created": False, "insufficient": False}
+        before = await self._apply(correo, amount, request_id, minimum)
+        if before is not None:
+            result["balance"] = before.get("saldo", 0) + amount
+        else:
+            user = await self.users.find_one(
+                {"correo": correo}, {"_id": 0, "saldo": 1, APPLIED_FIELD: {"$elemMatch": {"$eq": request_id}}})
+            if user is None and minimum is None:
+                await self.users.insert_one({"correo": correo, "saldo": amount, APPLIED_FIELD: [request_id]})
+                result.update(balance=amount, created=True)
+            elif user is not None and user.get(APPLIED_FIELD):
+                # Ya aplicado: se registra el movimiento por si faltó
+                result.update(balance=user.get("saldo", 0), applied=False)
+            else:
+                result.update(balance=(user or {}).get("saldo", 0), applied=False, insufficient=True)
+                return result
+        await self._record(ledger_entry(request_id, correo, amount, kind, reference))
+        return result
+
+    async def history(self, correo, position, count):
+        """Movimientos del usuario, del más reciente; retorna ``(docs, next_cursor)``."""
+        return await keyset_page(self.ledger, {"correo": correo}, NEWEST_FIRST, position, count, {"_id": 0})
+
+
+def balance_drift_pipeline():
+    """Usuarios cuyo saldo no coincide con la suma de sus movimientos."""
+    return [
+        {"$group": {"_id": "$correo", "ledger_balance": {"$sum": "$amount"}, "entries": {"$sum": 1}}},
+        {"$lookup": {"from": "users", "localField": "_id", "foreignField": "correo", "as": "user"}},
+        {"$unwind": "$user"},
+        {"$match": {"$expr": {"$gt": [
+            {"$abs": {"$subtract": [{"$ifNull": ["$user.saldo", 0]}, "$ledger_balance"]}},
+            BALANCE_TOLERANCE,
+        ]}}},
+        {"$project": {"_id": "$user._id", "correo": "$_id", "saldo": "$user.saldo",
+                      "ledger_balance": 1, "entries": 1}},
+    ]
+
+
+def reconcile(db, apply=True):
+    """Reconstruye el saldo de ``users`` desde el libro en una agregación.
+
+    Con ``apply=False`` solo retorna los usuarios con diferencias. Sin
+    movimientos de apertura el saldo previo al libro se perdería, así que
+    en ese caso lanza ``RuntimeError``.
+    """
+    pipeline = balance_drift_pipeline()
+    if not apply:
+        return list(db[LEDGER_COLLECTION].aggregate(pipeline))
+    ledger = db[LEDGER_COLLECTION]
+    if ledger.find_one({}, {"_id": 1}) and not ledger.find_one({"kind": OPENING}, {"_id": 1}):
+        raise RuntimeError("El libro no tiene movimientos de apertura; corre 'python wallet.py backfill' antes")
+    pipeline += [
+        {"$project": {"saldo": "$ledger_balance"}},
+        {"$merge": {"into": "users", "on": "_id", "whenMatched": "merge", "whenNotMatched": "discard"}},
+    ]
+    db[LEDGER_COLLECTION].aggregate(pipeline)
+    return []
+
+
+def backfill_opening_balances(db):
+    """Registra el saldo previo al libro como movimiento de apertura.
+
+    El monto de apertura es el saldo actual menos lo que ya suman los
+    movimientos del usuario, así que se puede correr con el libro en uso;
+    las aperturas existentes no se modifican.
+    """
+    db["users"].aggregate([
+        {"$lookup": {"from": LEDGER_COLLECTION, "localField": "correo", "foreignField": "correo", "as": "entries"}},
+        {"$project": {
+            "_id": 0,
+            "request_id": {"$concat": [f"{OPENING}:", "$correo"]},
+            "correo": 1,
+            "amount": {"$subtract": [{"$ifNull": ["$saldo", 0]}, {"$sum": "$entries.amount"}]},
+            "kind": OPENING,
+            "reference": None,
+            "timestamp": "$$NOW",
+        }},
+        {"$match": {"correo": {"$type": "string"}}},
+        {"$merge": {"into": LEDGER_COLLECTION, "on": "request_id",
+                    "whenMatched": "keepExisting", "whenNotMatched": "insert"}},
+    ])
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else "reconcile"
+    db = get_db()
+    if command == "backfill":
+        backfill_opening_balances(db)
+        print(f"[WALLET] Aperturas registradas: {db[LEDGER_COLLECTION].count_documents({'kind': OPENING})}")
+        return 0
+    if command == "reconcile":
+        drift = reconcile(db, apply=False)
+        for user in drift:
+            print(f"[WALLET] {user['correo']}: saldo {user.get('saldo')} -> {user['ledger_balance']} "
+                  f"({user['entries']} movimientos)")
+        print(f"[WALLET] Usuarios con diferencias: {len(drift)}")
+        if "--apply" in argv and drift:
+            try:
+                reconcile(db)
+            except RuntimeError as e:
+                print(f"[WALLET] {e}")
+                return 1
+            print("[WALLET] Saldos reconstruidos desde el libro")
+        return 0
+    print(f"Uso: python {argv[0]} [reconcile [--apply]|backfill]")
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
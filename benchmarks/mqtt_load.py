@@ -0,0 +1,553 @@
+"""Grabación, reproducción y carga sintética de los tópicos MQTT.
+
+Mide cuántos mensajes por segundo absorben ``mqtt_updates.on_message`` y
+``mqtt_requests.on_message``, con su latencia de procesamiento y el retraso
+de punta a punta.
+
+Las capturas son NDJSON comprimido con gzip, un mensaje por línea::
+
+    {"t": 0.0125, "topic": "stocks/updates", "qos": 1, "payload": "{...}"}
+
+donde ``t`` son los segundos desde el primer mensaje.
+
+Comandos::
+
+    # grabar el tráfico real (Ctrl-C o --duration para terminar)
+    python benchmarks/mqtt_load.py record trafico.ndjson.gz --mqtt broker.iic2173.org:9000 \\
+        --username user --password pass --duration 600
+
+    # generar una captura sintética
+    python benchmarks/mqtt_load.py generate sintetico.ndjson.gz --streams updates,requests,auctions \\
+        --messages 50000 --symbols 200 --rate 2000 --duplicates 0.01
+
+    # reproducir llamando directo a on_message de un broker (sin red)
+    python benchmarks/mqtt_load.py replay sintetico.ndjson.gz --target updates --speed max
+
+    # reproducir a través de un Mosquitto local
+    python benchmarks/mqtt_load.py replay trafico.ndjson.gz --target requests --mqtt localhost:1883 --speed 10
+
+``replay`` importa el broker elegido y arma sus workers (y el buffer de
+escrituras de ``broker_updates``) igual que ``start_mqtt_client``, así que
+escribe en el MongoDB de ``MONGO_URI``: usar un servidor de pruebas.
+``--seed`` crea antes los stocks, usuarios y transacciones que necesitan las
+respuestas de la captura.
+
+Cada mensaje se reproduce con el campo ``_bench_sent`` (hora de envío), que
+los handlers ignoran; el retraso es desde ese envío hasta que el worker
+termina el mensaje. Con el buffer de ``broker_updates`` activo el worker solo
+encola, y la escritura queda en el tiempo total (hasta vaciar el buffer).
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import paho.mqtt.client as mqtt
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TOPIC_UPDATES = "stocks/updates"
+TOPIC_REQUESTS = "stocks/requests"
+TOPIC_VALIDATION = "stocks/validation"
+TOPIC_AUCTIONS = "stocks/auctions"
+
+# Tópicos y módulo de cada broker
+TARGETS = {
+    "updates": ("broker_updates", "mqtt_updates", (TOPIC_UPDATES,)),
+    "requests": ("broker_requests", "mqtt_requests", (TOPIC_REQUESTS, TOPIC_VALIDATION, TOPIC_AUCTIONS)),
+}
+STREAMS = ("updates", "requests", "auctions")
+SENT_FIELD = "_bench_sent"
+GROUP_ID = "27"
+SEED = 20240501
+
+
+def parse_address(value, default_port=1883):
+    host, _, port = value.partition(":")
+    return host, int(port or default_port)
+
+
+def mqtt_client(username=None, password=None):
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    if username:
+        client.username_pw_set(username, password)
+    return client
+
+
+# --- Capturas ---
+
+def write_capture(path, messages):
+    """Escribe ``(t, topic, qos, payload)``; retorna cuántos mensajes escribió."""
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for t, topic, qos, payload in messages:
+            f.write(json.dumps({"t": round(t, 6), "topic": topic, "qos": qos, "payload": payload}) + "\n")
+            count += 1
+    return count
+
+
+def read_capture(path, topics=None):
+    messages = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if topics is None or entry["topic"] in topics:
+                messages.append((entry["t"], entry["topic"], entry.get("qos", 1), entry["payload"]))
+    return messages
+
+
+def record(path, address, topics, username, password, duration, limit):
+    """Graba los mensajes de ``topics`` hasta ``duration`` segundos o ``limit`` mensajes."""
+    done = threading.Event()
+    lock = threading.Lock()
+    started = []
+    f = gzip.open(path, "wt", encoding="utf-8")
+    count = 0
+
+    def on_connect(client, userdata, flags, rc, properties=None):
+        for topic in topics:
+            client.subscribe(topic, qos=1)
+        print(f"[RECORD] Conectado a {address[0]}:{address[1]}, grabando {', '.join(topics)}")
+
+    def on_message(client, userdata, msg):
+        nonlocal count
+        now = time.monotonic()
+        with lock:
+            if done.is_set():
+                return
+            if not started:
+                started.append(now)
+            f.write(json.dumps({"t": round(now - started[0], 6), "topic": msg.topic, "qos": msg.qos,
+                                "payload": msg.payload.decode("utf-8", "replace")}) + "\n")
+            count += 1
+            if limit and count >= limit:
+                done.set()
+
+    client = mqtt_client(username, password)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(*address, keepalive=60)
+    client.loop_start()
+    try:
+        done.wait(duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        done.set()
+        client.loop_stop()
+        client.disconnect()
+        with lock:
+            f.close()
+    print(f"[RECORD] {count} mensajes guardados en {path}")
+    return count
+
+
+# --- Generador sintético ---
+
+def _iso(start, offset):
+    return (start + timedelta(microseconds=offset)).isoformat()
+
+
+def update_stream(rng, symbols, start):
+    """IPO de cada símbolo y luego UPDATE (90%) y EMIT (10%) al azar."""
+    names = [f"S{i:04d}" for i in range(symbols)]
+    prices = {name: round(rng.uniform(5, 500), 2) for name in names}
+    n = 0
+    for name in names:
+        n += 1
+        yield TOPIC_UPDATES, 1, {"kind": "IPO", "symbol": name, "quantity": 100000, "price": prices[name],
+                                 "longName": f"Synthetic {name} Inc.", "timestamp": _iso(start, n)}
+    while True:
+        n += 1
+        name = rng.choice(names)
+        prices[name] = round(prices[name] * rng.uniform(0.98, 1.02), 2)
+        kind = "EMIT" if rng.random() < 0.1 else "UPDATE"
+        yield TOPIC_UPDATES, 1, {"kind": kind, "symbol": name, "quantity": rng.randint(1, 500) if kind == "EMIT" else 0,
+                                 "price": prices[name], "longName": f"Synthetic {name} Inc.",
+                                 "timestamp": _iso(start, n)}
+
+
+def request_stream(rng, symbols, start):
+    """Solicitud de compra, su respuesta y (a veces) la validación."""
+    n = 0
+    while True:
+        n += 1
+        request_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        symbol = f"S{rng.randrange(symbols):04d}"
+        yield TOPIC_REQUESTS, 1, {"request_id": request_id, "group_id": str(rng.randint(1, 30)),
+                                  "quantity": rng.randint(1, 10), "symbol": symbol, "operation": "BUY"}
+        status = "ACCEPTED" if rng.random() < 0.9 else "REJECTED"
+        yield TOPIC_REQUESTS, 1, {"request_id": request_id, "kind": "response", "status": status,
+                                  "timestamp": _iso(start, n)}
+        if status == "ACCEPTED" and rng.random() < 0.3:
+            yield TOPIC_VALIDATION, 0, {"request_id": request_id, "status": rng.choice(("ACCEPTED", "REJECTED")),
+                                        "reason": "", "timestamp": _iso(start, n)}
+
+
+def auction_stream(rng, symbols, start):
+    """Oferta, dos propuestas y la aceptación de una y el rechazo de la otra."""
+    n = 0
+    while True:
+        n += 1
+        auction_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        symbol = f"S{rng.randrange(symbols):04d}"
+        quantity = rng.randint(1, 20)
+        base = {"auction_id": auction_id, "symbol": symbol, "quantity": quantity, "timestamp": _iso(start, n)}
+        yield TOPIC_AUCTIONS, 1, dict(base, proposal_id="", group_id=str(rng.randint(1, 30)), operation="offer")
+        proposals = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(2)]
+        for proposal_id in proposals:
+            yield TOPIC_AUCTIONS, 1, dict(base, proposal_id=proposal_id, group_id=str(rng.randint(1, 30)),
+                                          operation="proposal")
+        accepted, rejected = proposals
+        yield TOPIC_AUCTIONS, 1, dict(base, proposal_id=accepted, group_id=GROUP_ID, operation="acceptance")
+        yield TOPIC_AUCTIONS, 1, dict(base, proposal_id=rejected, group_id=GROUP_ID, operation="rejection")
+
+
+STREAM_FACTORIES = {"updates": update_stream, "requests": request_stream, "auctions": auction_stream}
+
+
+def generate(streams, messages, symbols, rate, duplicates, seed=SEED):
+    """Intercala los streams en ronda a ``rate`` mensajes por segundo.
+
+    Con ``duplicates`` > 0 esa fracción de los mensajes se repite enseguida,
+    como una reentrega de QoS 1.
+    """
+    rng = random.Random(seed)
+    start = datetime.now(timezone.utc).replace(microsecond=0)
+    generators = [STREAM_FACTORIES[name](rng, symbols, start) for name in streams]
+    interval = 1 / rate if rate else 0.0
+    i = 0
+    while i < messages:
+        for generator in generators:
+            if i >= messages:
+                break
+            topic, qos, payload = next(generator)
+            raw = json.dumps(payload)
+            yield i * interval, topic, qos, raw
+            i += 1
+            if duplicates and i < messages and rng.random() < duplicates:
+                yield i * interval, topic, qos, raw
+                i += 1
+
+
+# --- Reproducción ---
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def latency_summary(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3),
+    }
+
+
+class Timings:
+    """Latencias de on_message y de los workers, y retraso desde el envío."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.on_message = []
+        self.handler = []
+        self.lag = []
+        self.errors = 0
+        self.progress = threading.Condition(self._lock)
+
+    def instrument(self, handler):
+        def wrapper(*args):
+            started = time.perf_counter()
+            ok = True
+            try:
+                handler(*args)
+            except Exception:
+                ok = False
+                raise
+            finally:
+                finished = time.perf_counter()
+                data = args[-1]
+                sent = data.get(SENT_FIELD) if isinstance(data, dict) else None
+                with self._lock:
+                    self.handler.append(finished - started)
+                    if sent is not None:
+                        self.lag.append(time.time() - sent)
+                    if not ok:
+                        self.errors += 1
+                    self.progress.notify_all()
+
+        return wrapper
+
+    def handled(self):
+        with self._lock:
+            return len(self.handler)
+
+    def wait_for(self, expected, idle_timeout):
+        """Espera ``expected`` mensajes procesados o ``idle_timeout`` sin avances."""
+        with self._lock:
+            last = len(self.handler)
+            while len(self.handler) < expected:
+                self.progress.wait(idle_timeout)
+                if len(self.handler) == last:
+                    return False
+                last = len(self.handler)
+        return True
+
+
+def load_broker(target):
+    """Importa el módulo del broker desde su directorio."""
+    if os.getenv("CI") == "true" or os.getenv("GITHUB_ACTIONS") == "true":
+        raise SystemExit("replay no corre con CI=true: los brokers omiten la base de datos")
+    directory, module_name, _ = TARGETS[target]
+    sys.path.insert(0, os.path.join(ROOT_DIR, directory))
+    module = __import__(module_name)
+    if module.db is None:
+        raise SystemExit(f"{module_name} no pudo conectarse a MongoDB (MONGO_URI)")
+    return module
+
+
+def start_workers(module, target, timings):
+    """Workers (y buffer) del broker, como en start_mqtt_client."""
+    if target == "updates":
+        if module.INGEST_BUFFERED:
+            module.ingest_buffer = module.IngestBuffer(module.db, on_flush=module.bump_collection_versions).start()
+        module.dispatcher = module.ShardedDispatcher("updates", timings.instrument(module.process_update)).start()
+    else:
+        module.dispatcher = module.ShardedDispatcher("requests", timings.instrument(module.process_message)).start()
+
+
+def stop_workers(module):
+    module.dispatcher.close(timeout=None)
+    if getattr(module, "ingest_buffer", None) is not None:
+        module.ingest_buffer.close(timeout=None)
+
+
+def seed_requests(db, messages):
+    """Stocks, usuarios y transacciones para las solicitudes de la captura."""
+    from pymongo import UpdateOne
+
+    symbols = set()
+    transactions = []
+    for _, topic, _, payload in messages:
+        data = _decode(payload)
+        if topic != TOPIC_REQUESTS or not data or "symbol" not in data or data.get("kind") == "response":
+            continue
+        symbols.add(data["symbol"])
+        transactions.append(UpdateOne({"request_id": data.get("request_id")}, {"$setOnInsert": {
+            "request_id": data.get("request_id"), "symbol": data["symbol"], "quantity": data.get("quantity", 0),
+            "user_email": f"bench-user-{len(transactions) % 100}", "status": "PENDING",
+        }}, upsert=True))
+    stocks = [UpdateOne({"symbol": symbol}, {"$setOnInsert": {"symbol": symbol, "price": 100.0, "quantity": 10 ** 9}},
+                        upsert=True) for symbol in symbols]
+    users = [UpdateOne({"correo": f"bench-user-{i}"}, {"$setOnInsert": {"saldo": 10.0 ** 9}}, upsert=True)
+             for i in range(100)]
+    for name, operations in (("current_stocks", stocks), ("users", users), ("transactions", transactions)):
+        if operations:
+            db[name].bulk_write(operations, ordered=False)
+    print(f"[REPLAY] Seed: {len(stocks)} stocks, {len(users)} usuarios, {len(transactions)} transacciones")
+
+
+def _decode(payload):
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _stamp(payload):
+    data = _decode(payload)
+    if data is None:
+        return payload.encode("utf-8")
+    data[SENT_FIELD] = time.time()
+    return json.dumps(data).encode("utf-8")
+
+
+def _pace(started, t, speed):
+    if speed is None:
+        return
+    delay = started + t / speed - time.perf_counter()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def replay(path, target, speed, address=None, username=None, password=None, seed=False, idle_timeout=10.0):
+    """Reproduce la captura contra ``target``; ``speed`` None es lo más rápido posible."""
+    _, _, topics = TARGETS[target]
+    messages = read_capture(path, topics)
+    if not messages:
+        raise SystemExit(f"La captura no tiene mensajes de {', '.join(topics)}")
+    module = load_broker(target)
+    if seed and target == "requests":
+        seed_requests(module.db, messages)
+    timings = Timings()
+    dropped_before = module.seen_messages.stats()["dropped"]
+    start_workers(module, target, timings)
+
+    subscriber = publisher = None
+    if address is not None:
+        subscribed = threading.Event()
+        subscriber = mqtt_client(username, password)
+        subscriber.on_connect = module.on_connect
+        subscriber.on_subscribe = lambda *args, **kwargs: subscribed.set()
+        subscriber.on_message = module.on_message
+        subscriber.connect(*address, keepalive=60)
+        subscriber.loop_start()
+        publisher = mqtt_client(username, password)
+        publisher.connect(*address, keepalive=60)
+        publisher.loop_start()
+        if not subscribed.wait(10):
+            raise SystemExit(f"Sin suscripción en {address[0]}:{address[1]}")
+        # on_connect del broker se suscribe a un tópico a la vez
+        time.sleep(0.5)
+
+    started = time.perf_counter()
+    for t, topic, qos, payload in messages:
+        _pace(started, t, speed)
+        if publisher is not None:
+            publisher.publish(topic, _stamp(payload), qos=qos)
+        else:
+            send_started = time.perf_counter()
+            module.on_message(None, None, SimpleNamespace(topic=topic, payload=_stamp(payload), qos=qos))
+            timings.on_message.append(time.perf_counter() - send_started)
+    sent_elapsed = time.perf_counter() - started
+
+    dropped = module.seen_messages.stats()["dropped"] - dropped_before
+    expected = len(messages) - dropped
+    if publisher is not None:
+        complete = timings.wait_for(expected, idle_timeout)
+        if not complete:
+            # Los descartados llegan después; se recalcula antes de rendirse
+            dropped = module.seen_messages.stats()["dropped"] - dropped_before
+            complete = timings.wait_for(len(messages) - dropped, idle_timeout)
+        publisher.loop_stop()
+        publisher.disconnect()
+        subscriber.loop_stop()
+        subscriber.disconnect()
+    stop_workers(module)
+    elapsed = time.perf_counter() - started
+    dropped = module.seen_messages.stats()["dropped"] - dropped_before
+
+    handled = timings.handled()
+    return {
+        "target": target,
+        "mode": "mqtt" if address is not None else "direct",
+        "speed": speed or "max",
+        "messages": len(messages),
+        "handled": handled,
+        "duplicates_dropped": dropped,
+        "handler_errors": timings.errors,
+        "send_seconds": round(sent_elapsed, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "offered_msg_per_sec": round(len(messages) / sent_elapsed, 1) if sent_elapsed else None,
+        "sustained_msg_per_sec": round((handled + dropped) / elapsed, 1) if elapsed else None,
+        "on_message": latency_summary(timings.on_message),
+        "handler": latency_summary(timings.handler),
+        "end_to_end_lag": latency_summary(timings.lag),
+    }
+
+
+def print_report(result):
+    print(f"[REPLAY] {result['target']} ({result['mode']}, velocidad {result['speed']}): "
+          f"{result['messages']} mensajes, {result['handled']} procesados, "
+          f"{result['duplicates_dropped']} repetidos descartados, {result['handler_errors']} errores")
+    print(f"[REPLAY] Ofrecido {result['offered_msg_per_sec']} msg/s, sostenido "
+          f"{result['sustained_msg_per_sec']} msg/s ({result['elapsed_seconds']}s hasta vaciar los workers)")
+    for name in ("on_message", "handler", "end_to_end_lag"):
+        summary = result[name]
+        if summary["count"]:
+            print(f"[REPLAY] {name:15} p50 {summary['p50_ms']:9.3f} ms  p95 {summary['p95_ms']:9.3f} ms  "
+                  f"p99 {summary['p99_ms']:9.3f} ms  max {summary['max_ms']:9.3f} ms")
+
+
+def parse_speed(value):
+    if value == "max":
+        return None
+    speed = float(value.rstrip("x"))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("la velocidad debe ser mayor que cero")
+    return speed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=f"python {argv[0]}", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = commands.add_parser("record", help="grabar tráfico de un broker MQTT")
+    record_parser.add_argument("capture")
+    record_parser.add_argument("--mqtt", required=True, help="host:puerto")
+    record_parser.add_argument("--topics", default=",".join(TARGETS["updates"][2] + TARGETS["requests"][2]))
+    record_parser.add_argument("--duration", type=float, help="segundos a grabar")
+    record_parser.add_argument("--count", type=int, default=0, help="mensajes a grabar")
+
+    generate_parser = commands.add_parser("generate", help="generar una captura sintética")
+    generate_parser.add_argument("capture")
+    generate_parser.add_argument("--streams", default=",".join(STREAMS))
+    generate_parser.add_argument("--messages", type=int, default=50000)
+    generate_parser.add_argument("--symbols", type=int, default=100, help="cardinalidad de símbolos")
+    generate_parser.add_argument("--rate", type=float, default=1000, help="mensajes por segundo de la captura")
+    generate_parser.add_argument("--duplicates", type=float, default=0.0, help="fracción de reentregas")
+    generate_parser.add_argument("--seed", type=int, default=SEED)
+
+    replay_parser = commands.add_parser("replay", help="reproducir una captura contra un broker")
+    replay_parser.add_argument("capture")
+    replay_parser.add_argument("--target", choices=sorted(TARGETS), required=True)
+    replay_parser.add_argument("--speed", type=parse_speed, default=None, help="1, 10, ... o max (por defecto)")
+    replay_parser.add_argument("--mqtt", help="host:puerto de un Mosquitto local; sin esto se llama a on_message")
+    replay_parser.add_argument("--seed", action="store_true", help="crear los datos que necesitan las respuestas")
+    replay_parser.add_argument("--idle-timeout", type=float, default=10.0,
+                               help="segundos sin mensajes procesados antes de dejar de esperar")
+    replay_parser.add_argument("--output", help="archivo JSON donde guardar el resultado")
+
+    for sub in (record_parser, replay_parser):
+        sub.add_argument("--username", default=os.getenv("MQTT_USER"))
+        sub.add_argument("--password", default=os.getenv("MQTT_PASSWORD"))
+
+    args = parser.parse_args(argv[1:])
+    if args.command == "record":
+        topics = [topic for topic in args.topics.split(",") if topic]
+        record(args.capture, parse_address(args.mqtt), topics, args.username, args.password,
+               args.duration, args.count)
+        return 0
+    if args.command == "generate":
+        streams = [name for name in args.streams.split(",") if name]
+        unknown = set(streams) - set(STREAMS)
+        if unknown:
+            parser.error(f"streams desconocidos: {', '.join(sorted(unknown))}")
+        count = write_capture(args.capture, generate(streams, args.messages, args.symbols, args.rate,
+                                                     args.duplicates, args.seed))
+        print(f"[GENERATE] {count} mensajes guardados en {args.capture}")
+        return 0
+
+    address = parse_address(args.mqtt) if args.mqtt else None
+    result = replay(args.capture, args.target, args.speed, address, args.username, args.password,
+                    args.seed, args.idle_timeout)
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dict(result, capture=args.capture, created_at=datetime.utcnow().isoformat(timespec="seconds")),
+                      f, indent=2)
+        print(f"[REPLAY] Resultado guardado en {args.output}")
+    return 1 if result["handler_errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,71 @@
+"""Descarte de mensajes MQTT repetidos.
+
+Los tópicos se publican con QoS 1 (al menos una vez), así que un mismo
+mensaje puede llegar más de una vez. ``SeenCache`` recuerda las llaves de los
+mensajes recientes, acotado en cantidad y con TTL, y el hilo de red descarta
+los repetidos antes de encolarlos, sin tocar la base de datos. Lo que el
+cache no ve (reinicios, varias réplicas del broker) lo cubren las escrituras
+condicionadas y los índices únicos de MongoDB.
+
+Configuración: ``DEDUP_MAX_ENTRIES`` (100000) y ``DEDUP_TTL_SECONDS`` (600).
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "100000"))
+DEDUP_TTL_SECONDS = float(os.getenv("DEDUP_TTL_SECONDS", "600"))
+
+
+class SeenCache:
+    def __init__(self, max_entries=DEDUP_MAX_ENTRIES, ttl=DEDUP_TTL_SECONDS, clock=time.monotonic):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._clock = clock
+        # llave -> instante en que expira, en orden de llegada (y de expiración)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.dropped = 0
+        self.evicted = 0
+        # Repetidos que no estaban en el cache y detectó la base de datos
+        self.stored_duplicates = 0
+
+    def seen(self, key):
+        """True si ``key`` llegó dentro del TTL; si no, la registra.
+
+        Un mensaje sin llave (None) nunca se considera repetido.
+        """
+        if key is None:
+            return False
+        now = self._clock()
+        with self._lock:
+            self.checked += 1
+            while self._entries:
+                oldest, expires = next(iter(self._entries.items()))
+                if expires > now:
+                    break
+                del self._entries[oldest]
+            if key in self._entries:
+                self.dropped += 1
+                return True
+            self._entries[key] = now + self.ttl
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+            return False
+
+    def record_duplicate(self):
+        with self._lock:
+            self.stored_duplicates += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "checked": self.checked,
+                "dropped": self.dropped,
+                "evicted": self.evicted,
+                "stored_duplicates": self.stored_duplicates,
+            }
@@ -0,0 +1,165 @@
+"""Logging estructurado que no bloquea el hilo que registra.
+
+Los mensajes pasan por una cola acotada y un hilo de fondo los escribe en
+stdout, así un request o un ``on_message`` nunca espera la escritura. Si la
+cola se llena el mensaje se descarta y se cuenta. Cada categoría (``auth``,
+``mqtt.message``, ...) puede muestrearse para los mensajes de alto volumen;
+WARNING y superiores nunca se muestrean.
+
+Configuración por variables de entorno:
+
+- ``LOG_LEVEL``: nivel mínimo (INFO por defecto).
+- ``LOG_FORMAT``: ``json`` (por defecto) o ``text``.
+- ``LOG_SAMPLE_RATES``: ``categoria=tasa`` separados por coma, por ejemplo
+  ``mqtt.message=0.01,db.query=0.1``.
+- ``LOG_QUEUE_SIZE``: tamaño de la cola (10000 por defecto).
+
+El logging queda configurado al importar el módulo.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SERVICE = os.getenv("LOG_SERVICE", "broker_requests")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Por defecto se registra 1 de cada 100 payloads de MQTT
+DEFAULT_SAMPLE_RATES = {"mqtt.message": 0.01}
+
+# Prefijo de los loggers propios, para no mezclarlos con los de librerías
+NAMESPACE = "stocks"
+
+_listener = None
+_handler = None
+
+
+def parse_sample_rates(value):
+    rates = {}
+    for item in (value or "").split(","):
+        category, _, rate = item.partition("=")
+        if category.strip() and rate.strip():
+            rates[category.strip()] = float(rate)
+    return rates
+
+
+def _category(record):
+    prefix = NAMESPACE + "."
+    return record.name[len(prefix):] if record.name.startswith(prefix) else record.name
+
+
+class JSONFormatter(logging.Formatter):
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "service": self.service,
+            "category": _category(record),
+            "message": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self, service):
+        super().__init__("%(asctime)s %(levelname)s " + service + " [%(category)s] %(message)s")
+
+    def format(self, record):
+        record.category = _category(record)
+        message = super().format(record)
+        fields = getattr(record, "fields", None)
+        return f"{message} {json.dumps(fields, default=str, ensure_ascii=False)}" if fields else message
+
+
+class SamplingFilter(logging.Filter):
+    """Deja pasar solo una fracción de los mensajes de cada categoría."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(_category(record))
+        return rate is None or random.random() < rate
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Encola sin esperar; si la cola está llena descarta y cuenta."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # El mensaje se arma aquí (los argumentos pueden cambiar después) y
+        # el formato JSON se hace en el hilo de escritura
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(service=SERVICE):
+    """Configura el logging del proceso; es idempotente."""
+    global _listener, _handler
+    if _listener is not None:
+        return
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _handler = NonBlockingQueueHandler(log_queue)
+    _handler.addFilter(SamplingFilter({**DEFAULT_SAMPLE_RATES, **parse_sample_rates(os.getenv("LOG_SAMPLE_RATES"))}))
+
+    writer = logging.StreamHandler(sys.stdout)
+    writer.setFormatter(JSONFormatter(service) if LOG_FORMAT == "json" else TextFormatter(service))
+
+    logger = logging.getLogger(NAMESPACE)
+    logger.setLevel(LOG_LEVEL)
+    logger.addHandler(_handler)
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, writer, respect_handler_level=True)
+    _listener.start()
+    # Escribir lo pendiente al terminar el proceso
+    atexit.register(_listener.stop)
+
+
+def get_logger(category):
+    return logging.getLogger(f"{NAMESPACE}.{category}")
+
+
+def log_stats():
+    return {
+        "queued": _handler.queue.qsize() if _handler else 0,
+        "dropped": _handler.dropped if _handler else 0,
+    }
+
+
+setup_logging()
@@ -0,0 +1,142 @@
+"""Métricas en formato Prometheus del broker.
+
+Expone en un puerto HTTP aparte (``METRICS_PORT``, 9100 por defecto):
+
+- latencia de cada comando de MongoDB por colección y operación, con un
+  ``CommandListener`` de pymongo,
+- mensajes MQTT recibidos y tiempo de procesamiento por tópico,
+- el estado del pool de conexiones (``PoolMetrics``).
+"""
+import os
+import threading
+import time
+from functools import wraps
+
+from prometheus_client import REGISTRY, Counter, Histogram, start_http_server
+from prometheus_client.core import GaugeMetricFamily
+from pymongo import monitoring
+
+from logs import get_logger, log_stats
+
+log = get_logger("metrics")
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+MONGO_COMMAND_DURATION = Histogram(
+    "mongodb_command_duration_seconds",
+    "Latencia de comandos de MongoDB por colección y operación",
+    ["client", "collection", "command"],
+    buckets=LATENCY_BUCKETS,
+)
+MONGO_COMMAND_FAILURES = Counter(
+    "mongodb_command_failures_total",
+    "Comandos de MongoDB que fallaron",
+    ["client", "collection", "command"],
+)
+MQTT_RECEIVED = Counter("mqtt_messages_received_total", "Mensajes recibidos por tópico", ["topic"])
+MQTT_HANDLE_DURATION = Histogram(
+    "mqtt_message_handle_duration_seconds",
+    "Tiempo de procesamiento de un mensaje recibido por tópico",
+    ["topic"],
+    buckets=LATENCY_BUCKETS,
+)
+
+# Comandos sin colección (ping, hello, ...) se agrupan aquí
+NO_COLLECTION = "-"
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def __init__(self, client_name):
+        self.client_name = client_name
+        self._lock = threading.Lock()
+        # (request_id, connection_id) -> collection
+        self._in_flight = {}
+
+    @staticmethod
+    def _collection(event):
+        command = event.command
+        if event.command_name == "getMore":
+            return command.get("collection", NO_COLLECTION)
+        target = command.get(event.command_name)
+        return target if isinstance(target, str) else NO_COLLECTION
+
+    def started(self, event):
+        with self._lock:
+            self._in_flight[(event.request_id, event.connection_id)] = self._collection(event)
+
+    def _finish(self, event):
+        with self._lock:
+            collection = self._in_flight.pop((event.request_id, event.connection_id), NO_COLLECTION)
+        return collection
+
+    def succeeded(self, event):
+        collection = self._finish(event)
+        MONGO_COMMAND_DURATION.labels(self.client_name, collection, event.command_name).observe(
+            event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self._finish(event)
+        MONGO_COMMAND_DURATION.labels(self.client_name, collection, event.command_name).observe(
+            event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.labels(self.client_name, collection, event.command_name).inc()
+
+
+def timed_handler(on_message):
+    """Envuelve un ``on_message`` de paho para contar y medir cada mensaje."""
+
+    @wraps(on_message)
+    def wrapper(client, userdata, msg):
+        MQTT_RECEIVED.labels(msg.topic).inc()
+        started = time.perf_counter()
+        try:
+            return on_message(client, userdata, msg)
+        finally:
+            MQTT_HANDLE_DURATION.labels(msg.topic).observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+class StatsCollector:
+    """Expone como gauges los valores numéricos de ``stats()``."""
+
+    def __init__(self, prefix, stats, label=None):
+        self.prefix = prefix
+        self.stats = stats
+        self.label = label
+
+    def collect(self):
+        snapshots = self.stats()
+        if isinstance(snapshots, dict):
+            snapshots = [snapshots]
+        families = {}
+        for snapshot in snapshots:
+            labels = [str(snapshot.get(self.label))] if self.label else []
+            for key, value in snapshot.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{self.prefix}_{key}"
+                if name not in families:
+                    families[name] = GaugeMetricFamily(name, f"{self.prefix} {key}",
+                                                       labels=[self.label] if self.label else [])
+                families[name].add_metric(labels, value)
+        return list(families.values())
+
+
+def register_stats(prefix, stats, label=None):
+    REGISTRY.register(StatsCollector(prefix, stats, label))
+
+
+register_stats("logging", log_stats)
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """Sirve /metrics en un hilo de fondo; con puerto 0 no se expone."""
+    if not port:
+        return
+    try:
+        start_http_server(port)
+        log.info("Métricas en el puerto %s", port)
+    except OSError as e:
+        log.error("No se pudo abrir el puerto de métricas %s: %s", port, e)
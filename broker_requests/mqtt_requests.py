@@ -2,12 +2,23 @@ import os
 import json
 import paho.mqtt.client as mqtt
 from dateutil import parser
-from pymongo import MongoClient
+from database import get_client, DB_NAME
+from dedup import SeenCache
+from dispatch import ShardedDispatcher
+from logs import get_logger
+from settlement import Settlement
+from metrics import register_stats, start_metrics_server, timed_handler
 from dotenv import load_dotenv
+from pymongo.errors import DuplicateKeyError
+import signal
 import time
 
 load_dotenv()
 
+log = get_logger("requests")
+# Payload de cada mensaje; se muestrea (ver LOG_SAMPLE_RATES)
+message_log = get_logger("mqtt.message")
+
 BROKER_HOST = os.getenv("MQTT_BROKER")
 BROKER_PORT = int(os.getenv("MQTT_PORT", "9000"))
 REQUEST_TOPIC = "stocks/requests"
@@ -16,15 +27,13 @@ AUCTION_TOPIC = "stocks/auctions"
 MQTT_USER = os.getenv("MQTT_USER")
 MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
 
-MONGO_URI = os.getenv("MONGO_URI")
-
 # Detect if running in CI environment
 IS_CI = os.getenv("GITHUB_ACTIONS") == "true" or os.getenv("CI") == "true"
-print(f"[BROKER_REQUESTS] Running in CI environment: {IS_CI}")
+log.info("Running in CI environment: %s", IS_CI)
 
 # Only connect to MongoDB if not in CI
 if IS_CI:
-    print("[BROKER_REQUESTS] Running in CI environment, skipping database connection")
+    log.info("Running in CI environment, skipping database connection")
     client_mongo = None
     db = None
     collection_requests = None
@@ -34,11 +43,13 @@ if IS_CI:
     collection_event_log = None
     collection_auction_offers = None
     admin_transactions_collection = None
+    collection_versions = None
+    settlement = None
 else:
-    print("[BROKER_REQUESTS] Iniciando cliente MQTT")
+    log.info("Iniciando cliente MQTT")
     try:
-        client_mongo = MongoClient(MONGO_URI)
-        db = client_mongo["stocks_db"] 
+        client_mongo = get_client()
+        db = client_mongo[DB_NAME]
         collection_requests = db["requests"]
         collection_stocks = db["current_stocks"]
         collection_transactions = db["transactions"]
@@ -46,55 +57,120 @@ else:
         collection_event_log = db["event_log"]
         collection_auction_offers = db["auction_offers"]
         admin_transactions_collection = db["admin_transactions"]
-        print("[BROKER_REQUESTS] Connected to MongoDB")
+        # Versiones por colección usadas por la API para invalidar totales cacheados
+        collection_versions = db["collection_versions"]
+        # Respuestas y validaciones en una transacción por mensaje
+        settlement = Settlement(client_mongo, db)
+        log.info("Connected to MongoDB")
     except Exception as e:
-        print(f"[BROKER_REQUESTS] Failed to connect to MongoDB: {e}")
+        log.error("Failed to connect to MongoDB: %s", e)
         client_mongo = None
 
+# Workers por request_id/auction_id; se crean al iniciar el cliente MQTT
+dispatcher = None
+
+# Mensajes recientes, para descartar las entregas repetidas de QoS 1
+seen_messages = SeenCache()
+
+# Colecciones que puede modificar cada tópico
+TOPIC_COLLECTIONS = {
+    REQUEST_TOPIC: ("requests", "transactions", "current_stocks", "users", "event_log"),
+    VALIDATION_TOPIC: ("requests", "transactions", "current_stocks"),
+    AUCTION_TOPIC: ("auction_offers", "admin_transactions"),
+}
+
+def bump_collection_versions(*names):
+    if collection_versions is None or not names:
+        return
+    collection_versions.update_one(
+        {"_id": "stocks_db"},
+        {"$inc": {name: 1 for name in names}},
+        upsert=True
+    )
+
 def on_connect(client, userdata, flags, rc, properties=None):
-    print(f"Conectado al broker con código de resultado: {rc}")
-    print(f"[DEBUG] Conectado con código: {rc}")
+    log.info("Conectado al broker con código de resultado: %s", rc)
     client.subscribe(REQUEST_TOPIC)
-    print(f"[DEBUG] Suscrito a: {REQUEST_TOPIC}")
+    log.debug("Suscrito a: %s", REQUEST_TOPIC)
     client.subscribe(VALIDATION_TOPIC)
-    print(f"[DEBUG] Suscrito a: {VALIDATION_TOPIC}")
+    log.debug("Suscrito a: %s", VALIDATION_TOPIC)
     client.subscribe(AUCTION_TOPIC)
-    print(f"[DEBUG] Suscrito a: {AUCTION_TOPIC}")
+    log.debug("Suscrito a: %s", AUCTION_TOPIC)
 
 def on_message(client, userdata, msg):
-    print(f"Mensaje recibido en {msg.topic}: {msg.payload.decode()}")
+    message_log.info("Mensaje recibido en %s: %s", msg.topic, msg.payload.decode())
     # Skip processing in CI environment
     if IS_CI:
-        print("[BROKER_REQUESTS] Running in CI, skipping message processing")
+        log.debug("Running in CI, skipping message processing")
         return
         
     try:
         data = json.loads(msg.payload.decode("utf-8"))
-        handle_timestamp(data)
-        if msg.topic == REQUEST_TOPIC:
-            if is_purchase_request(data):
-                handle_purchase_request(data)
-            elif is_response(data):
-                handle_response(data)
-        elif msg.topic == VALIDATION_TOPIC:
-            handle_validation(data)
-        elif msg.topic == AUCTION_TOPIC:
-            print("Mensaje de subasta recibido")
-            if is_auction_offer(data):
-                handle_auction_offer(data)
-                print("Oferta de subasta recibida")
-            elif is_auction_proposal(data):
-                print("Propuesta de subasta recibida")
-                handle_auction_proposal(data)
-            elif is_auction_response(data):
-                operation = data.get("operation")
-                if operation == "acceptance":
-                    handle_acceptance_response(data)
-                else:
-                    handle_rejection_response(data)
-
     except json.JSONDecodeError as e:
-        print("Error al decodificar el JSON:", e)
+        log.error("Error al decodificar el JSON: %s", e)
+        return
+
+    key = dedup_key(msg.topic, data)
+    if seen_messages.seen(key):
+        log.debug("Mensaje repetido descartado: %s", key)
+        return
+
+    if dispatcher is not None:
+        # Mensajes de una misma solicitud o subasta van al mismo worker
+        dispatcher.submit(message_key(msg.topic, data), msg.topic, data)
+    else:
+        process_message(msg.topic, data)
+
+def message_key(topic, data):
+    return data.get("request_id") or data.get("auction_id") or topic
+
+def dedup_key(topic, data):
+    """Identifica un mensaje para descartar repetidos; None si no trae id."""
+    if topic == AUCTION_TOPIC:
+        if not data.get("auction_id"):
+            return None
+        if data.get("operation") != "offer" and not data.get("proposal_id"):
+            return None
+        return (topic, data.get("operation"), data["auction_id"], data.get("proposal_id"))
+    if not data.get("request_id"):
+        return None
+    if topic == REQUEST_TOPIC and is_purchase_request(data):
+        return (topic, "request", data["request_id"])
+    # Respuestas y validaciones: una por estado
+    return (topic, data.get("kind"), data["request_id"], data.get("status"))
+
+def process_message(topic, data):
+    """Aplica un mensaje; corre en el worker de su llave.
+
+    Los handlers retornan True solo si escribieron algo; los repetidos y los
+    que no aplican no tocan las versiones de las colecciones.
+    """
+    handle_timestamp(data)
+    wrote = False
+    if topic == REQUEST_TOPIC:
+        if is_purchase_request(data):
+            wrote = handle_purchase_request(data)
+        elif is_response(data):
+            wrote = handle_response(data)
+    elif topic == VALIDATION_TOPIC:
+        wrote = handle_validation(data)
+    elif topic == AUCTION_TOPIC:
+        log.debug("Mensaje de subasta recibido")
+        if is_auction_offer(data):
+            wrote = handle_auction_offer(data)
+            log.debug("Oferta de subasta recibida")
+        elif is_auction_proposal(data):
+            log.debug("Propuesta de subasta recibida")
+            wrote = handle_auction_proposal(data)
+        elif is_auction_response(data):
+            operation = data.get("operation")
+            if operation == "acceptance":
+                wrote = handle_acceptance_response(data)
+            else:
+                wrote = handle_rejection_response(data)
+
+    if wrote:
+        bump_collection_versions(*TOPIC_COLLECTIONS.get(topic, ()))
 
 def is_auction_offer(data):
     return data.get("operation") == "offer"
@@ -107,7 +183,7 @@ def is_auction_response(data):
 
 def handle_auction_offer(data):
     if collection_auction_offers is None:
-        print("[BROKER_REQUESTS] Database not available")
+        log.warning("Database not available")
         return
     
     offer_data = {
@@ -119,19 +195,24 @@ def handle_auction_offer(data):
         "group_id": data.get("group_id"),
         "status": "OFFERED",
     }
-    collection_auction_offers.insert_one(offer_data)
-    print(f"Oferta de subasta registrada: {offer_data}")
+    # Solo se inserta si el auction_id es nuevo (índice único en auction_offers)
+    try:
+        result = collection_auction_offers.update_one(
+            {"auction_id": offer_data["auction_id"]}, {"$setOnInsert": offer_data}, upsert=True)
+    except DuplicateKeyError:
+        result = None
+    if result is None or result.upserted_id is None:
+        seen_messages.record_duplicate()
+        log.info("Oferta de subasta repetida ignorada: %s", offer_data["auction_id"])
+        return
+    log.info("Oferta de subasta registrada: %s", offer_data)
+    return True
 
 def handle_auction_proposal(data):
     if collection_auction_offers is None:
-        print("[BROKER_REQUESTS] Database not available")
+        log.warning("Database not available")
         return
     auction_id = data.get("auction_id")
-    #Buscar auction_id en la colección de ofertas
-    offer = collection_auction_offers.find_one({"auction_id": auction_id})
-    if not offer:
-        print(f"Oferta de subasta no encontrada para auction_id: {auction_id}")
-        return
     #Añadir proposal_id, symbol, ... a proposals de la collection_auction_offers
     proposal_data = {
         "proposal_id": data.get("proposal_id", ""),
@@ -141,16 +222,25 @@ def handle_auction_proposal(data):
         "group_id": data.get("group_id"),
         "operation": data.get("operation", "proposal"),
     }
-    # Insertar proposal_data al array proposals
-    collection_auction_offers.update_one(
-        {"auction_id": auction_id},
-        {"$push": {"proposals": proposal_data}}
-    )
-    print(f"Propuesta de subasta registrada: {proposal_data}")
+    # Insertar proposal_data al array proposals si esa propuesta no está
+    query = {"auction_id": auction_id}
+    if proposal_data["proposal_id"]:
+        query["proposals.proposal_id"] = {"$ne": proposal_data["proposal_id"]}
+    result = collection_auction_offers.update_one(query, {"$push": {"proposals": proposal_data}})
+    if result.matched_count == 0:
+        # Sin oferta o propuesta ya registrada; solo en ese caso se lee la oferta
+        if collection_auction_offers.find_one({"auction_id": auction_id}, {"_id": 1}) is None:
+            log.warning("Oferta de subasta no encontrada para auction_id: %s", auction_id)
+        else:
+            seen_messages.record_duplicate()
+            log.info("Propuesta de subasta repetida ignorada: %s", proposal_data["proposal_id"])
+        return
+    log.info("Propuesta de subasta registrada: %s", proposal_data)
+    return True
 
 def handle_acceptance_response(data):
     if collection_auction_offers is None:
-        print("[BROKER_REQUESTS] Database not available")
+        log.warning("Database not available")
         return
         
     auction_id = data.get("auction_id")
@@ -158,12 +248,12 @@ def handle_acceptance_response(data):
     timestamp = data.get("timestamp")
 
     if not auction_id or not proposal_id:
-        print("Ignorando response sin auction_id o proposal_id:", data)
+        log.warning("Ignorando response sin auction_id o proposal_id: %s", data)
         return
 
     offer = collection_auction_offers.find_one({"auction_id": auction_id})
     if not offer:
-        print(f"Oferta de subasta no encontrada: {auction_id}")
+        log.warning("Oferta de subasta no encontrada: %s", auction_id)
         return
     
     #Buscar propuesta en proposals collection_auction_offers
@@ -173,7 +263,7 @@ def handle_acceptance_response(data):
     proposal_group_27 = next((p for p in offer.get("proposals", []) if p.get("group_id") == "27"), None)
 
     if not proposal:
-        print(f"Propuesta no encontrada en la oferta {auction_id} para proposal_id: {proposal_id}")
+        log.warning("Propuesta no encontrada en la oferta %s para proposal_id: %s", auction_id, proposal_id)
         return
 
     # Actualizar el estado de la oferta a "ACCEPTED"
@@ -182,7 +272,7 @@ def handle_acceptance_response(data):
         {"$set": {"status": "ACCEPTED", "timestamp": timestamp}}
     )
     
-    print(f"Respuesta de aceptación registrada para la propuesta {proposal_id} en la oferta {auction_id}")
+    log.info("Respuesta de aceptación registrada para la propuesta %s en la oferta %s", proposal_id, auction_id)
     #Admin acepta propuesta de otro grupo (Oferta de admin)
     if offer.get("group_id") == "27":
         update_admin_inventary(data)
@@ -192,6 +282,7 @@ def handle_acceptance_response(data):
     #Otro grupo acepta stock a la que admin le hizo una propuesta (Oferta de otro grupo)
     elif proposal_group_27:
         update_admin_inventary(proposal_group_27)
+    return True
         
 def update_admin_inventary(data):
     # Guardar la transacción en la colección de transacciones del administrador
@@ -205,7 +296,7 @@ def update_admin_inventary(data):
 def handle_rejection_response(data):
     #Otro grupo rechaza propuesta de admin, esas stocks vuelven a inventario de grupo
     if collection_auction_offers is None:
-        print("[BROKER_REQUESTS] Database not available")
+        log.warning("Database not available")
         return
         
     auction_id = data.get("auction_id")
@@ -213,18 +304,18 @@ def handle_rejection_response(data):
     timestamp = data.get("timestamp")
 
     if not auction_id or not proposal_id:
-        print("Ignorando response sin auction_id o proposal_id:", data)
+        log.warning("Ignorando response sin auction_id o proposal_id: %s", data)
         return
 
     offer = collection_auction_offers.find_one({"auction_id": auction_id})
     if not offer:
-        print(f"Oferta de subasta no encontrada: {auction_id}")
+        log.warning("Oferta de subasta no encontrada: %s", auction_id)
         return
     
     #Buscar propuesta en proposals collection_auction_offers
     proposal = next((p for p in offer.get("proposals", []) if p.get("proposal_id") == proposal_id), None)
     if not proposal:
-        print(f"Propuesta no encontrada en la oferta {auction_id} para proposal_id: {proposal_id}")
+        log.warning("Propuesta no encontrada en la oferta %s para proposal_id: %s", auction_id, proposal_id)
         return
 
     # Actualizar el estado de la oferta a "REJECTED"
@@ -233,14 +324,15 @@ def handle_rejection_response(data):
         {"$set": {"status": "REJECTED", "timestamp": timestamp}}
     )
     
-    print(f"Respuesta de rechazo registrada para la propuesta {proposal_id} en la oferta {auction_id}")
+    log.info("Respuesta de rechazo registrada para la propuesta %s en la oferta %s", proposal_id, auction_id)
     #Otro grupo rechaza propuesta de admin, esas stocks vuelven a inventario de grupo (Oferta de otro grupo)
     if proposal.get("group_id") == "27":
         update_admin_inventary(proposal)
+    return True
     
 def handle_validation(data):
     if collection_requests is None:
-        print("[BROKER_REQUESTS] Database not available")
+        log.warning("Database not available")
         return
         
     request_id = data.get("request_id")
@@ -248,25 +340,13 @@ def handle_validation(data):
     timestamp = data.get("timestamp")
 
     if not request_id:
-        print("Ignorando response sin request_id:", data)
-        return
-
-    request_result = collection_requests.find_one({"request_id": request_id})
-    if not request_result:
-        print(f"Request no encontrada: {request_id}")
+        log.warning("Ignorando response sin request_id: %s", data)
         return
 
-    update_request_status(request_id, status, timestamp)
-    update_transaction_status(request_id, status, timestamp)
-    
-    stock_result = collection_stocks.find_one({"symbol": request_result["symbol"]})
-
-    if not stock_result:
-        print(f"Stock {request_result['symbol']} no encontrado.")
-        return
-
-    if status == "REJECTED":
-        handle_rejected_response(request_result, stock_result, timestamp)
+    applied = settlement.apply_validation(request_id, status, timestamp)
+    if applied is False:
+        seen_messages.record_duplicate()
+    return bool(applied)
 
 def handle_timestamp(data):
     if data.get("timestamp"):
@@ -280,7 +360,7 @@ def is_response(data):
 
 def handle_purchase_request(data):
     if collection_requests is None:
-        print("[BROKER_REQUESTS] Database not available")
+        log.warning("Database not available")
         return
         
     request_data = {
@@ -290,15 +370,25 @@ def handle_purchase_request(data):
         "symbol": data.get("symbol"),
         "operation": data.get("operation", "BUY"),
         "status": "PENDING",
-        "applied": False,
+        "stock_deducted": False,
         "deposit_token": data.get("deposit_token", ""),
     }
-    collection_requests.insert_one(request_data)
-    print(f"Request registrada: {request_data}")
+    # Solo se inserta si el request_id es nuevo (índice único en requests)
+    try:
+        result = collection_requests.update_one(
+            {"request_id": request_data["request_id"]}, {"$setOnInsert": request_data}, upsert=True)
+    except DuplicateKeyError:
+        result = None
+    if result is None or result.upserted_id is None:
+        seen_messages.record_duplicate()
+        log.info("Request repetida ignorada: %s", request_data["request_id"])
+        return
+    log.info("Request registrada: %s", request_data)
+    return True
 
 def handle_response(data):
     if collection_requests is None:
-        print("[BROKER_REQUESTS] Database not available")
+        log.warning("Database not available")
         return
         
     request_id = data.get("request_id")
@@ -306,147 +396,56 @@ def handle_response(data):
     timestamp = data["timestamp"]
 
     if not request_id:
-        print("Ignorando response sin request_id:", data)
+        log.warning("Ignorando response sin request_id: %s", data)
         return
 
-    request_result = collection_requests.find_one({"request_id": request_id})
-    if not request_result:
-        print(f"Request no encontrada: {request_id}")
-        return
+    applied = settlement.apply_response(request_id, status, timestamp)
+    if applied is False:
+        seen_messages.record_duplicate()
+    return bool(applied)
 
-    update_request_status(request_id, status, timestamp)
-    update_transaction_status(request_id, status, timestamp)
-    
-    stock_result = collection_stocks.find_one({"symbol": request_result["symbol"]})
-    user_transaction = collection_transactions.find_one({"request_id": request_id})
-
-    if not stock_result:
-        print(f"Stock {request_result['symbol']} no encontrado.")
-        return
-
-    if status == "ACCEPTED":
-        handle_accepted_response(request_result, stock_result, timestamp)
-        update_user_wallet(user_transaction, -request_result["quantity"] * stock_result["price"], timestamp)
-    elif status == "REJECTED":
-        handle_rejected_response(request_result, stock_result, timestamp)
-        update_user_wallet(user_transaction, request_result["quantity"] * stock_result["price"], timestamp)
-
-def update_request_status(request_id, status, timestamp):
-    if collection_requests is None:
-        return
-    collection_requests.update_one(
-        {"request_id": request_id},
-        {"$set": {"status": status, "timestamp": timestamp}}
-    )
-    print(f"Request actualizada: {request_id} | Nuevo estado: {status}")
-
-def update_transaction_status(request_id, status, timestamp):
-    if collection_transactions is None:
-        return
-    transaction = collection_transactions.find_one({"request_id": request_id})
-    if transaction:
-        collection_transactions.update_one(
-            {"request_id": request_id},
-            {"$set": {"status": status, "timestamp": timestamp}}
-        )
-        print(f"Transacción actualizada: {request_id} | Nuevo estado: {status}")
-
-def handle_accepted_response(request, stock, timestamp):
-    if collection_stocks is None:
-        return
-    new_quantity = stock["quantity"] - request["quantity"]
-    if new_quantity < 0:
-        print(f"No hay suficiente cantidad de {request['symbol']} para completar la solicitud.")
-        return
-
-    collection_stocks.update_one(
-        {"symbol": request["symbol"]},
-        {"$set": {"quantity": new_quantity, "timestamp": timestamp}}
-    )
-    collection_requests.update_one(
-        {"request_id": request["request_id"]},
-        {"$set": {"applied": True}}
-    )
-    print(f"Stock actualizado: {request['symbol']} | Nueva cantidad: {new_quantity}")
-
-    log_event("BUY", request, stock["price"], timestamp)
-
-def handle_rejected_response(request, stock, timestamp):
-    if collection_stocks is None:
-        return
-    if request["applied"]:
-        new_quantity = stock["quantity"] + request["quantity"]
-        collection_stocks.update_one(
-            {"symbol": request["symbol"]},
-            {"$set": {"quantity": new_quantity, "timestamp": timestamp}}
-        )
-        print(f"Stock actualizado: {request['symbol']} | Nueva cantidad: {new_quantity}")
-    else:
-        collection_requests.update_one(
-            {"request_id": request["request_id"]},
-            {"$set": {"applied": True}}
-        )
-
-def update_user_wallet(transaction, balance_change, timestamp):
-    if collection_users is None:
-        return
-    if not transaction:
-        print("Transacción no encontrada.")
-        return
-    
-    user_id = transaction.get("user_email")
-    user = collection_users.find_one({"correo": user_id})
-    if not user:
-        print(f"Usuario {user_id} no encontrado.")
-        return
-
-    new_balance = user["saldo"] + balance_change
-    collection_users.update_one(
-        {"correo": user_id},
-        {"$set": {"saldo": new_balance, "timestamp": timestamp}}
-    )
-    print(f"Saldo actualizado para el usuario {user_id} | Nuevo saldo: {new_balance}")
-
-def log_event(event_type, request, price, timestamp):
-    if collection_event_log is None:
-        return
-    event_data = {
-        "type": event_type,
-        "symbol": request["symbol"],
-        "quantity": request["quantity"],
-        "group_id": request["group_id"],
-        "price": price,
-        "timestamp": timestamp
-    }
-    collection_event_log.insert_one(event_data)
-    print(f"Compra exitosa registrada en el event_log: {event_data}")
+def _terminate(signum, frame):
+    raise SystemExit(0)
 
 def start_mqtt_client():
-    print("[BROKER_REQUESTS] Entrando a start_mqtt_client")
+    log.debug("Entrando a start_mqtt_client")
     # Skip MQTT connection in CI environment
     if IS_CI:
-        print("[BROKER_REQUESTS] Running in CI environment, skipping MQTT client")
+        log.info("Running in CI environment, skipping MQTT client")
         return
         
+    start_metrics_server()
+
     if not BROKER_HOST:
-        print("[BROKER_REQUESTS] No MQTT broker configured")
+        log.warning("No MQTT broker configured")
         return
-    print("[BROKER_REQUESTS] Iniciando cliente MQTT")
+    log.info("Iniciando cliente MQTT")
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
 
     if MQTT_USER:
         client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
 
     client.on_connect = on_connect
-    client.on_message = on_message
-
-    while True:
-        try:
-            client.connect(BROKER_HOST, BROKER_PORT, keepalive=60)
-            client.loop_forever()
-        except ConnectionRefusedError:
-            print("Conexión rechazada. Reintentando en 5 segundos...")
-            time.sleep(5)
+    client.on_message = timed_handler(on_message)
+
+    global dispatcher
+    dispatcher = ShardedDispatcher("requests", process_message).start()
+    register_stats("mqtt_dispatch", dispatcher.stats, label="shard")
+    register_stats("mqtt_dedup", seen_messages.stats)
+
+    # SIGTERM (docker stop) sale de loop_forever para terminar lo encolado
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        while True:
+            try:
+                client.connect(BROKER_HOST, BROKER_PORT, keepalive=60)
+                client.loop_forever()
+            except ConnectionRefusedError:
+                log.warning("Conexión rechazada. Reintentando en 5 segundos...")
+                time.sleep(5)
+    finally:
+        client.disconnect()
+        dispatcher.close()
 
 if __name__ == "__main__":
     start_mqtt_client()
\ No newline at end of file
@@ -0,0 +1,293 @@
+"""Aplicación de las respuestas y validaciones de una solicitud de compra.
+
+Cada respuesta (``stocks/requests`` con ``kind: response``) o validación
+(``stocks/validation``) se aplica en una sola transacción multi-documento,
+leyendo cada documento a lo más una vez:
+
+1. ``requests``: ``find_one_and_update`` cambia el estado y retorna la
+   solicitud (símbolo, cantidad). Solo aplica si la solicitud no tiene ya
+   esa respuesta (``response_status``) o validación (``validation_status``)
+   ni un estado final (ACCEPTED o REJECTED) por esa misma vía: un mensaje
+   repetido o contradictorio, aunque llegue después de un reinicio o a otra
+   réplica, no encuentra la solicitud y no tiene más efectos.
+2. ``transactions``: ``find_one_and_update`` cambia el estado y retorna el
+   usuario.
+3. ``current_stocks``: ``$inc`` de la cantidad (condicionado a que alcance
+   al comprar) que retorna el precio. ``stock_deducted`` registra si la
+   cantidad está descontada; devolverla lo cambia primero de forma
+   condicionada, así la cantidad se devuelve a lo más una vez.
+4. ``requests`` (``stock_deducted``), ``event_log``, ``wallet_ledger`` y
+   ``users`` (``$inc`` del saldo, ver ``wallet.py``).
+
+Si el servidor no soporta transacciones (standalone) las mismas escrituras
+se hacen sin sesión.
+
+Para medir respuestas por segundo contra un replica set local::
+
+    python settlement.py bench [--responses 5000] [--workers 8]
+"""
+import argparse
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from logs import get_logger
+from wallet import PURCHASE, REFUND, Wallet
+
+log = get_logger("requests")
+
+BENCH_DB_NAME = "stocks_db_settlement_bench"
+# Después de uno de estos estados se ignoran los demás mensajes de la misma vía
+FINAL_STATUSES = ("ACCEPTED", "REJECTED")
+
+
+def supports_transactions(client):
+    """True si el servidor es un replica set o un mongos."""
+    hello = client.admin.command("hello")
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
+
+
+class Settlement:
+    def __init__(self, client, db, use_transactions=None):
+        self.client = client
+        self.requests = db["requests"]
+        self.stocks = db["current_stocks"]
+        self.transactions = db["transactions"]
+        self.event_log = db["event_log"]
+        self.wallet = Wallet(db)
+        self._use_transactions = use_transactions
+        self._lock = threading.Lock()
+
+    @property
+    def use_transactions(self):
+        if self._use_transactions is None:
+            with self._lock:
+                if self._use_transactions is None:
+                    self._use_transactions = supports_transactions(self.client)
+                    log.info("Transacciones %s", "habilitadas" if self._use_transactions else "no soportadas")
+        return self._use_transactions
+
+    def _run(self, callback):
+        if not self.use_transactions:
+            return callback(None)
+        with self.client.start_session() as session:
+            return session.with_transaction(callback)
+
+    def _set_status(self, request_id, status, marker, timestamp, session):
+        """Actualiza el estado de la solicitud y de la transacción del usuario.
+
+        ``marker`` es el campo que guarda el último estado recibido por esa vía
+        (respuesta o validación); si ya tiene ``status`` o un estado final el
+        mensaje no aplica. Retorna la solicitud antes del cambio y la transacción, o
+        ``(None, None)`` si no hay nada que aplicar.
+        """
+        request = self.requests.find_one_and_update(
+            {"request_id": request_id, marker: {"$nin": [status, *FINAL_STATUSES]}},
+            {"$set": {"status": status, marker: status, "timestamp": timestamp}},
+            projection={"_id": 0, "request_id": 1, "symbol": 1, "quantity": 1, "group_id": 1},
+            session=session,
+        )
+        if request is None:
+            return None, None
+        log.info("Request actualizada: %s | Nuevo estado: %s", request_id, status)
+        transaction = self.transactions.find_one_and_update(
+            {"request_id": request_id},
+            {"$set": {"status": status, "timestamp": timestamp}},
+            projection={"_id": 0, "user_email": 1},
+            session=session,
+        )
+        if transaction is not None:
+            log.info("Transacción actualizada: %s | Nuevo estado: %s", request_id, status)
+        return request, transaction
+
+    def _not_applied(self, request_id, session):
+        """False si la solicitud existe (mensaje repetido), None si no existe."""
+        if self.requests.count_documents({"request_id": request_id}, limit=1, session=session):
+            log.info("Mensaje repetido ignorado: %s", request_id)
+            return False
+        log.warning("Request no encontrada: %s", request_id)
+        return None
+
+    def _stock_price(self, symbol, session):
+        stock = self.stocks.find_one({"symbol": symbol}, {"_id": 0, "price": 1}, session=session)
+        return stock["price"] if stock else None
+
+    def _accept(self, request, timestamp, session):
+        """Descuenta la cantidad y registra la compra; retorna el precio."""
+        claimed = self.requests.update_one(
+            {"request_id": request["request_id"], "stock_deducted": {"$ne": True}},
+            {"$set": {"stock_deducted": True}},
+            session=session,
+        )
+        if not claimed.modified_count:
+            # Ya descontada por otra respuesta ACCEPTED
+            return self._stock_price(request["symbol"], session)
+        stock = self.stocks.find_one_and_update(
+            {"symbol": request["symbol"], "quantity": {"$gte": request["quantity"]}},
+            {"$inc": {"quantity": -request["quantity"]}, "$set": {"timestamp": timestamp}},
+            projection={"_id": 0, "price": 1},
+            session=session,
+        )
+        if stock is None:
+            # Sin cantidad suficiente o sin stock: no hay nada que devolver después
+            self.requests.update_one({"request_id": request["request_id"]}, {"$set": {"stock_deducted": False}},
+                                     session=session)
+            price = self._stock_price(request["symbol"], session)
+            if price is not None:
+                log.warning("No hay suficiente cantidad de %s para completar la solicitud.", request["symbol"])
+            return price
+        log.info("Stock actualizado: %s | Cantidad descontada: %s", request["symbol"], request["quantity"])
+        event_data = {
+            "type": "BUY",
+            "symbol": request["symbol"],
+            "quantity": request["quantity"],
+            "group_id": request.get("group_id"),
+            "price": stock["price"],
+            "timestamp": timestamp,
+        }
+        self.event_log.insert_one(event_data, session=session)
+        log.info("Compra exitosa registrada en el event_log: %s", event_data)
+        return stock["price"]
+
+    def _reject(self, request, timestamp, session, need_price=True):
+        """Devuelve la cantidad si estaba descontada; retorna el precio."""
+        released = self.requests.update_one(
+            {"request_id": request["request_id"], "stock_deducted": True},
+            {"$set": {"stock_deducted": False}},
+            session=session,
+        )
+        if released.modified_count:
+            stock = self.stocks.find_one_and_update(
+                {"symbol": request["symbol"]},
+                {"$inc": {"quantity": request["quantity"]}, "$set": {"timestamp": timestamp}},
+                projection={"_id": 0, "price": 1},
+                session=session,
+            )
+            if stock is not None:
+                log.info("Stock actualizado: %s | Cantidad devuelta: %s", request["symbol"], request["quantity"])
+            return stock["price"] if stock else None
+        return self._stock_price(request["symbol"], session) if need_price else None
+
+    def _adjust_wallet(self, transaction, request_id, kind, amount, timestamp, session):
+        if not transaction:
+            log.warning("Transacción no encontrada.")
+            return
+        user_id = transaction.get("user_email")
+        # Una respuesta repetida usa la misma llave y no mueve el saldo otra vez
+        user = self.wallet.post(user_id, amount, f"{request_id}:{kind}", kind, reference=request_id,
+                                timestamp=timestamp, session=session)
+        if not user:
+            log.warning("Saldo de %s sin cambios: movimiento ya registrado o usuario no encontrado.", user_id)
+            return
+        log.info("Saldo actualizado para el usuario %s | Nuevo saldo: %s", user_id, user["saldo"])
+
+    def apply_response(self, request_id, status, timestamp):
+        """Respuesta ACCEPTED/REJECTED de una solicitud de compra.
+
+        Retorna True si se aplicó, False si era repetida y None si la
+        solicitud no existe.
+        """
+        def callback(session):
+            request, transaction = self._set_status(request_id, status, "response_status", timestamp, session)
+            if request is None:
+                return self._not_applied(request_id, session)
+            if status == "ACCEPTED":
+                price = self._accept(request, timestamp, session)
+                sign, kind = -1, PURCHASE
+            elif status == "REJECTED":
+                price = self._reject(request, timestamp, session)
+                sign, kind = 1, REFUND
+            else:
+                return True
+            if price is None:
+                log.warning("Stock %s no encontrado.", request["symbol"])
+                return True
+            self._adjust_wallet(transaction, request_id, kind, sign * request["quantity"] * price, timestamp, session)
+            return True
+
+        return self._run(callback)
+
+    def apply_validation(self, request_id, status, timestamp):
+        """Validación del pago; solo un rechazo devuelve la cantidad.
+
+        Retorna lo mismo que ``apply_response``.
+        """
+        def callback(session):
+            request, _ = self._set_status(request_id, status, "validation_status", timestamp, session)
+            if request is None:
+                return self._not_applied(request_id, session)
+            if status == "REJECTED":
+                self._reject(request, timestamp, session, need_price=False)
+            return True
+
+        return self._run(callback)
+
+
+def seed_bench(db, responses, symbols):
+    db.client.drop_database(db.name)
+    names = [f"R{i:03d}" for i in range(symbols)]
+    db["current_stocks"].insert_many([{"symbol": name, "price": 10.0, "quantity": 10 ** 9} for name in names])
+    db["users"].insert_many([{"correo": f"user-{i}", "saldo": 10.0 ** 9} for i in range(100)])
+    request_ids = [str(uuid.uuid4()) for _ in range(responses)]
+    db["requests"].insert_many([{
+        "request_id": request_id, "group_id": "27", "quantity": 1, "symbol": names[i % symbols],
+        "operation": "BUY", "status": "PENDING", "stock_deducted": False,
+    } for i, request_id in enumerate(request_ids)])
+    db["transactions"].insert_many([{
+        "request_id": request_id, "symbol": names[i % symbols], "quantity": 1,
+        "user_email": f"user-{i % 100}", "status": "PENDING",
+    } for i, request_id in enumerate(request_ids)])
+    for name in ("requests", "transactions"):
+        db[name].create_index("request_id", unique=True)
+    db["users"].create_index("correo", unique=True)
+    db["wallet_ledger"].create_index("request_id", unique=True)
+    db["current_stocks"].create_index("symbol", unique=True)
+    return request_ids
+
+
+def bench(client, responses, workers, symbols):
+    db = client[BENCH_DB_NAME]
+    for use_transactions in (True, False):
+        if use_transactions and not supports_transactions(client):
+            print("El servidor no es un replica set; se omite el modo con transacciones")
+            continue
+        request_ids = seed_bench(db, responses, symbols)
+        settlement = Settlement(client, db, use_transactions=use_transactions)
+        timestamp = datetime.utcnow()
+        chunks = [request_ids[i::workers] for i in range(workers)]
+
+        def work(chunk):
+            for n, request_id in enumerate(chunk):
+                # 1 de cada 10 respuestas es un rechazo
+                settlement.apply_response(request_id, "REJECTED" if n % 10 == 9 else "ACCEPTED", timestamp)
+
+        threads = [threading.Thread(target=work, args=(chunk,)) for chunk in chunks]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        accepted = db["requests"].count_documents({"status": "ACCEPTED", "stock_deducted": True})
+        print(f"{'transacción' if use_transactions else 'sin sesión':12} {responses} respuestas en "
+              f"{elapsed:.2f}s -> {responses / elapsed:,.0f} resp/s ({accepted} aplicadas)")
+    client.drop_database(BENCH_DB_NAME)
+    return 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=f"python {argv[0]}")
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--responses", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--symbols", type=int, default=20)
+    args = parser.parse_args(argv[1:])
+
+    from database import get_client
+    return bench(get_client(), args.responses, args.workers, args.symbols)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
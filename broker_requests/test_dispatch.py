@@ -0,0 +1,83 @@
+import threading
+import time
+
+from dedup import SeenCache
+from dispatch import ShardedDispatcher
+
+
+def test_dispatcher_keeps_order_per_key():
+    # Prueba que los mensajes de una misma llave se procesan en orden aunque
+    # caigan en workers distintos de los de otras llaves
+    processed = []
+    lock = threading.Lock()
+
+    def handler(key, n):
+        time.sleep(0.001 * (n % 3))
+        with lock:
+            processed.append((key, n))
+
+    dispatcher = ShardedDispatcher("test", handler, workers=4, queue_size=5).start()
+    keys = [f"S{i}" for i in range(8)]
+    for n in range(20):
+        for key in keys:
+            dispatcher.submit(key, key, n)
+    dispatcher.close()
+
+    assert len(processed) == 160
+    for key in keys:
+        assert [n for k, n in processed if k == key] == list(range(20))
+    assert sum(shard["processed"] for shard in dispatcher.stats()) == 160
+
+
+def test_dispatcher_blocks_when_the_queue_is_full_and_survives_errors():
+    # Prueba que submit espera con la cola llena (y lo cuenta) y que un error
+    # del handler no detiene al worker
+    started = threading.Event()
+    release = threading.Event()
+    done = []
+
+    def handler(n):
+        if n == 0:
+            started.set()
+            release.wait(5)
+            raise RuntimeError("falla")
+        done.append(n)
+
+    dispatcher = ShardedDispatcher("test", handler, workers=1, queue_size=1).start()
+    dispatcher.submit("k", 0)
+    assert started.wait(5)
+    dispatcher.submit("k", 1)
+    blocked = threading.Thread(target=dispatcher.submit, args=("k", 2))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+    assert dispatcher.stats()[0]["blocked"] == 1
+
+    release.set()
+    blocked.join(5)
+    dispatcher.close()
+    assert done == [1, 2]
+    assert dispatcher.stats()[0]["errors"] == 1
+
+
+def test_seen_cache_evicts_oldest_and_expires_by_ttl():
+    # Prueba que el cache descarta repetidos, olvida la llave más antigua al
+    # llenarse y deja pasar una llave cuyo TTL venció
+    now = [0.0]
+    cache = SeenCache(max_entries=2, ttl=10, clock=lambda: now[0])
+    assert cache.seen(None) is False
+    assert cache.seen(None) is False
+    assert cache.seen("a") is False
+    assert cache.seen("a") is True
+    assert cache.seen("b") is False
+    assert cache.seen("c") is False
+    # "a" salió por capacidad
+    assert cache.seen("a") is False
+    assert cache.stats()["evicted"] == 2
+
+    now[0] = 9.0
+    assert cache.seen("c") is True
+    now[0] = 20.0
+    assert cache.seen("c") is False
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["dropped"] == 2
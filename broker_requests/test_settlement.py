@@ -0,0 +1,122 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from settlement import Settlement
+
+TS = datetime(2024, 5, 1, 12, 0)
+
+
+def _matches(document, query):
+    for field, condition in query.items():
+        value = document.get(field)
+        values = value if isinstance(value, list) else [value]
+        if isinstance(condition, dict):
+            if "$ne" in condition and condition["$ne"] in values:
+                return False
+            if "$nin" in condition and any(v in condition["$nin"] for v in values):
+                return False
+            if "$gte" in condition and not (value is not None and value >= condition["$gte"]):
+                return False
+        elif condition not in values:
+            return False
+    return True
+
+
+def _apply(document, update):
+    for field, value in update.get("$set", {}).items():
+        document[field] = value
+    for field, value in update.get("$inc", {}).items():
+        document[field] = document.get(field, 0) + value
+    for field, value in update.get("$push", {}).items():
+        document[field] = (document.get(field, []) + value["$each"])[value["$slice"]:]
+
+
+class FakeCollection:
+    """Colección en memoria con los operadores que usa Settlement."""
+
+    def __init__(self, documents=()):
+        self.documents = [dict(document) for document in documents]
+
+    def _find(self, query):
+        return next((d for d in self.documents if _matches(d, query)), None)
+
+    def find_one(self, query, projection=None, session=None):
+        document = self._find(query)
+        return dict(document) if document else None
+
+    def find_one_and_update(self, query, update, projection=None, return_document=False, session=None):
+        document = self._find(query)
+        if document is None:
+            return None
+        before = dict(document)
+        _apply(document, update)
+        return dict(document) if return_document else before
+
+    def update_one(self, query, update, upsert=False, session=None):
+        document = self._find(query)
+        if document is None:
+            if not upsert:
+                return SimpleNamespace(modified_count=0, upserted_id=None)
+            document = {**query, **update.get("$setOnInsert", {})}
+            self.documents.append(document)
+            return SimpleNamespace(modified_count=0, upserted_id=len(self.documents))
+        before = dict(document)
+        _apply(document, update)
+        return SimpleNamespace(modified_count=int(before != document), upserted_id=None)
+
+    def count_documents(self, query, limit=0, session=None):
+        return sum(1 for d in self.documents if _matches(d, query))
+
+    def insert_one(self, document, session=None):
+        self.documents.append(dict(document))
+
+
+@pytest.fixture
+def settlement():
+    db = {
+        "requests": FakeCollection([{"request_id": "r1", "symbol": "AAPL", "quantity": 2, "group_id": "27",
+                                     "status": "PENDING", "stock_deducted": False}]),
+        "transactions": FakeCollection([{"request_id": "r1", "user_email": "a@b.cl", "status": "PENDING"}]),
+        "current_stocks": FakeCollection([{"symbol": "AAPL", "price": 10.0, "quantity": 5}]),
+        "event_log": FakeCollection(),
+        "wallet_ledger": FakeCollection(),
+        "users": FakeCollection([{"correo": "a@b.cl", "saldo": 100.0}]),
+    }
+    return Settlement(None, db, use_transactions=False), db
+
+
+def quantity(db):
+    return db["current_stocks"].documents[0]["quantity"]
+
+
+def test_repeated_messages_change_stock_and_ledger_once(settlement):
+    # Prueba que una respuesta o validación repetida no vuelve a mover la
+    # cantidad, el saldo ni el ledger
+    settlement, db = settlement
+    assert settlement.apply_response("r1", "ACCEPTED", TS) is True
+    assert settlement.apply_response("r1", "ACCEPTED", TS) is False
+    assert quantity(db) == 3
+    assert db["users"].documents[0]["saldo"] == 80.0
+    assert [e["request_id"] for e in db["wallet_ledger"].documents] == ["r1:purchase"]
+
+    assert settlement.apply_validation("r1", "REJECTED", TS) is True
+    assert settlement.apply_validation("r1", "REJECTED", TS) is False
+    assert quantity(db) == 5
+    assert len(db["wallet_ledger"].documents) == 1
+    assert settlement.apply_validation("missing", "REJECTED", TS) is None
+
+
+def test_rejected_after_accepted_is_a_noop(settlement):
+    # Prueba que un REJECTED que llega después de un ACCEPTED por la misma
+    # vía no devuelve la cantidad ni reembolsa
+    settlement, db = settlement
+    assert settlement.apply_validation("r1", "ACCEPTED", TS) is True
+    assert settlement.apply_response("r1", "ACCEPTED", TS) is True
+    assert settlement.apply_validation("r1", "REJECTED", TS) is False
+    assert settlement.apply_response("r1", "REJECTED", TS) is False
+    assert quantity(db) == 3
+    assert db["users"].documents[0]["saldo"] == 80.0
+    assert db["requests"].documents[0]["stock_deducted"] is True
+    assert len(db["wallet_ledger"].documents) == 1
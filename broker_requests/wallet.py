@@ -0,0 +1,69 @@
+"""Movimientos de saldo de los usuarios desde el broker.
+
+Escribe en ``wallet_ledger`` los mismos documentos que ``api/wallet.py``: un
+movimiento por ``request_id`` (índice único) y el saldo de ``users`` ajustado
+con ``$inc``, condicionado a que el ``request_id`` no esté en
+``wallet_applied``. Un ``request_id`` repetido no vuelve a mover el saldo y
+completa el movimiento si faltaba.
+"""
+import os
+from datetime import datetime
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+LEDGER_COLLECTION = "wallet_ledger"
+APPLIED_FIELD = "wallet_applied"
+WALLET_RECENT_REQUESTS = int(os.getenv("WALLET_RECENT_REQUESTS", "100"))
+
+PURCHASE = "purchase"
+REFUND = "refund"
+
+
+def ledger_entry(request_id, correo, amount, kind, reference=None, timestamp=None):
+    return {
+        "request_id": request_id,
+        "correo": correo,
+        "amount": amount,
+        "kind": kind,
+        "reference": reference,
+        "timestamp": timestamp or datetime.utcnow(),
+    }
+
+
+class Wallet:
+    def __init__(self, db):
+        self.ledger = db[LEDGER_COLLECTION]
+        self.users = db["users"]
+
+    def _record(self, entry, session):
+        try:
+            result = self.ledger.update_one(
+                {"request_id": entry["request_id"]}, {"$setOnInsert": entry}, upsert=True, session=session)
+        except DuplicateKeyError:
+            # Dentro de una transacción el error la aborta: se deja subir
+            if session is not None:
+                raise
+            return False
+        return result.upserted_id is not None
+
+    def post(self, correo, amount, request_id, kind, reference=None, timestamp=None, session=None):
+        """Ajusta el saldo de un usuario existente y registra el movimiento.
+
+        Retorna el usuario con el saldo nuevo, o None si el movimiento ya
+        estaba aplicado o el usuario no existe.
+        """
+        user = self.users.find_one_and_update(
+            {"correo": correo, APPLIED_FIELD: {"$ne": request_id}},
+            {"$inc": {"saldo": amount}, "$set": {"timestamp": timestamp},
+             "$push": {APPLIED_FIELD: {"$each": [request_id], "$slice": -WALLET_RECENT_REQUESTS}}},
+            projection={"_id": 0, "saldo": 1},
+            return_document=ReturnDocument.AFTER,
+            session=session,
+        )
+        if user is None and not self.users.find_one(
+                {"correo": correo, APPLIED_FIELD: request_id}, {"_id": 1}, session=session):
+            return None
+        # También cuando ya estaba aplicado, por si faltó el movimiento
+        self._record(ledger_entry(request_id, correo, amount, kind, reference, timestamp), session)
+        return user
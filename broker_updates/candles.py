@@ -0,0 +1,145 @@
+"""Velas OHLCV por símbolo mantenidas a partir de stocks/updates.
+
+Cada evento IPO/EMIT/UPDATE actualiza la vela de 1m, 5m, 1h y 1d que le
+corresponde en la colección ``candles`` con un upsert atómico, así los
+gráficos leen las velas en lugar de recorrer ``event_log``. Las velas guardan
+el timestamp del primer y último precio para que un mensaje que llega
+desordenado no cambie la apertura o el cierre.
+
+Para construir las velas desde el ``event_log`` existente::
+
+    python candles.py backfill [SYMBOL]
+"""
+import sys
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, IndexModel, UpdateOne
+
+from database import get_db
+
+# Intervalo -> (segundos, unidad y tamaño para $dateTrunc)
+INTERVALS = {
+    "1m": (60, "minute", 1),
+    "5m": (300, "minute", 5),
+    "1h": (3600, "hour", 1),
+    "1d": (86400, "day", 1),
+}
+
+CANDLE_INDEX = IndexModel(
+    [("symbol", ASCENDING), ("interval", ASCENDING), ("start", ASCENDING)],
+    name="symbol_interval_start",
+    unique=True,
+)
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _utc_naive(timestamp):
+    # MongoDB guarda las fechas en UTC sin zona horaria
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def bucket_start(timestamp, seconds):
+    """Inicio de la vela de ``seconds`` segundos que contiene ``timestamp``."""
+    timestamp = _utc_naive(timestamp)
+    elapsed = int((timestamp - _EPOCH).total_seconds())
+    return _EPOCH + timedelta(seconds=elapsed - elapsed % seconds)
+
+
+def candle_updates(symbol, price, quantity, timestamp):
+    """Operaciones de upsert para las velas de todos los intervalos."""
+    timestamp = _utc_naive(timestamp)
+    price = float(price)
+    quantity = float(quantity or 0)
+    operations = []
+    for interval, (seconds, _, _) in INTERVALS.items():
+        # Se evalúan sobre el documento anterior: high/low/volume acumulan y
+        # open/close solo cambian si el mensaje es el más antiguo/reciente
+        operations.append(UpdateOne(
+            {"symbol": symbol, "interval": interval, "start": bucket_start(timestamp, seconds)},
+            [{"$set": {
+                "open": {"$cond": [{"$lte": [timestamp, {"$ifNull": ["$open_at", timestamp]}]}, price, "$open"]},
+                "open_at": {"$min": ["$open_at", timestamp]},
+                "high": {"$max": ["$high", price]},
+                "low": {"$min": ["$low", price]},
+                "close": {"$cond": [{"$gte": [timestamp, {"$ifNull": ["$close_at", timestamp]}]}, price, "$close"]},
+                "close_at": {"$max": ["$close_at", timestamp]},
+                "volume": {"$add": [{"$ifNull": ["$volume", 0]}, quantity]},
+                "trades": {"$add": [{"$ifNull": ["$trades", 0]}, 1]},
+            }}],
+            upsert=True,
+        ))
+    return operations
+
+
+def record_event(collection, symbol, price, quantity, timestamp):
+    """Actualiza las velas del símbolo con un evento de precio."""
+    if collection is None or price is None or timestamp is None:
+        return
+    collection.bulk_write(candle_updates(symbol, price, quantity, timestamp), ordered=False)
+
+
+def ensure_candle_index(collection):
+    collection.create_indexes([CANDLE_INDEX])
+
+
+def backfill_pipeline(interval, symbol=None):
+    """Agregación que reconstruye las velas de ``interval`` desde event_log."""
+    _, unit, bin_size = INTERVALS[interval]
+    match = {"timestamp": {"$type": "date"}, "price": {"$ne": None}}
+    if symbol:
+        match["symbol"] = symbol
+    return [
+        {"$match": match},
+        {"$sort": {"timestamp": 1, "_id": 1}},
+        {"$group": {
+            "_id": {
+                "symbol": "$symbol",
+                "start": {"$dateTrunc": {"date": "$timestamp", "unit": unit, "binSize": bin_size}},
+            },
+            "open": {"$first": "$price"},
+            "open_at": {"$first": "$timestamp"},
+            "high": {"$max": "$price"},
+            "low": {"$min": "$price"},
+            "close": {"$last": "$price"},
+            "close_at": {"$last": "$timestamp"},
+            "volume": {"$sum": {"$ifNull": ["$quantity", 0]}},
+            "trades": {"$sum": 1},
+        }},
+        {"$project": {
+            "_id": 0,
+            "symbol": "$_id.symbol",
+            "interval": {"$literal": interval},
+            "start": "$_id.start",
+            "open": 1, "open_at": 1, "high": 1, "low": 1,
+            "close": 1, "close_at": 1, "volume": 1, "trades": 1,
+        }},
+        {"$merge": {
+            "into": "candles",
+            "on": ["symbol", "interval", "start"],
+            "whenMatched": "replace",
+            "whenNotMatched": "insert",
+        }},
+    ]
+
+
+def backfill(db, symbol=None):
+    """Reconstruye todas las velas desde event_log (idempotente)."""
+    ensure_candle_index(db["candles"])
+    for interval in INTERVALS:
+        db["event_log"].aggregate(backfill_pipeline(interval, symbol), allowDiskUse=True)
+        print(f"[CANDLES] Velas de {interval} reconstruidas" + (f" para {symbol}" if symbol else ""))
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] != "backfill":
+        print(f"Uso: python {argv[0]} backfill [SYMBOL]")
+        return 2
+    backfill(get_db(), argv[2] if len(argv) > 2 else None)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,167 @@
+import os
+import threading
+from importlib.util import find_spec
+
+from pymongo import MongoClient, monitoring
+
+from metrics import MongoCommandMetrics, register_stats
+
+from dotenv import load_dotenv
+load_dotenv()
+
+DB_NAME = "stocks_db"
+
+# Librerías que sirven a cada compresor de pymongo (zlib viene con Python;
+# zstd viene con Python 3.14 o con backports.zstd en versiones anteriores)
+COMPRESSOR_MODULES = {"zstd": ("compression.zstd", "backports.zstd"), "snappy": ("snappy",), "zlib": ("zlib",)}
+
+# Buckets (segundos) del histograma de espera al pedir una conexión al pool
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Métricas del pool de conexiones de un cliente de MongoDB.
+
+    Registra la espera para obtener una conexión (checkout), el tamaño del
+    pool y cuántas conexiones se abren y cierran (churn).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.wait_buckets = [0] * (len(WAIT_BUCKETS) + 1)
+        self.connections_created = 0
+        self.connections_closed = 0
+        self.checked_out = 0
+        self.pools_cleared = 0
+
+    def _observe_wait(self, duration):
+        self.wait_seconds_total += duration
+        self.wait_seconds_max = max(self.wait_seconds_max, duration)
+        for i, bound in enumerate(WAIT_BUCKETS):
+            if duration <= bound:
+                self.wait_buckets[i] += 1
+                return
+        self.wait_buckets[-1] += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self._observe_wait(event.duration)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+            self._observe_wait(event.duration)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections_created += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections_closed += 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pools_cleared += 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "client": self.name,
+                "pool_size": self.connections_created - self.connections_closed,
+                "in_use": self.checked_out,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "wait_seconds_total": round(self.wait_seconds_total, 6),
+                "wait_seconds_max": round(self.wait_seconds_max, 6),
+                "wait_seconds_buckets": dict(zip([*map(str, WAIT_BUCKETS), "+Inf"], self.wait_buckets)),
+                "connections_created": self.connections_created,
+                "connections_closed": self.connections_closed,
+                "pools_cleared": self.pools_cleared,
+            }
+
+
+pool_metrics = PoolMetrics("broker_updates")
+command_metrics = MongoCommandMetrics("broker_updates")
+register_stats("mongodb_pool", pool_metrics.snapshot, label="client")
+
+
+def _module_available(name):
+    try:
+        return find_spec(name) is not None
+    except ModuleNotFoundError:
+        return False
+
+
+def _compressors():
+    requested = [name.strip() for name in os.getenv("MONGO_COMPRESSORS", "zstd,snappy,zlib").split(",")]
+    available = [name for name in requested
+                 if any(_module_available(module) for module in COMPRESSOR_MODULES.get(name, ()))]
+    return ",".join(available)
+
+
+def client_options():
+    """Opciones del cliente desde variables de entorno."""
+    options = {
+        "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+        "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+        "maxIdleTimeMS": int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000")),
+        "waitQueueTimeoutMS": int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000")),
+        "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "30000")),
+        "appname": os.getenv("MONGO_APP_NAME", "broker-updates"),
+    }
+    compressors = _compressors()
+    if compressors:
+        options["compressors"] = compressors
+    if os.getenv("MONGO_WRITE_CONCERN"):
+        w = os.getenv("MONGO_WRITE_CONCERN")
+        options["w"] = int(w) if w.isdigit() else w
+    if os.getenv("MONGO_READ_CONCERN"):
+        options["readConcernLevel"] = os.getenv("MONGO_READ_CONCERN")
+    if os.getenv("MONGO_READ_PREFERENCE"):
+        options["readPreference"] = os.getenv("MONGO_READ_PREFERENCE")
+    return options
+
+
+_client_lock = threading.Lock()
+_client = None
+
+
+def get_client():
+    """Cliente compartido por todo el proceso."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = MongoClient(os.getenv("MONGO_URI"), event_listeners=[pool_metrics, command_metrics],
+                                  **client_options())
+        return _client
+
+
+def get_db():
+    return get_client()[DB_NAME]
@@ -0,0 +1,89 @@
+"""Reparto de los mensajes MQTT a un pool de workers por llave.
+
+El hilo de red de paho solo decodifica el mensaje y lo encola; cada worker
+tiene su propia cola acotada y procesa los mensajes en orden. La llave
+(símbolo, ``request_id``, ...) decide el worker, así los mensajes de una
+misma llave se procesan en el orden en que llegaron mientras los de otras
+llaves avanzan en paralelo.
+
+Si la cola de un worker está llena ``submit`` espera (backpressure): el
+hilo de red deja de leer y el broker retiene los mensajes.
+
+Configuración: ``DISPATCH_WORKERS`` (4) y ``DISPATCH_QUEUE_SIZE`` (1000).
+"""
+import os
+import queue
+import threading
+import zlib
+
+from logs import get_logger
+
+log = get_logger("dispatch")
+
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "4"))
+DISPATCH_QUEUE_SIZE = int(os.getenv("DISPATCH_QUEUE_SIZE", "1000"))
+
+_STOP = object()
+
+
+class ShardedDispatcher:
+    def __init__(self, name, handler, workers=DISPATCH_WORKERS, queue_size=DISPATCH_QUEUE_SIZE):
+        self.name = name
+        self.handler = handler
+        workers = max(1, workers)
+        self._queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in range(workers)]
+        self._threads = []
+        self.processed = [0] * workers
+        self.errors = [0] * workers
+        # Veces que el hilo de red esperó por una cola llena
+        self.blocked = [0] * workers
+
+    def shard(self, key):
+        # crc32 y no hash(): el reparto es el mismo entre reinicios
+        return zlib.crc32(str(key).encode("utf-8")) % len(self._queues)
+
+    def start(self):
+        for index in range(len(self._queues)):
+            thread = threading.Thread(target=self._run, args=(index,), name=f"{self.name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, key, *args):
+        index = self.shard(key)
+        try:
+            self._queues[index].put_nowait(args)
+        except queue.Full:
+            self.blocked[index] += 1
+            self._queues[index].put(args)
+
+    def close(self, timeout=30):
+        """Procesa lo encolado y detiene los workers."""
+        for worker_queue in self._queues:
+            worker_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self, index):
+        worker_queue = self._queues[index]
+        while True:
+            item = worker_queue.get()
+            if item is _STOP:
+                return
+            try:
+                self.handler(*item)
+                self.processed[index] += 1
+            except Exception:
+                self.errors[index] += 1
+                log.exception("Error procesando un mensaje en %s-%s", self.name, index)
+
+    def stats(self):
+        return [{
+            "shard": index,
+            "depth": worker_queue.qsize(),
+            "capacity": worker_queue.maxsize,
+            "processed": self.processed[index],
+            "errors": self.errors[index],
+            "blocked": self.blocked[index],
+        } for index, worker_queue in enumerate(self._queues)]
@@ -0,0 +1,409 @@
+"""Escritura de los mensajes de stocks/updates en MongoDB.
+
+``write_message`` aplica un mensaje con una escritura por colección (el
+camino original, un round trip tras otro). ``IngestBuffer`` junta los
+mensajes y los escribe en lotes con ``bulk_write`` sin orden: el lote se
+envía al llegar a ``INGEST_BATCH_SIZE`` mensajes o ``INGEST_FLUSH_MS``
+milisegundos después del primero, lo que ocurra antes.
+
+Las escrituras de ``current_stocks`` del mismo símbolo se reparten en
+"olas" sucesivas (una operación por símbolo en cada ``bulk_write``) para
+que se apliquen en el orden en que llegaron; los UPDATE seguidos de un
+símbolo se reducen al último porque solo reemplazan precio y timestamp.
+Para saber si un símbolo ya existe sin consultar cada vez, el buffer
+mantiene el conjunto de símbolos conocidos.
+
+Los mensajes no traen un id, así que cada evento guarda ``key`` (tipo,
+símbolo, timestamp, precio y cantidad) con un índice único en ``event_log``.
+El evento se inserta antes que el resto: una entrega repetida, aunque llegue
+después de un reinicio, choca con el índice y no vuelve a sumar cantidad ni
+a actualizar las velas. Si después falla la escritura del stock, el evento se
+borra para que una nueva entrega se pueda aplicar. Los EMIT y UPDATE de un
+símbolo que aún no existe no tienen evento y solo los cubre el cache en
+memoria.
+
+Para comparar ambos caminos con una ráfaga sintética::
+
+    python ingest.py bench [--messages 20000] [--symbols 50]
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+from candles import candle_updates, record_event
+from logs import get_logger
+
+log = get_logger("ingest")
+
+INGEST_BUFFERED = os.getenv("INGEST_BUFFERED", "true").lower() != "false"
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_FLUSH_SECONDS = float(os.getenv("INGEST_FLUSH_MS", "5")) / 1000
+# Mensajes pendientes antes de frenar al hilo de paho
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "10000"))
+
+KINDS = ("IPO", "EMIT", "UPDATE")
+
+DUPLICATE_KEY = 11000
+# Solo los eventos con llave; los anteriores a ella no entran al índice
+EVENT_KEY_INDEX = IndexModel([("key", ASCENDING)], name="key", unique=True,
+                             partialFilterExpression={"key": {"$type": "string"}})
+BENCH_DB_NAME = "stocks_db_ingest_bench"
+
+
+def update_key(data):
+    """Llave de un mensaje de stocks/updates; None sin símbolo o timestamp."""
+    timestamp = data.get("timestamp")
+    if not data.get("symbol") or not timestamp:
+        return None
+    if isinstance(timestamp, datetime):
+        timestamp = timestamp.isoformat()
+    return f"{data.get('kind')}|{data['symbol']}|{timestamp}|{data.get('price')}|{data.get('quantity')}"
+
+
+def ensure_event_key_index(collection):
+    collection.create_indexes([EVENT_KEY_INDEX])
+
+
+def event_document(data, quantity=None, long_name=None):
+    document = {
+        "_id": ObjectId(),
+        "type": data["kind"],
+        "symbol": data["symbol"],
+        "quantity": data["quantity"] if quantity is None else quantity,
+        "price": data["price"],
+        "longName": data.get("longName", "") if long_name is None else long_name,
+        "timestamp": data["timestamp"],
+    }
+    key = update_key(data)
+    if key is not None:
+        document["key"] = key
+    return document
+
+
+def stock_operation(data):
+    """Upsert de ``current_stocks`` equivalente al camino original."""
+    kind = data["kind"]
+    symbol = data.get("symbol")
+    if kind == "IPO":
+        return UpdateOne({"symbol": symbol}, {"$set": {
+            "symbol": data.get("symbol", "SYMBOL"),
+            "quantity": data.get("quantity", 0),
+            "price": data.get("price", 0),
+            "longName": data.get("longName"),
+            "timestamp": data.get("timestamp"),
+            "owner_type": "platform",
+        }}, upsert=True)
+    if kind == "EMIT":
+        return UpdateOne({"symbol": symbol}, {
+            "$set": {"price": data.get("price", 0), "timestamp": data.get("timestamp"), "owner_type": "platform"},
+            "$inc": {"quantity": data.get("quantity", 0)},
+            "$setOnInsert": {"longName": data.get("longName")},
+        }, upsert=True)
+    return UpdateOne({"symbol": symbol}, {
+        "$set": {"price": data.get("price", 0), "timestamp": data["timestamp"], "owner_type": "platform"},
+        "$setOnInsert": {"quantity": 0, "longName": ""},
+    }, upsert=True)
+
+
+def message_event(data, exists):
+    """Evento de event_log del mensaje; EMIT y UPDATE solo se registran si
+    el símbolo ya existía (``exists``)."""
+    kind = data["kind"]
+    if kind == "IPO":
+        return event_document(data)
+    if not exists:
+        return None
+    if kind == "EMIT":
+        return event_document(data)
+    return event_document(data, quantity=0, long_name="")
+
+
+def write_message(db, data):
+    """Aplica un mensaje con escrituras individuales (sin buffer).
+
+    Retorna True si escribió algo; False si el mensaje no aplica o es repetido.
+    """
+    kind = data.get("kind")
+    if kind not in KINDS:
+        return False
+    stocks = db["current_stocks"]
+    exists = kind != "IPO" and stocks.find_one({"symbol": data.get("symbol")}, {"_id": 1}) is not None
+    try:
+        event = message_event(data, exists)
+    except KeyError as e:
+        log.warning("Mensaje %s de %s sin el campo %s", kind, data.get("symbol"), e)
+        return False
+    if event is not None:
+        try:
+            db["event_log"].insert_one(event)
+        except DuplicateKeyError:
+            log.info("Update repetido ignorado: %s", event["key"])
+            return False
+    try:
+        stocks.bulk_write([stock_operation(data)])
+    except PyMongoError:
+        if event is not None:
+            db["event_log"].delete_one({"_id": event["_id"]})
+        raise
+    if event is not None:
+        try:
+            record_event(db["candles"], event["symbol"], event["price"], event["quantity"], event["timestamp"])
+        except PyMongoError as e:
+            log.error("No se pudo actualizar las velas de %s: %s", event["symbol"], e)
+    return True
+
+
+def _waves(operations):
+    """Reparte (símbolo, kind, operación) en olas de (símbolo, operación) con
+    a lo más una operación por símbolo, respetando el orden de llegada."""
+    by_symbol = {}
+    for symbol, kind, operation in operations:
+        queue = by_symbol.setdefault(symbol, [])
+        if kind == "UPDATE" and queue and queue[-1][0] == "UPDATE":
+            queue[-1] = (kind, operation)
+        else:
+            queue.append((kind, operation))
+    waves = []
+    for symbol, queue in by_symbol.items():
+        for i, (_, operation) in enumerate(queue):
+            if i == len(waves):
+                waves.append([])
+            waves[i].append((symbol, operation))
+    return waves
+
+
+class IngestBuffer:
+    def __init__(self, db, batch_size=INGEST_BATCH_SIZE, flush_interval=INGEST_FLUSH_SECONDS,
+                 max_pending=INGEST_MAX_PENDING, on_flush=None):
+        self.stocks = db["current_stocks"]
+        self.event_log = db["event_log"]
+        self.candles = db["candles"]
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_pending = max(self.batch_size, max_pending)
+        # Se llama con los nombres de las colecciones escritas en cada lote
+        self.on_flush = on_flush
+        self._known = set()
+        self._pending = []
+        self._first_at = None
+        self._cond = threading.Condition()
+        self._closing = False
+        self._thread = None
+        self.messages = 0
+        self.flushes = 0
+        self.write_errors = 0
+        self.duplicates = 0
+        self.last_flush_seconds = 0.0
+
+    def start(self):
+        """Carga los símbolos existentes e inicia el hilo que escribe los lotes."""
+        self._known = set(self.stocks.distinct("symbol"))
+        self._thread = threading.Thread(target=self._run, name="ingest-buffer", daemon=True)
+        self._thread.start()
+        return self
+
+    def add(self, data):
+        if data.get("kind") not in KINDS:
+            return
+        with self._cond:
+            while len(self._pending) >= self.max_pending and not self._closing:
+                self._cond.wait()
+            if not self._pending:
+                self._first_at = time.monotonic()
+            self._pending.append(data)
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+
+    def close(self, timeout=10):
+        """Escribe lo pendiente y detiene el hilo."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if self._pending:
+                    if self._closing or len(self._pending) >= self.batch_size:
+                        break
+                    remaining = self._first_at + self.flush_interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                elif self._closing:
+                    return None
+                else:
+                    self._cond.wait()
+            batch = self._pending[:self.batch_size]
+            self._pending = self._pending[self.batch_size:]
+            self._first_at = time.monotonic() if self._pending else None
+            self._cond.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self.flush(batch)
+            except Exception:
+                # El hilo sigue con el próximo lote
+                self.write_errors += 1
+                log.exception("No se pudo escribir un lote de %s mensajes", len(batch))
+
+    def _bulk(self, collection, operations):
+        """Escribe sin orden; retorna índice -> código de las operaciones que fallaron.
+
+        Las llaves duplicadas (eventos repetidos) no se cuentan como errores.
+        """
+        if not operations:
+            return {}
+        try:
+            collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            failed = {error["index"]: error.get("code") for error in e.details.get("writeErrors", [])}
+            errors = [error for error in e.details.get("writeErrors", []) if error.get("code") != DUPLICATE_KEY]
+            self.duplicates += len(failed) - len(errors)
+            if errors:
+                self.write_errors += len(errors)
+                log.error("Errores escribiendo %s: %s", collection.name, errors[:3])
+            return failed
+        return {}
+
+    def flush(self, batch):
+        """Escribe un lote: eventos, stocks por olas y luego velas."""
+        started = time.perf_counter()
+        # (símbolo, kind, operación, evento o None) por mensaje
+        entries = []
+        # Símbolos que aparecen por primera vez en este lote
+        added = set()
+        for data in batch:
+            symbol = data.get("symbol")
+            try:
+                # El evento se arma antes: un mensaje incompleto no escribe nada
+                event = message_event(data, symbol in self._known or symbol in added)
+                entries.append((symbol, data["kind"], stock_operation(data), event))
+            except KeyError as e:
+                log.warning("Mensaje %s de %s sin el campo %s", data.get("kind"), symbol, e)
+                continue
+            added.add(symbol)
+
+        # Primero los eventos: el índice único de key descarta los repetidos
+        # y sus mensajes no se aplican
+        logged = [entry for entry in entries if entry[3] is not None]
+        rejected = self._bulk(self.event_log, [InsertOne(entry[3]) for entry in logged])
+        skipped = {id(logged[index]) for index in rejected}
+        entries = [entry for entry in entries if id(entry) not in skipped]
+
+        # Si falla la escritura de un símbolo se saltan sus olas siguientes,
+        # se borran sus eventos y no queda como conocido
+        failed = set()
+        for wave in _waves([(symbol, kind, operation) for symbol, kind, operation, _ in entries]):
+            wave = [(symbol, operation) for symbol, operation in wave if symbol not in failed]
+            errors = self._bulk(self.stocks, [operation for _, operation in wave])
+            failed.update(wave[index][0] for index in errors)
+        events = [event for symbol, _, _, event in entries if event is not None]
+        if failed:
+            orphaned = [event["_id"] for event in events if event["symbol"] in failed]
+            self.event_log.delete_many({"_id": {"$in": orphaned}})
+            events = [event for event in events if event["symbol"] not in failed]
+        self._known.update({symbol for symbol, _, _, _ in entries} - failed)
+        candles = []
+        for event in events:
+            if event["price"] is not None and event["timestamp"] is not None:
+                candles.extend(candle_updates(event["symbol"], event["price"], event["quantity"], event["timestamp"]))
+        self._bulk(self.candles, candles)
+
+        self.messages += len(batch)
+        self.flushes += 1
+        self.last_flush_seconds = time.perf_counter() - started
+        if self.on_flush is not None:
+            self.on_flush("current_stocks", "event_log")
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "messages": self.messages,
+            "flushes": self.flushes,
+            "write_errors": self.write_errors,
+            "duplicates": self.duplicates,
+            "last_flush_seconds": self.last_flush_seconds,
+            "known_symbols": len(self._known),
+        }
+
+
+def synthetic_burst(messages, symbols, seed=7):
+    """Ráfaga reproducible: IPO por símbolo y luego UPDATE/EMIT mezclados."""
+    rng = random.Random(seed)
+    start = datetime.utcnow().replace(microsecond=0)
+    names = [f"B{i:03d}" for i in range(symbols)]
+    burst = [{"kind": "IPO", "symbol": name, "quantity": 1000, "price": 100.0, "longName": f"Bench {name}",
+              "timestamp": start} for name in names]
+    for i in range(max(0, messages - symbols)):
+        name = rng.choice(names)
+        kind = "EMIT" if rng.random() < 0.1 else "UPDATE"
+        burst.append({"kind": kind, "symbol": name, "quantity": rng.randint(1, 50),
+                      "price": round(rng.uniform(50, 150), 2), "longName": f"Bench {name}",
+                      "timestamp": start + timedelta(milliseconds=i)})
+    return burst
+
+
+def bench(client, messages, symbols, batch_size, flush_interval):
+    burst = synthetic_burst(messages, symbols)
+    results = {}
+    final_stocks = {}
+    for mode in ("direct", "buffered"):
+        client.drop_database(BENCH_DB_NAME)
+        db = client[BENCH_DB_NAME]
+        started = time.perf_counter()
+        if mode == "direct":
+            for data in burst:
+                write_message(db, dict(data))
+        else:
+            buffer = IngestBuffer(db, batch_size=batch_size, flush_interval=flush_interval).start()
+            for data in burst:
+                buffer.add(dict(data))
+            buffer.close(timeout=None)
+        elapsed = time.perf_counter() - started
+        results[mode] = len(burst) / elapsed
+        final_stocks[mode] = {doc["symbol"]: (doc["price"], doc["quantity"])
+                              for doc in db["current_stocks"].find({}, {"_id": 0})}
+        print(f"{mode:9} {len(burst)} mensajes en {elapsed:.2f}s -> {results[mode]:,.0f} msg/s "
+              f"(event_log: {db['event_log'].estimated_document_count()})")
+    client.drop_database(BENCH_DB_NAME)
+    print(f"Aceleración: x{results['buffered'] / results['direct']:.1f}")
+    if final_stocks["direct"] != final_stocks["buffered"]:
+        print("ADVERTENCIA: current_stocks difiere entre ambos caminos")
+        return 1
+    return 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=f"python {argv[0]}")
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--symbols", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument("--flush-ms", type=float, default=INGEST_FLUSH_SECONDS * 1000)
+    args = parser.parse_args(argv[1:])
+
+    from database import get_client
+    return bench(get_client(), args.messages, args.symbols, args.batch_size, args.flush_ms / 1000)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
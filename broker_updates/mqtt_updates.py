@@ -2,181 +2,136 @@ import os
 import json
 import paho.mqtt.client as mqtt
 from dateutil import parser
-from pymongo import MongoClient
+from database import get_client, DB_NAME
+from candles import ensure_candle_index
+from dedup import SeenCache
+from dispatch import ShardedDispatcher
+from ingest import INGEST_BUFFERED, IngestBuffer, ensure_event_key_index, update_key, write_message
+from logs import get_logger
+from metrics import register_stats, start_metrics_server, timed_handler
 from dotenv import load_dotenv
+import signal
 import time
 
 load_dotenv()
 
+log = get_logger("updates")
+candles_log = get_logger("candles")
+# Payload de cada mensaje; se muestrea (ver LOG_SAMPLE_RATES)
+message_log = get_logger("mqtt.message")
+
 BROKER_HOST = os.getenv("MQTT_BROKER")
 BROKER_PORT = int(os.getenv("MQTT_PORT", "1883"))  # Add default value
 TOPIC = "stocks/updates"
 MQTT_USER = os.getenv("MQTT_USER")
 MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
 
-MONGO_URI = os.getenv("MONGO_URI")
-
 # Detect if running in CI environment
 IS_CI = os.getenv("GITHUB_ACTIONS") == "true" or os.getenv("CI") == "true"
 
 # Only connect to MongoDB if not in CI
 if IS_CI:
-    print("[BROKER_UPDATES] Running in CI environment, skipping database connection")
+    log.info("Running in CI environment, skipping database connection")
     client_mongo = None
     db = None
     collection_stocks = None
     collection_event_log = None
+    collection_versions = None
+    collection_candles = None
 else:
     try:
-        client_mongo = MongoClient(MONGO_URI)
-        db = client_mongo["stocks_db"] 
+        client_mongo = get_client()
+        db = client_mongo[DB_NAME]
         collection_stocks = db["current_stocks"]
         collection_event_log = db["event_log"]
-        print("[BROKER_UPDATES] Connected to MongoDB")
+        # Versiones por colección usadas por la API para invalidar totales cacheados
+        collection_versions = db["collection_versions"]
+        # Velas OHLCV por símbolo e intervalo
+        collection_candles = db["candles"]
+        log.info("Connected to MongoDB")
     except Exception as e:
-        print(f"[BROKER_UPDATES] Failed to connect to MongoDB: {e}")
+        log.error("Failed to connect to MongoDB: %s", e)
         client_mongo = None
+        collection_candles = None
+
+# Buffer de escrituras en lote y workers por símbolo; se crean al iniciar
+# el cliente MQTT
+ingest_buffer = None
+dispatcher = None
+
+# Mensajes recientes, para descartar las entregas repetidas de QoS 1
+seen_messages = SeenCache()
+
+def bump_collection_versions(*names):
+    if collection_versions is None or not names:
+        return
+    collection_versions.update_one(
+        {"_id": "stocks_db"},
+        {"$inc": {name: 1 for name in names}},
+        upsert=True
+    )
 
 def on_connect(client, userdata, flags, rc, properties=None):
-    print(f"Conectado al broker con código de resultado: {rc}")
+    log.info("Conectado al broker con código de resultado: %s", rc)
     client.subscribe(TOPIC)
 
+def process_update(data):
+    """Escribe un mensaje de stocks/updates; corre en el worker de su símbolo."""
+    if data.get("timestamp"):
+        data["timestamp"] = parser.isoparse(data["timestamp"])
+
+    if ingest_buffer is not None:
+        # El hilo del buffer escribe y actualiza las versiones por lote
+        ingest_buffer.add(data)
+        return
+
+    if write_message(db, data):
+        bump_collection_versions("current_stocks", "event_log")
+
+def message_key(data):
+    """Identifica un update (la misma llave de event_log); sin símbolo o timestamp no se deduplica."""
+    return update_key(data)
+
 def on_message(client, userdata, msg):
-    print(f"Mensaje recibido en {msg.topic}: {msg.payload.decode()}")
+    message_log.info("Mensaje recibido en %s: %s", msg.topic, msg.payload.decode())
     
     # Skip processing in CI environment
     if IS_CI:
-        print("[BROKER_UPDATES] Running in CI, skipping message processing")
+        log.debug("Running in CI, skipping message processing")
         return
         
     if collection_stocks is None:
-        print("[BROKER_UPDATES] Database not available")
+        log.warning("Database not available")
         return
         
     try:
         data = json.loads(msg.payload.decode("utf-8"))
-        if data.get("timestamp"):
-            data["timestamp"] = parser.isoparse(data["timestamp"])
-
-        kind = data.get("kind")
-        symbol = data.get("symbol")
-
-        if kind == "IPO":
-            stock_data = {
-                "symbol": data.get("symbol", "SYMBOL"),
-                "quantity": data.get("quantity", 0),
-                "price": data.get("price", 0),
-                "longName": data.get("longName"),
-                "timestamp": data.get("timestamp"),
-                "owner_type": "platform"
-            }
-            collection_stocks.update_one(
-                {"symbol": symbol},
-                {"$set": stock_data},
-                upsert=True
-            )
-            print(f"[IPO] Acción registrada/actualizada: {stock_data}")
-            event_data = {
-                "type": data["kind"],
-                "symbol": data["symbol"],
-                "quantity": data["quantity"],
-                "price": data["price"],
-                "longName": data.get("longName", ""),
-                "timestamp": data["timestamp"]
-            }
-            if collection_event_log is not None:
-                collection_event_log.insert_one(event_data)
-                print(f"[EVENT LOG] Registrada {data['kind']} de {data['symbol']}")
-
-        elif kind == "EMIT":
-            emit_quantity = data.get("quantity", 0)
-            new_price = data.get("price", 0)
-            timestamp = data.get("timestamp")
-
-            result = collection_stocks.find_one({"symbol": symbol})
-            if result:
-                updated_quantity = result["quantity"] + float(emit_quantity)
-                collection_stocks.update_one(
-                    {"symbol": symbol},
-                    {"$set": {
-                        "price": new_price,
-                        "timestamp": timestamp,
-                        "owner_type": "platform"
-                        },
-                     "$inc": {"quantity": emit_quantity}
-                    }
-                )
-                print(f"[EMIT] Acción actualizada: {symbol} | Nuevo precio: {new_price}, Cantidad total: {updated_quantity}")
-
-                event_data = {
-                "type": data["kind"],
-                "symbol": data["symbol"],
-                "quantity": data["quantity"],
-                "price": data["price"],
-                "longName": data.get("longName", ""),
-                "timestamp": data["timestamp"]
-                }
-                if collection_event_log is not None:
-                    collection_event_log.insert_one(event_data)
-                    print(f"[EVENT LOG] Registrada {data['kind']} de {data['symbol']}")
-
-            else:
-                new_stock = {
-                    "symbol": symbol,
-                    "quantity": emit_quantity,
-                    "price": new_price,
-                    "longName": data["longName"],
-                    "timestamp": timestamp,
-                    "owner_type": "platform"
-                }
-                collection_stocks.insert_one(new_stock)
-                print(f"[UPDATE] Acción no encontrada. Se insertó con valores: {new_stock}")
-
-        elif kind == "UPDATE":
-            new_price = data.get("price", 0)
-            result = collection_stocks.find_one({"symbol": symbol})
-            if result:
-                collection_stocks.update_one(
-                    {"symbol": symbol},
-                    {"$set": {"price": new_price,
-                              "timestamp": data["timestamp"],
-                              "owner_type": "platform"}}
-                )
-                print(f"[UPDATE] Precio actualizado para {symbol}: {new_price}")
-                event_data = {
-                    "type": data["kind"],
-                    "symbol": data["symbol"],
-                    "quantity": 0,
-                    "price": new_price,
-                    "longName": "",
-                    "timestamp": data["timestamp"]
-                }
-                if collection_event_log is not None:
-                    collection_event_log.insert_one(event_data)
-                    print(f"[EVENT LOG] Registrada {data['kind']} de {data['symbol']}")
-            else:
-                new_stock = {
-                    "symbol": symbol,
-                    "quantity": 0,
-                    "price": new_price,
-                    "longName": "",
-                    "timestamp": data["timestamp"],
-                    "owner_type": "platform"
-                }
-                collection_stocks.insert_one(new_stock)
-                print(f"[UPDATE] Acción no encontrada. Se insertó con valores por defecto: {new_stock}")
-
     except json.JSONDecodeError as e:
-        print("Error al decodificar el JSON:", e)
+        log.warning("Error al decodificar el JSON: %s", e)
+        return
+
+    if seen_messages.seen(message_key(data)):
+        log.debug("Update repetido descartado: %s %s", data.get("kind"), data.get("symbol"))
+        return
+
+    if dispatcher is not None:
+        dispatcher.submit(data.get("symbol"), data)
+    else:
+        process_update(data)
+
+def _terminate(signum, frame):
+    raise SystemExit(0)
 
 def start_mqtt_client():
     # Skip MQTT connection in CI environment
     if IS_CI:
-        print("[BROKER_UPDATES] Running in CI environment, skipping MQTT client")
+        log.info("Running in CI environment, skipping MQTT client")
         return
         
+    start_metrics_server()
+
     if not BROKER_HOST:
-        print("[BROKER_UPDATES] No MQTT broker configured")
+        log.warning("No MQTT broker configured")
         return
         
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
@@ -185,15 +140,45 @@ def start_mqtt_client():
         client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
 
     client.on_connect = on_connect
-    client.on_message = on_message
+    client.on_message = timed_handler(on_message)
 
-    while True:
+    if collection_candles is not None:
         try:
-            client.connect(BROKER_HOST, BROKER_PORT, keepalive=60)
-            client.loop_forever()
-        except ConnectionRefusedError:
-            print("Conexión rechazada. Reintentando en 5 segundos...")
-            time.sleep(5)
+            ensure_candle_index(collection_candles)
+        except Exception as e:
+            candles_log.error("No se pudo crear el índice de velas: %s", e)
+    if collection_stocks is not None:
+        try:
+            ensure_event_key_index(db["event_log"])
+        except Exception as e:
+            log.error("No se pudo crear el índice de llaves de event_log: %s", e)
+
+    global ingest_buffer, dispatcher
+    if INGEST_BUFFERED and collection_stocks is not None:
+        ingest_buffer = IngestBuffer(db, on_flush=bump_collection_versions).start()
+        register_stats("ingest", ingest_buffer.stats)
+        log.info("Escrituras en lotes de hasta %s mensajes", ingest_buffer.batch_size)
+    dispatcher = ShardedDispatcher("updates", process_update).start()
+    register_stats("mqtt_dispatch", dispatcher.stats, label="shard")
+    register_stats("mqtt_dedup", seen_messages.stats)
+
+    # SIGTERM (docker stop) sale de loop_forever para escribir lo pendiente
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        while True:
+            try:
+                client.connect(BROKER_HOST, BROKER_PORT, keepalive=60)
+                client.loop_forever()
+            except ConnectionRefusedError:
+                log.warning("Conexión rechazada. Reintentando en 5 segundos...")
+                time.sleep(5)
+    finally:
+        client.disconnect()
+        # Primero los workers, que todavía pueden entregar mensajes al buffer
+        dispatcher.close()
+        if ingest_buffer is not None:
+            ingest_buffer.close()
+            log.info("Buffer de escrituras vaciado", extra={"fields": ingest_buffer.stats()})
 
 if __name__ == "__main__":
     start_mqtt_client()
\ No newline at end of file
@@ -0,0 +1,130 @@
+from datetime import datetime
+
+import pytest
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from ingest import IngestBuffer, _waves, message_event, stock_operation, write_message
+
+TS = datetime(2024, 5, 1, 12, 0)
+
+
+def message(kind, symbol, quantity=5, price=10.0, timestamp=TS):
+    return {"kind": kind, "symbol": symbol, "quantity": quantity, "price": price,
+            "timestamp": timestamp, "longName": symbol.lower()}
+
+
+def _symbol(operation):
+    return (operation._doc if isinstance(operation, InsertOne) else operation._filter).get("symbol")
+
+
+class FakeCollection:
+    """Registra las escrituras; falla las de los símbolos en ``failing``."""
+
+    def __init__(self, name, failing=(), duplicates=()):
+        self.name = name
+        self.failing = set(failing)
+        self.duplicates = set(duplicates)
+        self.writes = []
+        self.deleted = []
+
+    def _code(self, symbol, key=None):
+        if key in self.duplicates:
+            return 11000
+        if symbol in self.failing:
+            return 2
+        return None
+
+    def bulk_write(self, operations, ordered=True):
+        errors = []
+        for index, operation in enumerate(operations):
+            document = operation._doc if isinstance(operation, InsertOne) else {}
+            code = self._code(_symbol(operation), document.get("key"))
+            if code is None:
+                self.writes.append(operation)
+            else:
+                errors.append({"index": index, "code": code, "errmsg": "falla"})
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+
+    def insert_one(self, document):
+        if self._code(document["symbol"], document.get("key")) == 11000:
+            raise DuplicateKeyError("dup")
+        self.writes.append(document)
+
+    def find_one(self, query, projection=None):
+        return {"_id": 1} if query.get("symbol") in self.failing | {"KNOWN"} else None
+
+    def delete_one(self, query):
+        self.deleted.append(query["_id"])
+
+    def delete_many(self, query):
+        self.deleted.extend(query["_id"]["$in"])
+
+
+def fake_db(stocks=(), events=()):
+    return {"current_stocks": FakeCollection("current_stocks", failing=stocks),
+            "event_log": FakeCollection("event_log", duplicates=events),
+            "candles": FakeCollection("candles")}
+
+
+def test_waves_keep_ipo_before_later_messages_of_the_same_symbol():
+    # Prueba que el IPO de un símbolo queda en una ola anterior a su EMIT y
+    # que los UPDATE seguidos del mismo símbolo se juntan en uno
+    operations = [(m["symbol"], m["kind"], stock_operation(m)) for m in [
+        message("IPO", "AAPL"), message("UPDATE", "MSFT"), message("EMIT", "AAPL"),
+        message("UPDATE", "MSFT", price=11.0), message("UPDATE", "AAPL"),
+    ]]
+    waves = _waves(operations)
+    assert [[symbol for symbol, _ in wave] for wave in waves] == [["AAPL", "MSFT"], ["AAPL"], ["AAPL"]]
+    assert waves[0][0][1] is operations[0][2]
+    assert waves[1][0][1] is operations[2][2]
+    # Queda el último UPDATE de MSFT
+    assert waves[0][1][1] is operations[3][2]
+
+
+def test_message_event_only_logs_known_symbols():
+    # Prueba que EMIT y UPDATE de un símbolo desconocido no generan evento
+    assert message_event(message("EMIT", "AAPL"), exists=False) is None
+    assert message_event(message("UPDATE", "AAPL"), exists=False) is None
+    assert message_event(message("IPO", "AAPL"), exists=False)["quantity"] == 5
+    update = message_event(message("UPDATE", "AAPL"), exists=True)
+    assert update["quantity"] == 0 and update["longName"] == ""
+    assert update["key"] == f"UPDATE|AAPL|{TS.isoformat()}|10.0|5"
+
+
+def test_flush_skips_duplicates_and_drops_events_of_failed_symbols():
+    # Prueba que un evento repetido no vuelve a escribir el stock y que si
+    # falla el stock de un símbolo se borran sus eventos y no queda conocido
+    db = fake_db(stocks={"MSFT"}, events={f"EMIT|AAPL|{TS.isoformat()}|10.0|5"})
+    buffer = IngestBuffer(db)
+    buffer._known = {"AAPL"}
+    buffer.flush([message("EMIT", "AAPL"), message("IPO", "MSFT"), message("EMIT", "MSFT"),
+                  message("IPO", "NVDA")])
+
+    assert [_symbol(op) for op in db["current_stocks"].writes] == ["NVDA"]
+    inserted = [(op._doc["symbol"], op._doc["_id"]) for op in db["event_log"].writes]
+    assert [symbol for symbol, _ in inserted] == ["MSFT", "MSFT", "NVDA"]
+    assert db["event_log"].deleted == [_id for symbol, _id in inserted if symbol == "MSFT"]
+    assert {_symbol(op) for op in db["candles"].writes} == {"NVDA"}
+    assert buffer._known == {"AAPL", "NVDA"}
+    assert buffer.duplicates == 1 and buffer.write_errors == 1
+
+
+def test_write_message_logs_before_writing_and_undoes_on_failure():
+    # Prueba que write_message no aplica un evento repetido y borra el evento
+    # si falla la escritura del stock
+    key = f"EMIT|KNOWN|{TS.isoformat()}|10.0|5"
+    db = fake_db(events={key})
+    assert write_message(db, message("EMIT", "KNOWN")) is False
+    assert db["current_stocks"].writes == []
+
+    db = fake_db(stocks={"MSFT"})
+    with pytest.raises(BulkWriteError):
+        write_message(db, message("EMIT", "MSFT"))
+    [event] = db["event_log"].writes
+    assert db["event_log"].deleted == [event["_id"]]
+
+    db = fake_db()
+    assert write_message(db, message("IPO", "AAPL")) is True
+    assert [_symbol(op) for op in db["current_stocks"].writes] == ["AAPL"]